@@ -17,6 +17,10 @@ import random
 import binascii
 import scrypt
 
+from multiprocessing import cpu_count, TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
 from pixelated.exceptions import UserNotExistError
 
 from leap.auth import SRPAuth
@@ -28,21 +32,94 @@ from pixelated.bitmask_libraries.leap_certs import which_api_CA_bundle
 from pixelated.common import logger
 
 
+DEFAULT_HASH_WORKERS = cpu_count()
+DEFAULT_MAX_PENDING_HASHES = 4 * DEFAULT_HASH_WORKERS
+HASH_TIMEOUT_IN_S = 60
+
+
+class HashingBusyError(Exception):
+    pass
+
+
 def str_password(password):
     return password if type(password) != unicode else password.encode('utf8')
 
 
+def hash_password(password, salt):
+    return binascii.hexlify(scrypt.hash(str_password(password), salt))
+
+
+class PasswordHashingPool(object):
+    """ Runs scrypt on a fixed number of worker threads, one per core by default.
+
+        The scrypt binding releases the GIL, so the workers hash in parallel while the
+        memory and CPU scrypt takes stays bounded however many logins come in at once.
+        At most max_pending hashes may be running or queued, logins beyond that fail fast
+        with HashingBusyError. Adding credentials waits for its turn instead, as the user
+        is already created by then.
+    """
+
+    __slots__ = ('_pool', '_max_pending', '_pending', '_lock')
+
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, max_pending=DEFAULT_MAX_PENDING_HASHES):
+        self._pool = ThreadPool(workers)
+        self._max_pending = max_pending
+        self._pending = 0
+        self._lock = Lock()
+
+    def hash(self, password, salt, shed=True):
+        with self._lock:
+            if shed and self._pending >= self._max_pending:
+                raise HashingBusyError('%d password hashes pending' % self._pending)
+            self._pending += 1
+        try:
+            result = self._pool.apply_async(self._hash_and_release, (password, salt))
+        except Exception:
+            self._release()
+            raise
+        try:
+            return result.get(HASH_TIMEOUT_IN_S)
+        except TimeoutError:
+            raise HashingBusyError('password hash took longer than %d seconds' % HASH_TIMEOUT_IN_S)
+
+    def _hash_and_release(self, password, salt):
+        try:
+            return hash_password(password, salt)
+        finally:
+            self._release()  # a hash that timed out still takes its worker until it is done
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self):
+        return {'pending': self._pending, 'max_pending': self._max_pending}
+
+    def shutdown(self):
+        self._pool.close()
+
+
 class Authenticator(object):
 
-    __slots__ = ('_users', 'provider')
+    __slots__ = ('_users', 'provider', '_hashing_pool')
 
-    def __init__(self, users, provider):
+    def __init__(self, users, provider, hashing_pool=None):
+        """Without hashing_pool passwords get hashed on the calling thread"""
         self._users = users
         self.provider = provider
+        self._hashing_pool = hashing_pool
+
+    def hashing_stats(self):
+        return self._hashing_pool.stats() if self._hashing_pool else None
+
+    def _hash(self, password, salt, shed=True):
+        if self._hashing_pool:
+            return self._hashing_pool.hash(password, salt, shed=shed)
+        return hash_password(password, salt)
 
     def add_credentials(self, username, password):
         salt = binascii.hexlify(str(random.getrandbits(128)))
-        bytes = binascii.hexlify(scrypt.hash(str_password(password), salt))
+        bytes = self._hash(password, salt, shed=False)
 
         cfg = self._users.config(username)
         cfg['auth.salt'] = salt
@@ -65,7 +142,7 @@ class Authenticator(object):
         try:
             cfg = self._users.config(username)
             salt = cfg['auth.salt']
-            hashed_password = binascii.hexlify(scrypt.hash(str_password(password), salt))
+            hashed_password = self._hash(password, salt)
             return hashed_password == cfg['auth.hashed_password']
         except UserNotExistError:
             return False
@@ -15,7 +15,7 @@
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import getpass
 
-from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient, PixelatedHTTPError
+from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient, PixelatedHTTPError, parse_manager_endpoints
 import pixelated.manager
 
 import sys
@@ -33,7 +33,7 @@ class Cli(object):
 
     def _build_parser(self):
         parser = argparse.ArgumentParser()
-        parser.add_argument('--manager', help='provide manager URL (default: localhost:4449)')
+        parser.add_argument('--manager', help='provide manager host:port, a comma separated list fails over between managers (default: localhost:4449)')
         parser.add_argument('-k', '--no-check-certificate', help='don\'t validate SSL/TLS certificates', dest='check_cert', action='store_false', default=True)
         parser.add_argument('--no-ssl', help='force unsecured connection', dest='use_ssl', action='store_false', default=True)
         parser.add_argument('--sslcert', help='specify the SSL certificate to use', default=None)
@@ -44,55 +44,131 @@ class Cli(object):
         addparser = subparsers.add_parser('add', help='add an agent')
         addparser.add_argument('name', help='name of new user')
         startparser = subparsers.add_parser('start', help='start agent')
-        startparser.add_argument('name', help='name of user')
+        self._add_names_arguments(startparser)
+        self._add_wait_argument(startparser)
         stopparser = subparsers.add_parser('stop', help='stop agent')
-        stopparser.add_argument('name', help='name of user')
+        self._add_names_arguments(stopparser)
+        self._add_wait_argument(stopparser)
         infoparser = subparsers.add_parser('info', help='show agent info')
         infoparser.add_argument('name', help='name of user')
         subparsers.add_parser('memory_usage', help='show memory usage')
         resetparser = subparsers.add_parser('reset_data', help='reset user agent data')
-        resetparser.add_argument('name', help='name of user')
+        self._add_names_arguments(resetparser)
+        migrateparser = subparsers.add_parser('migrate', help='move a running agent to another docker host')
+        migrateparser.add_argument('name', help='name of user')
+        migrateparser.add_argument('host', help='address of the target docker host')
+        migrateparser.add_argument('--force', help='migrate even if the agent is in use', action='store_true', default=False)
+        self._add_wait_argument(migrateparser)
+        drainparser = subparsers.add_parser('drain', help='stop all agents and reject new starts for maintenance')
+        drainparser.add_argument('--grace-period', help='seconds until agents in use get stopped too (default: 600)', type=float, default=None)
+        draingroup = drainparser.add_mutually_exclusive_group()
+        draingroup.add_argument('--status', help='only show drain progress', action='store_true', default=False)
+        draingroup.add_argument('--cancel', help='stop draining and accept starts again', action='store_true', default=False)
+        rebalanceparser = subparsers.add_parser('rebalance', help='move idle agents to even out memory usage of docker hosts')
+        rebalanceparser.add_argument('--watermark', help='memory usage ratio hosts should stay below (default: 0.8)', type=float, default=None)
+        rebalanceparser.add_argument('-n', '--dry-run', help='only show the planned moves', action='store_true', default=False)
         return parser
 
+    def _add_names_arguments(self, parser):
+        parser.add_argument('names', help='name of user(s)', nargs='*', metavar='name')
+        parser.add_argument('-f', '--file', help='read user names from file, one per line', default=None)
+
+    def _add_wait_argument(self, parser):
+        parser.add_argument('-w', '--wait', help='wait until a single agent finished the operation', action='store_true', default=False)
+
+    def _read_names(self, args):
+        names = list(args.names)
+        if args.file:
+            with open(args.file) as fd:
+                names.extend(line.strip() for line in fd if line.strip())
+        return names
+
+    def _run_for_names(self, cli, args, action, single_call):
+        names = self._read_names(args)
+        if len(names) == 1 and not args.file:
+            result = single_call(names[0])
+            if getattr(args, 'wait', False):
+                self._wait_for_job(cli, names[0], result['job'])
+        else:
+            for result in cli.batch(action, names):
+                if result['status'] == 202:
+                    self._wait_for_job(cli, result['name'], result['job'])
+                else:
+                    self._out.write('%s:\tfailed (%d) %s\n' % (result['name'], result['status'], result.get('message', '')))
+
+    def _wait_for_job(self, cli, name, job):
+        job = cli.wait_for_job(job['id'])
+        if job['status'] == 'failed':
+            self._out.write('%s:\tfailed %s\n' % (name, job['error']))
+        else:
+            self._out.write('%s:\t%s\n' % (name, job['status']))
+
+    def _write_drain_status(self, status):
+        self._out.write('state:\t%s\n' % status['state'])
+        if status['state'] != 'off':
+            self._out.write('agents:\t%d of %d stopped, %d running\n' % (status['stopped_agents'], status['initial_agents'], status['running_agents']))
+            self._out.write('grace period:\t%ds left\n' % status['remaining_grace_period'])
+
     def run(self):
         parser = self._build_parser()
 
         try:
             args = parser.parse_args(self._args)
+            if args.cmd in ('start', 'stop', 'reset_data') and not args.names and not args.file:
+                parser.error('%s needs at least one name or --file' % args.cmd)
             if args.manager:
-                host, port = args.manager.split(':')
+                endpoints = parse_manager_endpoints(args.manager)
             else:
-                host, port = 'localhost', Cli.DEFAULT_SERVER_PORT
+                endpoints = [('localhost', Cli.DEFAULT_SERVER_PORT)]
+            host, port = endpoints[0]
 
             check_cert = args.sslcert if args.sslcert else args.check_cert
             fingerprint = args.fingerprint
 
-            cli = self._create_cli(host, port, check_cert, args.use_ssl, fingerprint)
+            cli = self._create_cli(host, port, check_cert, args.use_ssl, fingerprint, endpoints=endpoints[1:])
             if 'list' == args.cmd:
                 for agent in cli.list():
                     self._out.write('%s\n' % agent['name'])
             elif 'running' == args.cmd:
-                for agent in cli.list():
-                    if 'running' == agent['state']:
-                        self._out.write('%s\n' % agent['name'])
+                for agent in cli.list(state='running'):
+                    self._out.write('%s\n' % agent['name'])
             elif 'add' == args.cmd:
                 name = args.name
                 password = getpass.getpass('Enter password for new user', self._out)
                 cli.add(name, password)
             elif 'start' == args.cmd:
-                name = args.name
-                cli.start(name)
+                self._run_for_names(cli, args, 'start', cli.start)
             elif 'stop' == args.cmd:
-                name = args.name
-                cli.stop(name)
+                self._run_for_names(cli, args, 'stop', cli.stop)
             elif 'reset_data' == args.cmd:
-                name = args.name
-                cli.reset_data(name)
+                self._run_for_names(cli, args, 'reset_data', cli.reset_data)
             elif 'info' == args.cmd:
                 name = args.name
                 info = cli.get_agent_runtime(name)
-                message = 'Not running\n' if info['state'] == 'stopped' else 'port:\t%s\n' % info['port']
+                if info['state'] == 'stopped':
+                    message = 'Not running\n'
+                elif info['state'] == 'running':
+                    message = 'port:\t%s\n' % info['port']
+                else:
+                    message = '%s\n' % info['state'].capitalize()
                 self._out.write(message)
+            elif 'migrate' == args.cmd:
+                result = cli.migrate(args.name, args.host, force=args.force)
+                if args.wait:
+                    self._wait_for_job(cli, args.name, result['job'])
+            elif 'drain' == args.cmd:
+                if args.cancel:
+                    status = cli.cancel_drain()
+                elif args.status:
+                    status = cli.drain_status()
+                else:
+                    status = cli.drain(args.grace_period)
+                self._write_drain_status(status)
+            elif 'rebalance' == args.cmd:
+                moves = cli.rebalance_plan(args.watermark) if args.dry_run else cli.rebalance(args.watermark)
+                for move in moves:
+                    error = '\tfailed %s' % move['error'] if 'error' in move else ''
+                    self._out.write('%s:\t%s -> %s%s\n' % (move['agent'], move['source'], move['target'], error))
             elif 'memory_usage' == args.cmd:
                 usage = cli.memory_usage()
                 self._out.write('memory usage:\t%d\n' % usage['total_usage'])
@@ -106,5 +182,5 @@ class Cli(object):
         except SystemExit:
             pass
 
-    def _create_cli(self, host, port, cacert, ssl, fingerprint):
-        return PixelatedDispatcherClient(host, port, cacert=cacert, ssl=ssl, fingerprint=fingerprint)
+    def _create_cli(self, host, port, cacert, ssl, fingerprint, endpoints=None):
+        return PixelatedDispatcherClient(host, port, cacert=cacert, ssl=ssl, fingerprint=fingerprint, endpoints=endpoints)
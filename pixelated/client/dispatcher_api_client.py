@@ -16,10 +16,13 @@
 import json
 import ssl
 import time
+import urllib
+from collections import OrderedDict
+from threading import Lock
 
 import requests
 from requests.adapters import HTTPAdapter
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 from pixelated.common import latest_available_ssl_version
 from pixelated.common import logger
 try:
@@ -28,16 +31,26 @@ except:
     from urllib3.poolmanager import PoolManager
 
 DEFAULT_TIMEOUT_IN_S = 10
+DEFAULT_REQUEST_TIMEOUT_IN_S = 30
+DEFAULT_POOL_SIZE = 10
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_JOB_TIMEOUT_IN_S = 120
+JOB_WAIT_STEP_IN_S = 10
+JOB_POLL_INTERVAL_IN_S = 1
 VERIFY_HOSTNAME = None
+DEFAULT_RETRIES = 2
+INITIAL_BACKOFF_IN_S = 0.5
+MAX_BACKOFF_IN_S = 30
+MAX_PINNED_JOBS = 1000
 
 
 class EnforceTLSv1Adapter(HTTPAdapter):
     __slots__ = ('_assert_hostname', '_assert_fingerprint')
 
-    def __init__(self, assert_hostname=VERIFY_HOSTNAME, assert_fingerprint=None):
+    def __init__(self, assert_hostname=VERIFY_HOSTNAME, assert_fingerprint=None, **kwargs):
         self._assert_hostname = assert_hostname
         self._assert_fingerprint = assert_fingerprint
-        super(EnforceTLSv1Adapter, self).__init__()
+        super(EnforceTLSv1Adapter, self).__init__(**kwargs)
 
     def init_poolmanager(self, connections, maxsize, block=False):
         self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize,
@@ -62,50 +75,173 @@ class PixelatedNotAvailableHTTPError(PixelatedHTTPError):
     pass
 
 
+def parse_manager_endpoints(value):
+    """Parses a comma separated list of manager host:port pairs"""
+    endpoints = []
+    for endpoint in value.split(','):
+        hostname, port = endpoint.strip().rsplit(':', 1)
+        endpoints.append((hostname, int(port)))
+    return endpoints
+
+
+class ManagerEndpoint(object):
+    """Tracks health and load of a single manager a client talks to"""
+
+    __slots__ = ('hostname', 'port', 'base_url', 'outstanding', 'failures', 'retry_at')
+
+    def __init__(self, scheme, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.base_url = '%s://%s:%s' % (scheme, hostname, port)
+        self.outstanding = 0
+        self.failures = 0
+        self.retry_at = 0
+
+    def is_healthy(self, now):
+        return self.retry_at <= now
+
+    def mark_success(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def mark_failure(self, now):
+        self.failures += 1
+        self.retry_at = now + min(MAX_BACKOFF_IN_S, INITIAL_BACKOFF_IN_S * 2 ** (self.failures - 1))
+
+    def __str__(self):
+        return '%s:%s' % (self.hostname, self.port)
+
+
 class PixelatedDispatcherClient(object):
-    __slots__ = ('_hostname', '_port', '_base_url', '_cacert', '_scheme', '_assert_hostname', '_fingerprint')
+    """ Client for the manager REST api.
+
+        Additional managers can be passed as `endpoints`. Requests go to the healthy manager
+        with the fewest outstanding requests and managers that fail to connect are skipped with
+        an exponential backoff. Failed idempotent requests, and requests a manager answered with
+        503 because it is busy or draining, go to the next manager right away. The client never
+        sleeps between attempts, it gives up once every manager has been tried.
+
+        Jobs only exist on the manager that created them, so job lookups go to that manager.
+    """
 
-    def __init__(self, hostname, port, cacert=True, ssl=True, assert_hostname=VERIFY_HOSTNAME, fingerprint=None):
-        self._hostname = hostname
-        self._port = port
+    __slots__ = ('_endpoints', '_endpoints_lock', '_job_endpoints', '_retries', '_cacert', '_scheme', '_assert_hostname', '_fingerprint', '_pool_size', '_timeout', '_session', '_session_lock')
+
+    def __init__(self, hostname, port, cacert=True, ssl=True, assert_hostname=VERIFY_HOSTNAME, fingerprint=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_REQUEST_TIMEOUT_IN_S, endpoints=None, retries=DEFAULT_RETRIES):
         self._scheme = 'https' if ssl else 'http'
-        self._base_url = '%s://%s:%s' % (self._scheme, hostname, port)
+        self._endpoints = [ManagerEndpoint(self._scheme, h, p) for h, p in [(hostname, port)] + list(endpoints or [])]
+        self._endpoints_lock = Lock()
+        self._job_endpoints = OrderedDict()
+        self._retries = retries
         self._cacert = cacert
         self._assert_hostname = assert_hostname
         self._fingerprint = fingerprint
-
-    def _get(self, path):
-        uri = '%s%s' % (self._base_url, path)
-        s = requests.Session()
-        s.mount('https://', EnforceTLSv1Adapter(assert_fingerprint=self._fingerprint, assert_hostname=self._assert_hostname))
-        r = s.get(uri, verify=self._cacert)
-        self._raise_error_for_status(r.status_code, r.reason)
-        return r.json()
-
-    def _put(self, path, json_data=None):
-        uri = '%s%s' % (self._base_url, path)
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session = None
+        self._session_lock = Lock()
+
+    def _http_session(self):
+        """Returns the session shared by all calls, so connections to the manager get reused"""
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                session.mount('https://', EnforceTLSv1Adapter(assert_fingerprint=self._fingerprint, assert_hostname=self._assert_hostname, pool_maxsize=self._pool_size))
+                self._session = session
+            return self._session
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _acquire_endpoint(self, tried, endpoints=None):
+        """Picks the healthy endpoint with the fewest outstanding requests, preferring ones not tried yet"""
+        endpoints = endpoints or self._endpoints
+        with self._endpoints_lock:
+            now = time.time()
+            candidates = [e for e in endpoints if e not in tried] or endpoints
+            healthy = [e for e in candidates if e.is_healthy(now)]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: e.outstanding)
+            else:
+                endpoint = min(candidates, key=lambda e: e.retry_at)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release_endpoint(self, endpoint, failed):
+        with self._endpoints_lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.mark_failure(time.time())
+            else:
+                endpoint.mark_success()
+
+    def _pin_jobs(self, endpoint, data):
+        """Remembers the manager that created the jobs in a response"""
+        if not isinstance(data, dict):
+            return
+        items = [data] + [item for item in data.get('results') or data.get('moves') or [] if isinstance(item, dict)]
+        with self._endpoints_lock:
+            for item in items:
+                if isinstance(item.get('job'), dict):
+                    self._job_endpoints[item['job']['id']] = endpoint
+            while len(self._job_endpoints) > MAX_PINNED_JOBS:
+                self._job_endpoints.popitem(last=False)
+
+    def _job_endpoint(self, job_id):
+        with self._endpoints_lock:
+            return self._job_endpoints.get(job_id)
+
+    def _request(self, method, path, idempotent, timeout=None, endpoint=None, **kwargs):
+        """Sends the request and returns the manager that answered with the response.
+
+           With `endpoint` only that manager is asked.
+        """
+        candidates = [endpoint] if endpoint else self._endpoints
+        attempts = min(1 + self._retries, len(candidates))
+        tried = []
+        for attempt in range(attempts):
+            endpoint = self._acquire_endpoint(tried, candidates)
+            tried.append(endpoint)
+
+            uri = '%s%s' % (endpoint.base_url, path)
+            try:
+                r = getattr(self._http_session(), method)(uri, verify=self._cacert, timeout=timeout or self._timeout, **kwargs)
+            except (ConnectionError, Timeout), e:
+                self._release_endpoint(endpoint, failed=True)
+                if not idempotent or attempt + 1 == attempts:
+                    raise
+                logger.warn('Request to manager %s failed, retrying: %s' % (endpoint, e))
+                continue
+
+            self._release_endpoint(endpoint, failed=False)
+            if r.status_code == 503 and attempt + 1 < attempts:
+                logger.warn('Manager %s not available, trying another one: %s' % (endpoint, r.reason))
+                continue  # e.g. draining for maintenance, the request has not been processed
+            self._raise_error_for_status(r.status_code, r.reason)
+            return endpoint, r
+
+    def _get(self, path, timeout=None, endpoint=None):
+        return self._request('get', path, idempotent=True, timeout=timeout, endpoint=endpoint)[1].json()
+
+    def _put(self, path, json_data=None, idempotent=True):
         if json_data:
             json_data = json.dumps(json_data)
 
-        s = requests.Session()
-        s.mount('https://', EnforceTLSv1Adapter(assert_fingerprint=self._fingerprint, assert_hostname=self._assert_hostname))
-        r = s.put(uri, data=json_data, headers={'Content-Type': 'application/json'}, verify=self._cacert)
-
-        self._raise_error_for_status(r.status_code, r.reason)
-        return r.json()
+        endpoint, r = self._request('put', path, idempotent=idempotent, data=json_data, headers={'Content-Type': 'application/json'})
+        data = r.json()
+        self._pin_jobs(endpoint, data)
+        return data
 
     def _post(self, path, json_data=None):
-        uri = '%s%s' % (self._base_url, path)
         if json_data:
             json_data = json.dumps(json_data)
 
-        s = requests.Session()
-        s.mount('https://', EnforceTLSv1Adapter(assert_fingerprint=self._fingerprint, assert_hostname=self._assert_hostname))
-        r = s.post(uri, data=json_data, headers={'Content-Type': 'application/json'}, verify=self._cacert)
-
-        self._raise_error_for_status(r.status_code, r.reason)
-
-        return r.json() if r.content else None
+        endpoint, r = self._request('post', path, idempotent=False, data=json_data, headers={'Content-Type': 'application/json'})
+        data = r.json() if r.content else None
+        self._pin_jobs(endpoint, data)
+        return data
 
     def _raise_error_for_status(self, status_code, reason):
         if 503 == status_code:
@@ -113,8 +249,30 @@ class PixelatedDispatcherClient(object):
         if 400 <= status_code < 600:
             raise PixelatedHTTPError(reason, status_code=status_code)
 
-    def list(self):
-        return self._get('/agents').get('agents')
+    def list(self, state=None, prefix=None, page_size=DEFAULT_PAGE_SIZE):
+        """Returns an iterator over the agents. Only the first page is fetched right away, the others on demand"""
+        query = {'limit': page_size}
+        if state:
+            query['state'] = state
+        if prefix:
+            query['prefix'] = prefix
+
+        page = self._get(self._agents_path(query))
+        return self._iterate_agent_pages(page, query)
+
+    def _agents_path(self, query):
+        return '/agents?%s' % urllib.urlencode(sorted(query.items()))
+
+    def _iterate_agent_pages(self, page, query):
+        while True:
+            for agent in page.get('agents'):
+                yield agent
+
+            cursor = page.get('next')
+            if not cursor:
+                return
+            query['cursor'] = cursor
+            page = self._get(self._agents_path(query))
 
     def get_agent(self, name):
         return self._get('/agents/%s' % name)
@@ -124,11 +282,26 @@ class PixelatedDispatcherClient(object):
 
     def start(self, name):
         payload = {'state': 'running'}
-        return self._put('/agents/%s/state' % name, json_data=payload)
+        return self._put('/agents/%s/state' % name, json_data=payload, idempotent=False)  # creates a job
 
     def stop(self, name):
         payload = {'state': 'stopped'}
-        return self._put('/agents/%s/state' % name, json_data=payload)
+        return self._put('/agents/%s/state' % name, json_data=payload, idempotent=False)  # creates a job
+
+    def get_job(self, job_id):
+        return self._get('/jobs/%s' % job_id, endpoint=self._job_endpoint(job_id))
+
+    def wait_for_job(self, job_id, timeout_in_s=DEFAULT_JOB_TIMEOUT_IN_S):
+        """Blocks until the job finished or the timeout expired and returns the last known job state"""
+        deadline = time.time() + timeout_in_s
+        while True:
+            step = max(0, min(JOB_WAIT_STEP_IN_S, deadline - time.time()))
+            asked_at = time.time()
+            job = self._get('/jobs/%s/wait?timeout=%s' % (job_id, step), timeout=step + self._timeout, endpoint=self._job_endpoint(job_id))
+            if job['status'] in ('succeeded', 'failed') or time.time() >= deadline:
+                return job
+            if time.time() - asked_at < min(step, JOB_POLL_INTERVAL_IN_S):
+                time.sleep(JOB_POLL_INTERVAL_IN_S)  # the manager had no worker to spare for waiting
 
     def agent_exists(self, name):
         try:
@@ -158,18 +331,53 @@ class PixelatedDispatcherClient(object):
     def memory_usage(self):
         return self._get('/stats/memory_usage')
 
+    def migrate(self, name, host, force=False):
+        payload = {'host': host}
+        if force:
+            payload['force'] = True
+        return self._post('/agents/%s/migrate' % name, json_data=payload)
+
+    def drain(self, grace_period=None):
+        payload = {'draining': True}
+        if grace_period is not None:
+            payload['grace_period'] = grace_period
+        return self._put('/drain', json_data=payload)
+
+    def cancel_drain(self):
+        return self._put('/drain', json_data={'draining': False})
+
+    def drain_status(self):
+        return self._get('/drain')
+
+    def rebalance_plan(self, watermark=None):
+        path = '/rebalance?%s' % urllib.urlencode({'watermark': watermark}) if watermark else '/rebalance'
+        return self._get(path).get('moves')
+
+    def rebalance(self, watermark=None):
+        payload = {'watermark': watermark} if watermark else {}
+        return self._post('/rebalance', json_data=payload).get('moves')
+
+    def batch(self, action, agent_names):
+        """Schedules a job per agent, returns a result with the job or the error for every agent"""
+        payload = {
+            'action': action,
+            'agents': agent_names
+        }
+
+        return self._post('/batch', json_data=payload).get('results')
+
     def validate_connection(self, timeout_in_s=DEFAULT_TIMEOUT_IN_S):
         try:
             start = time.time()
             ok = False
             while not ok and (time.time() - start < timeout_in_s):
                 try:
-                    self.list()
+                    self.list(page_size=1)
                     ok = True
                 except ConnectionError, e:
                     logger.warn(e.message)
                 time.sleep(0.5)
             if not ok:
-                raise ConnectionError('Failed to connect to manager (%s) within %d seconds' % (self._hostname, timeout_in_s))
+                raise ConnectionError('Failed to connect to manager (%s) within %d seconds' % (', '.join(str(e) for e in self._endpoints), timeout_in_s))
         except PixelatedNotAvailableHTTPError:
             pass  # ignore this kind of problem
@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import heapq
+import json
+from hashlib import md5
+from threading import Lock
+
+from pixelated.common import logger
+
+DEFAULT_VIRTUAL_NODES = 100
+
+
+def load_shard_overrides(path):
+    """Reads a JSON object that maps user names to the shard they got migrated to"""
+    with open(path) as fd:
+        overrides = json.load(fd)
+    if not isinstance(overrides, dict):
+        raise ValueError('Shard overrides in %s must be a JSON object' % path)
+    return overrides
+
+
+class HashRing(object):
+    """ Consistent hash ring over shard names.
+
+        Every shard is placed on the ring several times so users spread evenly. Adding
+        a shard only moves the users that now hash to it, everyone else keeps their shard.
+    """
+
+    __slots__ = ('_keys', '_shards')
+
+    def __init__(self, shards, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        if not shards:
+            raise ValueError('Hash ring needs at least one shard')
+        nodes = sorted((self._hash('%s#%d' % (shard, i)), shard) for shard in shards for i in range(virtual_nodes))
+        self._keys = [key for key, shard in nodes]
+        self._shards = [shard for key, shard in nodes]
+
+    @staticmethod
+    def _hash(value):
+        return long(md5(value.encode('utf-8') if isinstance(value, unicode) else value).hexdigest(), 16)
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._shards[index]
+
+
+class ShardedDispatcherClient(object):
+    """ Spreads users over several managers.
+
+        Takes a dict of shard name to PixelatedDispatcherClient and offers the same api for
+        the calls the proxy makes. Calls for a user go to the shard the hash ring picks,
+        unless the user has an override because it got migrated to another shard.
+    """
+
+    __slots__ = ('_clients', '_ring', '_overrides', '_overrides_lock')
+
+    def __init__(self, clients, overrides=None, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        self._clients = dict(clients)
+        self._ring = HashRing(sorted(self._clients.keys()), virtual_nodes=virtual_nodes)
+        self._overrides = {}
+        self._overrides_lock = Lock()
+        self.update_overrides(overrides or {})
+
+    def update_overrides(self, overrides):
+        unknown = [shard for shard in overrides.values() if shard not in self._clients]
+        if unknown:
+            raise ValueError('Overrides refer to unknown shards: %s' % ', '.join(sorted(set(unknown))))
+        with self._overrides_lock:
+            self._overrides = dict(overrides)
+        logger.info('Using %d shard overrides' % len(overrides))
+
+    def shard_for(self, name):
+        with self._overrides_lock:
+            shard = self._overrides.get(name)
+        return shard if shard is not None else self._ring.shard_for(name)
+
+    def client_for(self, name):
+        return self._clients[self.shard_for(name)]
+
+    def get_agent(self, name):
+        return self.client_for(name).get_agent(name)
+
+    def get_agent_runtime(self, name):
+        return self.client_for(name).get_agent_runtime(name)
+
+    def start(self, name):
+        return self.client_for(name).start(name)
+
+    def stop(self, name):
+        return self.client_for(name).stop(name)
+
+    def agent_exists(self, name):
+        return self.client_for(name).agent_exists(name)
+
+    def authenticate(self, name, password):
+        return self.client_for(name).authenticate(name, password)
+
+    def add(self, agent_name, password):
+        return self.client_for(agent_name).add(agent_name, password)
+
+    def reset_data(self, agent_name):
+        return self.client_for(agent_name).reset_data(agent_name)
+
+    def list(self, state=None, prefix=None, **kwargs):
+        """Returns an iterator over the agents of all shards, ordered by name like the managers return them"""
+        pages = [client.list(state=state, prefix=prefix, **kwargs) for shard, client in sorted(self._clients.items())]
+        merged = heapq.merge(*[((agent['name'], agent) for agent in page) for page in pages])
+        return (agent for name, agent in merged)
+
+    def validate_connection(self, **kwargs):
+        for shard, client in sorted(self._clients.items()):
+            client.validate_connection(**kwargs)
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
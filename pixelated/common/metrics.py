@@ -0,0 +1,43 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+from threading import Lock
+
+
+class Metrics(object):
+    """Thread safe counters and timers that can be exposed as a JSON snapshot"""
+
+    __slots__ = ('_counters', '_timers', '_lock')
+
+    def __init__(self):
+        self._counters = {}
+        self._timers = {}
+        self._lock = Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def time(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def snapshot(self):
+        with self._lock:
+            timers = {}
+            for name, (count, total, maximum) in self._timers.iteritems():
+                timers[name] = {'count': count, 'total': total, 'max': maximum, 'mean': total / count}
+            return {'counters': dict(self._counters), 'timers': timers}
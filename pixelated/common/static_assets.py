@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import json
+import os
+import re
+import shutil
+from hashlib import md5
+from os.path import join, exists, isfile, splitext
+
+# only depends on the standard library as setup.py runs it before the dependencies are installed
+
+MANIFEST_FILE = 'manifest.json'
+FINGERPRINT_LENGTH = 10
+PRECOMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.txt', '.json')
+CSS_URL = re.compile(r'''url\((['"]?)([^'"()]+)\1\)''')
+
+
+def fingerprinted_name(name, content):
+    base, ext = splitext(name)
+    return '%s.%s%s' % (base, md5(content).hexdigest()[:FINGERPRINT_LENGTH], ext)
+
+
+def _rewrite_css_urls(content, manifest):
+    def replace(match):
+        quote, url = match.groups()
+        return 'url(%s%s%s)' % (quote, manifest.get(url, url), quote)
+    return CSS_URL.sub(replace, content)
+
+
+def _write(path, content):
+    with open(path, 'wb') as fd:
+        fd.write(content)
+
+
+def _write_gzipped(path, content):
+    with open(path + '.gz', 'wb') as raw:
+        fd = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=raw, mtime=0)
+        fd.write(content)
+        fd.close()
+
+
+def build_static_assets(static_path, build_path):
+    """ Writes a fingerprinted copy of every file in static_path to build_path.
+
+        Compressible files get a gzipped variant next to them, and css references to other
+        static files are rewritten to their fingerprinted names. The manifest maps original
+        to fingerprinted names and is returned.
+    """
+    if exists(build_path):
+        shutil.rmtree(build_path)
+    os.makedirs(build_path)
+
+    names = sorted(name for name in os.listdir(static_path) if isfile(join(static_path, name)))
+    stylesheets = [name for name in names if name.endswith('.css')]
+    manifest = {}
+    for name in [name for name in names if name not in stylesheets] + stylesheets:  # css last so it can reference the others
+        with open(join(static_path, name), 'rb') as fd:
+            content = fd.read()
+        if name in stylesheets:
+            content = _rewrite_css_urls(content, manifest)
+        manifest[name] = fingerprinted_name(name, content)
+
+        for target in (name, manifest[name]):
+            _write(join(build_path, target), content)
+            if name.endswith(PRECOMPRESSED_EXTENSIONS):
+                _write_gzipped(join(build_path, target), content)
+
+    with open(join(build_path, MANIFEST_FILE), 'w') as fd:
+        json.dump(manifest, fd, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_static_manifest(build_path):
+    """Returns the manifest of a static build or an empty dict if there is none"""
+    path = join(build_path, MANIFEST_FILE)
+    if not exists(path):
+        return {}
+    with open(path) as fd:
+        return json.load(fd)
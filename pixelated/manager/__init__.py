@@ -14,22 +14,32 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import os
-from threading import Thread
+import json
+from bisect import bisect_left, bisect_right
+from itertools import takewhile
+from threading import Thread, BoundedSemaphore
 import traceback
 from pixelated.provider.base_provider import ProviderInitializingException
 from pixelated.common import logger
 from pixelated.provider.docker import DockerProvider
+from pixelated.provider.docker.multi_host import MultiHostDockerProvider
+from pixelated.provider.docker.migration import RsyncDataSync, DEFAULT_MEMORY_WATERMARK
 from pixelated.provider.docker.pixelated_adapter import PixelatedDockerAdapter
 from pixelated.exceptions import InstanceAlreadyRunningError, UserNotExistError, InstanceNotRunningError, UserAlreadyExistsError, InstanceNotFoundError
 from pixelated.users import Users
-from pixelated.authenticator import Authenticator
+from pixelated.authenticator import Authenticator, PasswordHashingPool, HashingBusyError, DEFAULT_HASH_WORKERS, DEFAULT_MAX_PENDING_HASHES
 from os.path import join
 
 import ssl
 
 from bottle import run, Bottle, request, response, WSGIRefServer
 
-from pixelated.manager.bottle_adapter import SSLWSGIRefServerAdapter
+from pixelated.manager.activity import AgentActivity
+from pixelated.manager.agent_snapshot import AgentStateSnapshot
+from pixelated.manager.drain import Drain, DEFAULT_GRACE_PERIOD_IN_S
+from pixelated.manager.jobs import LifecycleJobs, JobInProgressError
+from pixelated.manager.state import StateStore, LeaderLock
+from pixelated.manager.bottle_adapter import SSLWSGIRefServerAdapter, ThreadPoolWSGIServerAdapter, DEFAULT_WORKERS
 from pixelated.provider.fork import ForkProvider
 from pixelated.provider.fork.fork_runner import ForkRunner
 from pixelated.provider.fork.mailpile_adapter import MailpileAdapter
@@ -40,6 +50,13 @@ from pixelated.bitmask_libraries.leap_provider import LeapProvider
 from pixelated.bitmask_libraries.leap_certs import LeapCertificate
 
 DEFAULT_PORT = 4443
+MAX_PAGE_SIZE = 1000
+BATCH_ACTIONS = ('start', 'stop', 'reset_data')
+DEFAULT_JOB_WAIT_IN_S = 10
+WORKERS_PER_JOB_WAITER = 4  # at most a quarter of the REST api workers may block waiting for jobs
+MAX_JOB_WAIT_IN_S = 30
+STATE_FILE = '.manager-state.json'
+LEADER_LOCK_FILE = '.manager.lock'
 
 
 class SSLConfig(object):
@@ -74,16 +91,22 @@ def log_all_exceptions(callback):
 
 
 class RESTfulServer(object):
-    __slots__ = ('_ssl_config', '_bindaddr', '_port', '_users', '_authenticator', '_provider', '_server_adapter')
+    __slots__ = ('_ssl_config', '_bindaddr', '_port', '_workers', '_users', '_authenticator', '_provider', '_server_adapter', '_agent_snapshot', '_jobs', '_activity', '_drain', '_job_waiters')
 
-    def __init__(self, ssl_config, users, authenticator, provider, bindaddr='127.0.0.1', port=DEFAULT_PORT):
+    def __init__(self, ssl_config, users, authenticator, provider, bindaddr='127.0.0.1', port=DEFAULT_PORT, workers=DEFAULT_WORKERS, state_store=None):
         self._ssl_config = ssl_config
         self._bindaddr = bindaddr
         self._port = port
+        self._workers = workers  # 0 means single-threaded
         self._users = users
         self._authenticator = authenticator
         self._provider = provider
         self._server_adapter = None
+        self._agent_snapshot = AgentStateSnapshot(provider)
+        self._jobs = LifecycleJobs(provider, on_finish=lambda job: self._agent_snapshot.invalidate(job.agent))
+        self._activity = AgentActivity(store=state_store)
+        self._drain = Drain(provider, self._jobs, lambda name: self._activity.is_idle(name), store=state_store)
+        self._job_waiters = BoundedSemaphore(workers // WORKERS_PER_JOB_WAITER) if workers >= WORKERS_PER_JOB_WAITER else None
 
     def init_bottle_app(self):
         app = Bottle()
@@ -99,8 +122,18 @@ class RESTfulServer(object):
         app.route('/agents/<name>/runtime', method='GET', callback=self._get_agent_runtime)
         app.route('/agents/<name>/authenticate', method='POST', callback=self._authenticate_agent)
         app.route('/agents/<name>/reset_data', method='PUT', callback=self._reset_agent_data)
+        app.route('/agents/<name>/migrate', method='POST', callback=self._migrate_agent)
+        app.route('/rebalance', method='GET', callback=self._rebalance_plan)
+        app.route('/rebalance', method='POST', callback=self._rebalance)
+        app.route('/batch', method='POST', callback=self._run_batch)
+        app.route('/jobs/<job_id>', method='GET', callback=self._get_job)
+        app.route('/jobs/<job_id>/wait', method='GET', callback=self._wait_for_job)
+
+        app.route('/drain', method='GET', callback=self._get_drain)
+        app.route('/drain', method='PUT', callback=self._put_drain)
 
         app.route('/stats/memory_usage', method='GET', callback=self._memory_usage)
+        app.route('/stats/server', method='GET', callback=self._server_stats)
 
         return app
 
@@ -120,25 +153,99 @@ class RESTfulServer(object):
 
         return '%s://%s%s/%s' % (parts.scheme, parts.netloc, '/agents', agent)
 
+    def _job_uri(self, job_id):
+        parts = request.urlparts
+
+        return '%s://%s%s/%s' % (parts.scheme, parts.netloc, '/jobs', job_id)
+
+    def _job_to_json(self, job):
+        job_json = job.to_json()
+        job_json['uri'] = self._job_uri(job.id)
+        return job_json
+
+    def _agent_status(self, name):
+        status = self._provider.status(name)
+        self._agent_snapshot.record(name, status['state'])
+        return status
+
     def _agent_to_json(self, agent):
         uri = self._agent_uri(agent)
-        state = self._provider.status(agent)['state']
+        state = self._agent_status(agent)['state']
 
         return {'name': agent, 'uri': uri, 'state': state}
 
-    def _user_with_agent_to_json(self, user):
-        uri = self._agent_uri(user)
-        state = self._provider.status(user)['state']
-
-        return {'name': user, 'uri': uri, 'state': state}
+    def _is_not_modified(self, etag):
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        return any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
 
     def _list_agents(self):
-        users = self._users.list()
-        json = []
-        for user in users:
-            json.append(self._user_with_agent_to_json(user))
-
-        return {"agents": json}
+        try:
+            limit = self._page_size_param()
+        except ValueError as error:
+            response.status = '400 Bad Request - %s' % error.message
+            return
+
+        names = self._agent_snapshot.sorted_names(self._users.list())
+        agents, next_cursor, version = self._select_agents(names, request.query.get('state'), request.query.get('prefix'), request.query.get('cursor'), limit)
+
+        etag = self._agent_snapshot.etag(version)
+        response.headers['ETag'] = etag
+        if self._is_not_modified(etag):
+            response.status = 304
+            return ''
+
+        response.content_type = 'application/json'
+        return self._encode_agent_list(agents, next_cursor, self._agent_uri(''))
+
+    def _page_size_param(self):
+        limit = request.query.get('limit')
+        if limit is None:
+            return None
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and %d' % MAX_PAGE_SIZE)
+        return int(limit)
+
+    def _select_agents(self, names, state_filter, prefix, cursor, limit):
+        """ Returns the agents of one page, the cursor for the next page and the snapshot version.
+
+            Names are sorted, only the agents looked at for the page get refreshed.
+        """
+        start = bisect_right(names, cursor) if cursor else 0
+        if prefix:
+            start = max(start, bisect_left(names, prefix))
+
+        selected = []
+        version = self._agent_snapshot.version
+        while start < len(names):
+            wanted = len(names) - start if limit is None else limit + 1 - len(selected)
+            batch = names[start:start + wanted]
+            if prefix:
+                batch = list(takewhile(lambda name: name.startswith(prefix), batch))  # sorted, so no further matches
+            start += len(batch)
+            version, states = self._agent_snapshot.refresh(batch)
+            for name, state in states:
+                if state_filter and state != state_filter:
+                    continue
+                if limit is not None and len(selected) == limit:
+                    return selected, selected[-1][0], version
+                selected.append((name, state))
+            if len(batch) < wanted:
+                break
+
+        return selected, None, version
+
+    def _encode_agent_list(self, agents, next_cursor, uri_prefix):
+        yield '{"agents": ['
+        separator = ''
+        for name, state in agents:
+            yield separator + json.dumps({'name': name, 'uri': uri_prefix + name, 'state': state})
+            separator = ', '
+        yield ']'
+        if next_cursor:
+            yield ', "next": %s' % json.dumps(next_cursor)
+        yield '}'
 
     def _add_agent(self):
         name = request.json['name']
@@ -146,6 +253,7 @@ class RESTfulServer(object):
         try:
             self._users.add(name)
             self._authenticator.add_credentials(name, password)
+            self._agent_snapshot.invalidate(name)
             logger.info('Added agent for user %s' % name)
             response.status = '201 Created'
             response.headers['Location'] = self._agent_uri(name)
@@ -156,7 +264,7 @@ class RESTfulServer(object):
 
     def _get_agent(self, name):
         try:
-            self._provider.status(name)
+            self._agent_status(name)
             return self._agent_to_json(name)
         except InstanceNotFoundError as error:
                 logger.warn(error.message)
@@ -167,7 +275,7 @@ class RESTfulServer(object):
 
     def _get_agent_state(self, name):
         try:
-            state = self._provider.status(name)['state']
+            state = self._agent_status(name)['state']
             return {'state': state}
         except InstanceNotFoundError as error:
                 logger.warn(error.message)
@@ -176,37 +284,91 @@ class RESTfulServer(object):
     def _put_agent_state(self, name):
         state = request.json['state']
 
-        if state == 'running':
-            try:
-                user_cfg = self._users.config(name)
-                self._provider.start(user_cfg)
-                logger.info('Started agent for user %s' % name)
-                return self._get_agent_state(name)
-            except UserNotExistError as error:
-                logger.warn(error.message)
-                response.status = '404 Not Found - %s' % error.message
-            except InstanceAlreadyRunningError as error:
-                logger.warn(error.message)
-                response.status = '409 Conflict - %s' % error.message
+        if state == 'running' and self._reject_while_draining():
+            return
+
+        try:
+            job = self._submit_lifecycle_job(name, 'start' if state == 'running' else 'stop')
+        except UserNotExistError as error:
+            logger.warn(error.message)
+            response.status = '404 Not Found - %s' % error.message
+            return
+        except (InstanceAlreadyRunningError, InstanceNotRunningError, JobInProgressError) as error:
+            logger.warn(error.message)
+            response.status = '409 Conflict - %s' % error.message
+            return
+
+        logger.info('Scheduled %s of agent for user %s' % (job.action, name))
+        response.status = '202 Accepted'
+        response.headers['Location'] = self._job_uri(job.id)
+        return {'state': self._provider.status(name)['state'], 'job': self._job_to_json(job)}  # not recorded, the job may have finished already
+
+    def _submit_lifecycle_job(self, name, action):
+        """Schedules start, stop or reset_data of an agent as a job"""
+        state = self._provider.status(name)['state']
+        if action == 'start':
+            user_cfg = self._users.config(name)
+            if state == 'running':
+                raise InstanceAlreadyRunningError('instance %s already running' % name)
+            job = self._jobs.submit(name, 'start', 'starting', lambda: self._provider.start(user_cfg))
+        elif action == 'stop':
+            if state == 'stopped':
+                raise InstanceNotRunningError('No running instance named %s' % name)
+            job = self._jobs.submit(name, 'stop', 'stopping', lambda: self._provider.stop(name))
         else:
+            user_cfg = self._users.config(name)
+            if state == 'running':
+                raise InstanceAlreadyRunningError('Agent %s is running, stop it before resetting data' % name)
+            job = self._jobs.submit(name, 'reset_data', 'resetting', lambda: self._provider.reset_data(user_cfg))
+        self._agent_snapshot.invalidate(name)
+        return job
+
+    def _get_job(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            response.status = '404 Not Found - No job with id %s' % job_id
+            return
+        return self._job_to_json(job)
+
+    def _wait_for_job(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            response.status = '404 Not Found - No job with id %s' % job_id
+            return
+
+        try:
+            timeout = min(float(request.query.get('timeout', DEFAULT_JOB_WAIT_IN_S)), MAX_JOB_WAIT_IN_S)
+        except ValueError:
+            response.status = '400 Bad Request - timeout must be a number'
+            return
+
+        if self._job_waiters and self._job_waiters.acquire(False):
             try:
-                self._provider.stop(name)
-                logger.info('Stopped agent for user %s' % name)
-                return self._get_agent_state(name)
-            except InstanceNotRunningError as error:
-                logger.warn(error.message)
-                response.status = '409 Conflict - %s' % error.message
+                job.wait(timeout)
+            finally:
+                self._job_waiters.release()
+        # else enough workers wait already, answer right away so the others stay free for the rest of the api
+        if not job.done:
+            response.status = '202 Accepted'
+        return self._job_to_json(job)
 
     def _get_agent_runtime(self, name):
         try:
-            return self._provider.status(name)
+            self._activity.touch(name)
+            return self._agent_status(name)
         except InstanceNotFoundError as error:
             logger.warn(error.message)
             response.status = '404 Not Found - %s' % error.message
 
     def _authenticate_agent(self, name):
         password = request.json['password']
-        result = self._authenticator.authenticate(name, password)
+        try:
+            result = self._authenticator.authenticate(name, password)
+        except HashingBusyError as error:
+            logger.warn('Rejected login of user %s: %s' % (name, error.message))
+            response.status = '503 Service Unavailable - Too many logins'
+            response.headers['Retry-After'] = '1'
+            return {}
         if result:
             self._provider.pass_credentials_to_agent(self._users.config(name), password)
             response.status = '200 Ok'
@@ -219,6 +381,7 @@ class RESTfulServer(object):
     def _reset_agent_data(self, name):
         try:
             user_config = self._users.config(name)
+            self._agent_snapshot.invalidate(name)
             self._provider.reset_data(user_config)
             return self._get_agent_state(name)
         except UserNotExistError as error:
@@ -228,12 +391,166 @@ class RESTfulServer(object):
             logger.warn(error.message)
             response.status = '409 Conflict - %s' % error.message
 
+    def _submit_migration(self, name, host):
+        user_cfg = self._users.config(name)
+        if self._provider.status(name)['state'] != 'running':
+            raise InstanceNotRunningError('No running instance named %s' % name)
+        job = self._jobs.submit(name, 'migrate', None, lambda: self._provider.migrate(user_cfg, host))  # the agent serves requests during the first sync
+        self._agent_snapshot.invalidate(name)
+        logger.info('Scheduled migration of agent for user %s to %s' % (name, host))
+        return job
+
+    def _migrate_agent(self, name):
+        if not self._provider.supports_migration:
+            response.status = '501 Not Implemented - Provider cannot migrate agents'
+            return
+        host = (request.json or {}).get('host')
+        if not host:
+            response.status = '400 Bad Request - host is required'
+            return
+        if not (request.json.get('force') or self._activity.is_idle(name)):
+            response.status = '409 Conflict - Agent %s is in use' % name
+            return
+
+        try:
+            job = self._submit_migration(name, host)
+        except UserNotExistError as error:
+            logger.warn(error.message)
+            response.status = '404 Not Found - %s' % error.message
+            return
+        except (InstanceNotRunningError, JobInProgressError) as error:
+            logger.warn(error.message)
+            response.status = '409 Conflict - %s' % error.message
+            return
+
+        response.status = '202 Accepted'
+        response.headers['Location'] = self._job_uri(job.id)
+        return {'state': 'running', 'job': self._job_to_json(job)}
+
+    def _watermark_param(self, params):
+        watermark = float(params.get('watermark', DEFAULT_MEMORY_WATERMARK))
+        if not 0 < watermark <= 1:
+            raise ValueError('watermark must be between 0 and 1')
+        return watermark
+
+    def _rebalance_plan(self):
+        if not self._provider.supports_migration:
+            response.status = '501 Not Implemented - Provider cannot migrate agents'
+            return
+        try:
+            watermark = self._watermark_param(request.query)
+        except ValueError:
+            response.status = '400 Bad Request - watermark must be a number between 0 and 1'
+            return
+
+        return {'moves': self._provider.rebalance_plan(self._activity.is_idle, watermark)}
+
+    def _rebalance(self):
+        if not self._provider.supports_migration:
+            response.status = '501 Not Implemented - Provider cannot migrate agents'
+            return
+        try:
+            watermark = self._watermark_param(request.json or {})
+        except ValueError:
+            response.status = '400 Bad Request - watermark must be a number between 0 and 1'
+            return
+
+        moves = self._provider.rebalance_plan(self._activity.is_idle, watermark)
+        for move in moves:
+            try:
+                move['job'] = self._job_to_json(self._submit_migration(move['agent'], move['target']))
+            except (UserNotExistError, InstanceNotRunningError, JobInProgressError) as error:
+                move['error'] = str(error)
+
+        logger.info('Scheduled %d agent migrations to rebalance docker hosts' % len([move for move in moves if 'job' in move]))
+        response.status = '202 Accepted'
+        return {'moves': moves}
+
+    def _batch_error_status(self, name, error):
+        if isinstance(error, (UserNotExistError, InstanceNotFoundError)):
+            return 404
+        elif isinstance(error, (InstanceAlreadyRunningError, InstanceNotRunningError, JobInProgressError)):
+            return 409
+        elif isinstance(error, ProviderInitializingException):
+            return 503
+        else:
+            logger.error('Batch operation for agent %s failed: %s' % (name, error))
+            return 500
+
+    def _run_batch(self):
+        """Schedules a job per agent, like single agent requests do. The job workers bound the parallelism"""
+        payload = request.json or {}
+        names = payload.get('agents')
+        action = payload.get('action')
+        if not isinstance(names, list) or not names or not all(isinstance(name, basestring) for name in names):
+            response.status = '400 Bad Request - agents must be a non-empty list of names'
+            return
+        if action not in BATCH_ACTIONS:
+            response.status = '400 Bad Request - Unknown action %s' % action
+            return
+        if action == 'start' and self._reject_while_draining():
+            return
+
+        results = []
+        for name in names:
+            try:
+                job = self._submit_lifecycle_job(name, action)
+                results.append({'name': name, 'status': 202, 'job': self._job_to_json(job)})
+            except Exception, error:
+                results.append({'name': name, 'status': self._batch_error_status(name, error), 'message': str(error)})
+
+        logger.info('Scheduled %s for %d agents' % (action, len(names)))
+        response.status = '202 Accepted'
+        return {'results': results}
+
+    def _reject_while_draining(self):
+        if self._drain.draining:
+            response.status = '503 Service Unavailable - Manager is draining'
+            response.headers['Retry-After'] = '60'
+            return True
+        return False
+
+    def _get_drain(self):
+        return self._drain.status()
+
+    def _put_drain(self):
+        payload = request.json or {}
+        if payload.get('draining', True):
+            try:
+                grace_period = float(payload.get('grace_period', DEFAULT_GRACE_PERIOD_IN_S))
+            except (TypeError, ValueError):
+                response.status = '400 Bad Request - grace_period must be a number'
+                return
+            self._drain.begin(grace_period)
+            response.status = '202 Accepted'
+        else:
+            self._drain.cancel()
+        return self._drain.status()
+
     def _memory_usage(self):
         return self._provider.memory_usage()
 
+    def _server_stats(self):
+        stats = self._server_adapter.stats() if isinstance(self._server_adapter, ThreadPoolWSGIServerAdapter) else None
+        stats = dict(stats or {'workers': 0})
+        hashing = self._authenticator.hashing_stats()
+        if hashing:
+            stats['password_hashing'] = hashing
+        return stats
+
     def serve_forever(self):
         app = self.init_bottle_app()
-        if self._ssl_config:
+        self._drain.resume()
+        if self._workers and self._ssl_config:
+            server_adapter = ThreadPoolWSGIServerAdapter(host=self._bindaddr, port=self._port, workers=self._workers,
+                                                         ssl_version=self._ssl_config.ssl_version,
+                                                         ssl_cert_file=self._ssl_config.ssl_certfile,
+                                                         ssl_key_file=self._ssl_config.ssl_keyfile,
+                                                         ssl_ca_certs=self._ssl_config.ssl_ca_certs,
+                                                         ssl_ciphers=self._ssl_config.ssl_ciphers)
+        elif self._workers:
+            server_adapter = ThreadPoolWSGIServerAdapter(host='localhost', port=self._port, workers=self._workers)
+        elif self._ssl_config:
             server_adapter = SSLWSGIRefServerAdapter(host=self._bindaddr, port=self._port,
                                                      ssl_version=self._ssl_config.ssl_version,
                                                      ssl_cert_file=self._ssl_config.ssl_certfile,
@@ -258,12 +575,16 @@ class RESTfulServer(object):
         if self._server_adapter:
             self._server_adapter.shutdown()
             self._server_adapter = None
+        self._drain.shutdown()
+        self._jobs.shutdown()
 
 
 class DispatcherManager(object):
-    __slots__ = ('_root_path', '_mailpile_bin', '_mailpile_virtualenv', '_ssl_config', '_server', '_provider', '_bindaddr', '_leap_provider_hostname', '_leap_provider_ca', '_leap_provider_fingerprint')
+    __slots__ = ('_root_path', '_mailpile_bin', '_mailpile_virtualenv', '_ssl_config', '_server', '_provider', '_bindaddr', '_leap_provider_hostname', '_leap_provider_ca', '_leap_provider_fingerprint', '_workers', '_docker_hosts', '_sync_data', '_leader_election', '_leader_lock', '_agent_socket_dir', '_hash_workers', '_max_pending_hashes', '_hashing_pool')
 
-    def __init__(self, root_path, mailpile_bin, ssl_config, leap_provider_hostname, leap_provider_ca, leap_provider_fingerprint=None, mailpile_virtualenv=None, provider='fork', bindaddr='127.0.0.1'):
+    def __init__(self, root_path, mailpile_bin, ssl_config, leap_provider_hostname, leap_provider_ca, leap_provider_fingerprint=None, mailpile_virtualenv=None, provider='fork', bindaddr='127.0.0.1', workers=DEFAULT_WORKERS, docker_hosts=None, sync_data=False, leader_election=False, agent_socket_dir=None,
+                 hash_workers=DEFAULT_HASH_WORKERS, max_pending_hashes=DEFAULT_MAX_PENDING_HASHES):
+        """Passwords get hashed by hash_workers threads, 0 hashes them on the REST api threads"""
         self._root_path = root_path
         self._mailpile_bin = mailpile_bin
         self._mailpile_virtualenv = mailpile_virtualenv
@@ -274,18 +595,36 @@ class DispatcherManager(object):
         self._leap_provider_hostname = leap_provider_hostname
         self._leap_provider_ca = leap_provider_ca
         self._leap_provider_fingerprint = leap_provider_fingerprint
+        self._workers = workers
+        self._docker_hosts = docker_hosts or []
+        self._sync_data = sync_data
+        self._leader_election = leader_election
+        self._leader_lock = None
+        self._agent_socket_dir = agent_socket_dir
+        self._hash_workers = hash_workers
+        self._max_pending_hashes = max_pending_hashes
+        self._hashing_pool = None
 
     def serve_forever(self):
         try:
+            if self._leader_election:
+                if self._provider != 'docker':
+                    logger.warn('Agents of the %s backend do not survive a failover' % self._provider)
+                self._leader_lock = LeaderLock(join(self._root_path, LEADER_LOCK_FILE))
+                self._leader_lock.acquire()  # standby until the active manager is gone
+
             provider = self._download_api_ca_bundle()
             users = Users(self._root_path)
-            authenticator = Authenticator(users, provider)
+            if self._hash_workers:
+                self._hashing_pool = PasswordHashingPool(self._hash_workers, self._max_pending_hashes)
+            authenticator = Authenticator(users, provider, hashing_pool=self._hashing_pool)
             provider = self._create_provider()
 
             Thread(target=provider.initialize).start()
 
             logger.info('Starting REST api')
-            self._server = RESTfulServer(self._ssl_config, users, authenticator, provider, bindaddr=self._bindaddr, port=DEFAULT_PORT)
+            state_store = StateStore(join(self._root_path, STATE_FILE))
+            self._server = RESTfulServer(self._ssl_config, users, authenticator, provider, bindaddr=self._bindaddr, port=DEFAULT_PORT, workers=self._workers, state_store=state_store)
             if self._ssl_config:
                 logger.info('Using SSL certfile %s and keyfile %s' % (self._ssl_config.ssl_certfile, self._ssl_config.ssl_keyfile))
             else:
@@ -301,6 +640,12 @@ class DispatcherManager(object):
             self._server.shutdown()
             self._server = None
             logger.info('Stopped server')
+        if self._leader_lock:
+            self._leader_lock.release()
+            self._leader_lock = None
+        if self._hashing_pool:
+            self._hashing_pool.shutdown()
+            self._hashing_pool = None
 
     def _download_api_ca_bundle(self):
         cfg = LeapConfig(leap_home=self._root_path, ca_cert_bundle=self._leap_provider_ca, assert_fingerprint=self._leap_provider_fingerprint)
@@ -314,9 +659,18 @@ class DispatcherManager(object):
 
     def _create_provider(self):
         if self._provider == 'docker':
-            docker_host = os.environ['DOCKER_HOST'] if os.environ.get('DOCKER_HOST') else None
             adapter = PixelatedDockerAdapter(self._leap_provider_hostname)
-            return DockerProvider(adapter, self._leap_provider_hostname, LeapProviderX509Info(ca_bundle=self._leap_provider_ca, fingerprint=self._leap_provider_fingerprint), docker_host)
+            leap_provider_x509 = LeapProviderX509Info(ca_bundle=self._leap_provider_ca, fingerprint=self._leap_provider_fingerprint)
+            if len(self._docker_hosts) > 1:
+                if self._agent_socket_dir:
+                    raise ValueError('Agent sockets are only reachable on the docker host, they do not work with several docker hosts')
+                data_sync = RsyncDataSync() if self._sync_data else None
+                return MultiHostDockerProvider(adapter, self._leap_provider_hostname, leap_provider_x509, self._docker_hosts, data_sync=data_sync)
+            elif self._docker_hosts:
+                docker_url, bind_address = self._docker_hosts[0]
+                return DockerProvider(adapter, self._leap_provider_hostname, leap_provider_x509, docker_url, bind_address=bind_address, agent_socket_dir=self._agent_socket_dir)
+            docker_host = os.environ['DOCKER_HOST'] if os.environ.get('DOCKER_HOST') else None
+            return DockerProvider(adapter, self._leap_provider_hostname, leap_provider_x509, docker_host, agent_socket_dir=self._agent_socket_dir)
         else:
             adapter = MailpileAdapter(self._mailpile_bin, mailpile_virtualenv=self._mailpile_virtualenv)
             runner = ForkRunner(self._root_path, adapter)
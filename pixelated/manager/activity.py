@@ -0,0 +1,60 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+from threading import Lock
+
+DEFAULT_IDLE_TIMEOUT_IN_S = 15 * 60
+PERSIST_INTERVAL_IN_S = 60
+
+
+class AgentActivity(object):
+    """ Remembers when an agent was used last.
+
+        The proxy asks for the agent runtime on every request it forwards, so the
+        manager counts these calls as activity of the user. With a state store the
+        activity gets persisted at most once per persist interval, so a manager taking
+        over does not mistake agents in use for idle ones.
+    """
+
+    __slots__ = ('_last_seen', '_lock', '_idle_timeout', '_store', '_persist_interval', '_persisted_at')
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT_IN_S, store=None, persist_interval=PERSIST_INTERVAL_IN_S):
+        self._lock = Lock()
+        self._idle_timeout = idle_timeout
+        self._store = store
+        self._persist_interval = persist_interval
+        self._persisted_at = time.time()
+        self._last_seen = dict(store.get('activity', {})) if store else {}
+
+    def touch(self, name):
+        now = time.time()
+        with self._lock:
+            self._last_seen[name] = now
+            if self._store is None or now - self._persisted_at < self._persist_interval:
+                return
+            self._persisted_at = now
+            snapshot = dict(self._last_seen)
+        self._store.set('activity', snapshot)
+
+    def idle_for(self, name):
+        """Returns the seconds since the agent was used last or None if it was not used since the manager started"""
+        with self._lock:
+            last_seen = self._last_seen.get(name)
+        return None if last_seen is None else time.time() - last_seen
+
+    def is_idle(self, name):
+        idle_for = self.idle_for(name)
+        return idle_for is None or idle_for >= self._idle_timeout
@@ -0,0 +1,112 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+import uuid
+from threading import Lock
+
+DEFAULT_MAX_AGE_IN_S = 30
+
+
+class AgentStateSnapshot(object):
+    """ Versioned cache of agent states as served by the agent listing.
+
+        Only entries that got invalidated by a state change, that are unknown
+        or that are older than max_age get fetched from the provider again.
+        The agent names are kept sorted and only sorted again when agents got
+        added or removed, so a page can be refreshed on its own. The version is bumped whenever the content of the snapshot changes and
+        can therefore be used as an ETag.
+    """
+
+    __slots__ = ('_provider', '_max_age', '_states', '_dirty', '_names', '_names_source', '_names_count', '_version', '_epoch', '_lock')
+
+    def __init__(self, provider, max_age=DEFAULT_MAX_AGE_IN_S):
+        self._provider = provider
+        self._max_age = max_age
+        self._states = {}
+        self._dirty = set()
+        self._names = []
+        self._names_source = None
+        self._names_count = 0
+        self._version = 0
+        self._epoch = uuid.uuid4().hex[:8]  # versions of different manager runs must not collide
+        self._lock = Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def etag(self, version=None):
+        return '"%s-%d"' % (self._epoch, self._version if version is None else version)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._dirty.add(name)
+
+    def invalidate_all(self):
+        with self._lock:
+            self._dirty.update(self._states.keys())
+
+    def record(self, name, state):
+        """Remembers a state that got fetched from the provider anyway"""
+        with self._lock:
+            self._update(name, state, time.time())
+
+    def sorted_names(self, names):
+        """Returns the names sorted. They only get sorted again if names is another list or changed its length"""
+        with self._lock:
+            if names is not self._names_source or len(names) != self._names_count:
+                self._index(names)
+            return self._names
+
+    def _index(self, names):
+        sorted_names = sorted(names)
+        if sorted_names != self._names:
+            self._version += 1
+        known = set(sorted_names)
+        for name in [name for name in self._states if name not in known]:
+            del self._states[name]
+            self._dirty.discard(name)
+        self._names, self._names_source, self._names_count = sorted_names, names, len(names)
+
+    def refresh(self, names):
+        """Brings the snapshot up to date for the given agents, e.g. the ones of a page.
+
+        Returns a tuple of the snapshot version and the list of (name, state) pairs.
+        The provider gets asked without holding the lock, so listings do not wait for each other.
+        """
+        with self._lock:
+            now = time.time()
+            stale = [name for name in names if self._is_stale(name, now)]
+            self._dirty.difference_update(stale)  # marked again if invalidated while fetching
+
+        fetched = [(name, self._provider.status(name)['state']) for name in stale]
+
+        with self._lock:
+            for name, state in fetched:
+                self._update(name, state, now, keep_dirty=True)
+            return self._version, [(name, self._states[name][0]) for name in names if name in self._states]
+
+    def _is_stale(self, name, now):
+        entry = self._states.get(name)
+        return entry is None or name in self._dirty or now - entry[1] > self._max_age
+
+    def _update(self, name, state, timestamp, keep_dirty=False):
+        entry = self._states.get(name)
+        if entry is None or entry[0] != state:
+            self._version += 1
+        self._states[name] = (state, timestamp)
+        if not keep_dirty:
+            self._dirty.discard(name)
@@ -16,9 +16,22 @@
 import SocketServer
 import socket
 import ssl
+import threading
+from Queue import Queue, Full
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
 
 from bottle import ServerAdapter
 
+from pixelated.common import logger
+
+SSL_SHUTDOWN_TIMEOUT_IN_S = 1
+SSL_HANDSHAKE_TIMEOUT_IN_S = 10
+DEFAULT_WORKERS = 16
+DEFAULT_QUEUE_SIZE = 128
+KEEP_ALIVE_TIMEOUT_IN_S = 2
+REQUEST_IO_TIMEOUT_IN_S = 60
+MAX_REQUEST_LINE_LENGTH = 65536
+
 
 class SSLTCPServer(SocketServer.TCPServer):
     def __init__(self, server_address, request_handler_class, bind_and_activate=True, ssl_key_file=None,
@@ -31,13 +44,51 @@ class SSLTCPServer(SocketServer.TCPServer):
         else:
             cert_reqs = ssl.CERT_NONE
 
-        self.socket = ssl.wrap_socket(self.socket, keyfile=ssl_key_file, certfile=ssl_cert_file, ciphers=ssl_ciphers,
-                                      ssl_version=ssl_version, server_side=True, ca_certs=ca_certs, cert_reqs=cert_reqs)
+        if hasattr(ssl, 'SSLContext'):
+            # one context for all connections, so its session cache allows clients to resume TLS sessions
+            self.ssl_context = ssl.SSLContext(ssl_version)
+            self.ssl_context.load_cert_chain(ssl_cert_file, ssl_key_file)
+            if ssl_ciphers:
+                self.ssl_context.set_ciphers(ssl_ciphers)
+            if ca_certs is not None:
+                self.ssl_context.load_verify_locations(ca_certs)
+            self.ssl_context.verify_mode = cert_reqs
+        else:
+            self.ssl_context = None
+            self.socket = ssl.wrap_socket(self.socket, keyfile=ssl_key_file, certfile=ssl_cert_file, ciphers=ssl_ciphers,
+                                          ssl_version=ssl_version, server_side=True, ca_certs=ca_certs, cert_reqs=cert_reqs)
 
         if bind_and_activate:
             self.server_bind()
             self.server_activate()
 
+    def get_request(self):
+        sock, client_address = self.socket.accept()
+        if self.ssl_context:
+            # the handshake happens in finish_request, i.e. in the worker thread and not in the accept loop
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, client_address
+
+    def finish_request(self, request, client_address):
+        if self.ssl_context:
+            try:
+                request.settimeout(SSL_HANDSHAKE_TIMEOUT_IN_S)
+                request.do_handshake()
+                request.settimeout(None)
+            except (ssl.SSLError, socket.error), e:
+                logger.warn('TLS handshake with %s failed: %s' % (client_address[0], e))
+                return
+        SocketServer.TCPServer.finish_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        try:
+            # send close_notify, otherwise clients cannot tell the end of a streamed response from a truncated one
+            request.settimeout(SSL_SHUTDOWN_TIMEOUT_IN_S)
+            request.unwrap()
+        except (ssl.SSLError, socket.error, ValueError):  # ValueError if the connection got shut down already
+            pass
+        SocketServer.TCPServer.shutdown_request(self, request)
+
 
 class SSLHTTPServer(SSLTCPServer):
     allow_reuse_address = 1  # Seems to make sense in testing environment
@@ -118,3 +169,267 @@ class SSLWSGIRefServerAdapter(ServerAdapter):
         if self._server:
             self._server.shutdown()
             self._server = None
+
+
+class ThreadPoolMixIn:
+    """Mix-in class to handle each connection with a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue; if the queue is full the connection is dropped.
+    """
+
+    workers = DEFAULT_WORKERS
+    queue_size = DEFAULT_QUEUE_SIZE
+
+    def start_workers(self):
+        self._connections = Queue(self.queue_size)
+        self._stats_lock = threading.Lock()
+        self._active_connections = set()
+        self._active_requests = 0
+        self._max_queue_depth = 0
+        self._handled = 0
+        self._rejected = 0
+        self._worker_threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._process_connections, name='manager-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self._worker_threads.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put_nowait((request, client_address))
+        except Full:
+            logger.warn('Request queue full, dropping connection from %s' % client_address[0])
+            with self._stats_lock:
+                self._rejected += 1
+            self.shutdown_request(request)
+            return
+
+        with self._stats_lock:
+            self._max_queue_depth = max(self._max_queue_depth, self._connections.qsize())
+
+    def _process_connections(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._stats_lock:
+                self._active_connections.add(request)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._stats_lock:
+                    self._active_connections.discard(request)
+                    self._handled += 1
+                self.shutdown_request(request)
+
+    def connections_waiting(self):
+        return not self._connections.empty()
+
+    def request_started(self):
+        with self._stats_lock:
+            self._active_requests += 1
+
+    def request_finished(self):
+        with self._stats_lock:
+            self._active_requests -= 1
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        with self._stats_lock:
+            connections = list(self._active_connections)
+        for request in connections:  # wake up workers waiting on idle keep-alive connections
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for _ in self._worker_threads:
+            self._connections.put(None)
+        for t in self._worker_threads:
+            t.join(SSL_SHUTDOWN_TIMEOUT_IN_S)
+        self._worker_threads = []
+
+    def stats(self):
+        with self._stats_lock:
+            return {'workers': self.workers,
+                    'active_connections': len(self._active_connections),
+                    'active_requests': self._active_requests,
+                    'queue_size': self.queue_size,
+                    'queue_depth': self._connections.qsize(),
+                    'max_queue_depth': self._max_queue_depth,
+                    'connections_handled': self._handled,
+                    'connections_rejected': self._rejected}
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    allow_reuse_address = 1
+
+
+class ThreadPoolSSLWSGIServer(ThreadPoolMixIn, SSLWSGIServer):
+    pass
+
+
+class RequestBody(object):
+    """wsgi.input that stops at the end of the request body, so the connection can be reused"""
+
+    __slots__ = ('_rfile', 'remaining')
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        return self.remaining if size is None or size < 0 else min(size, self.remaining)
+
+    def read(self, size=-1):
+        data = self._rfile.read(self._limit(size)) if self.remaining else ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._rfile.readline(self._limit(size)) if self.remaining else ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining and self.read(8192):
+            pass
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:  # without length the end of the response is the end of the connection
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class KeepAliveWSGIRequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler that serves several HTTP/1.1 requests on one connection"""
+
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_IO_TIMEOUT_IN_S  # for reading and writing a request, waiting for the next one uses KEEP_ALIVE_TIMEOUT_IN_S
+    wbufsize = -1  # send status line, headers and body in one go
+    disable_nagle_algorithm = True  # otherwise small responses on a reused connection wait for delayed acks
+    quiet = False
+
+    def address_string(self):  # Prevent reverse DNS lookups please.
+        return self.client_address[0]
+
+    def log_request(self, *args, **kw):
+        if not self.quiet:
+            return WSGIRequestHandler.log_request(self, *args, **kw)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.connection.settimeout(KEEP_ALIVE_TIMEOUT_IN_S)  # idle connections must not block a worker for long
+        try:
+            self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE_LENGTH + 1)
+        except (socket.timeout, ssl.SSLError, socket.error):
+            self.close_connection = 1
+            return
+        self.connection.settimeout(self.timeout)  # slow clients may take longer for the rest of the request
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > MAX_REQUEST_LINE_LENGTH:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+
+        if not self.parse_request():  # An error code has been sent, just exit
+            self.close_connection = 1
+            return
+
+        if self.headers.getheader('transfer-encoding'):
+            self.close_connection = 1  # chunked request bodies are not tracked
+            body = self.rfile
+        else:
+            body = RequestBody(self.rfile, int(self.headers.getheader('content-length') or 0))
+
+        if self.server.connections_waiting():
+            self.close_connection = 1  # give the worker to the next connection instead of waiting for this one
+
+        handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self      # backpointer for logging
+        self.server.request_started()
+        try:
+            handler.run(self.server.get_app())
+        finally:
+            self.server.request_finished()
+
+        if not self.close_connection:
+            body.drain()
+            self.wfile.flush()
+
+
+class ThreadPoolWSGIServerAdapter(ServerAdapter):
+    """Serves the app with a pool of worker threads, HTTP keep-alive and optional TLS.
+
+    Without ssl_cert_file the server speaks plain HTTP.
+    """
+
+    __slots__ = '_server'
+
+    _server = None
+
+    def run(self, app):  # pragma: no cover
+        server_cls = self.options.get('server_class')
+        if server_cls is None:
+            server_cls = ThreadPoolSSLWSGIServer if self.options.get('ssl_cert_file') else ThreadPoolWSGIServer
+
+        if ':' in self.host:  # Fix wsgiref for IPv6 addresses.
+            if getattr(server_cls, 'address_family') == socket.AF_INET:
+                class server_cls(server_cls):
+                    address_family = socket.AF_INET6
+
+        class handler_cls(self.options.get('handler_class', KeepAliveWSGIRequestHandler)):
+            quiet = self.quiet
+        if issubclass(server_cls, SSLTCPServer):
+            srv = server_cls((self.host, self.port), handler_cls,
+                             ssl_cert_file=self.options.get('ssl_cert_file'),
+                             ssl_key_file=self.options.get('ssl_key_file'),
+                             ssl_version=self.options.get('ssl_version', ssl.PROTOCOL_TLSv1),
+                             ca_certs=self.options.get('ssl_ca_certs', None),
+                             ssl_ciphers=self.options.get('ssl_ciphers', None))
+        else:
+            srv = server_cls((self.host, self.port), handler_cls)
+
+        srv.workers = self.options.get('workers', DEFAULT_WORKERS)
+        srv.queue_size = self.options.get('queue_size', DEFAULT_QUEUE_SIZE)
+        srv.set_app(app)
+        srv.start_workers()
+
+        self._server = srv
+        try:
+            srv.serve_forever()
+        finally:
+            srv.server_close()
+
+    def stats(self):
+        return self._server.stats() if self._server else None
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server = None
@@ -0,0 +1,157 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+from threading import Event, Lock, Thread, current_thread
+
+from pixelated.common import logger
+from pixelated.manager.jobs import JobInProgressError
+
+DEFAULT_GRACE_PERIOD_IN_S = 10 * 60
+DEFAULT_POLL_INTERVAL_IN_S = 5
+
+
+class Drain(object):
+    """ Empties the manager for maintenance.
+
+        While draining no agents may be started. Idle agents get stopped right away,
+        agents in use once the grace period is over. With a state store the drain survives
+        a manager restart or failover and gets resumed by the next active manager.
+    """
+
+    OFF = 'off'
+    DRAINING = 'draining'
+    DRAINED = 'drained'
+
+    __slots__ = ('_provider', '_jobs', '_is_idle', '_poll_interval', '_lock', '_state', '_started', '_grace_period', '_initial_agents', '_wakeup', '_thread', '_store')
+
+    def __init__(self, provider, jobs, is_idle, poll_interval=DEFAULT_POLL_INTERVAL_IN_S, store=None):
+        self._provider = provider
+        self._jobs = jobs
+        self._is_idle = is_idle
+        self._poll_interval = poll_interval
+        self._lock = Lock()
+        self._state = Drain.OFF
+        self._started = None
+        self._grace_period = None
+        self._initial_agents = 0
+        self._wakeup = Event()
+        self._thread = None
+        self._store = store
+        self._restore()
+
+    def _restore(self):
+        state = self._store.get('drain') if self._store else None
+        if state:
+            self._state = state['state']
+            self._started = state['started']
+            self._grace_period = state['grace_period']
+            self._initial_agents = state['initial_agents']
+
+    def _persist(self):
+        if self._store:
+            self._store.set('drain', {'state': self._state, 'started': self._started, 'grace_period': self._grace_period, 'initial_agents': self._initial_agents})
+
+    @property
+    def draining(self):
+        return self._state != Drain.OFF
+
+    def begin(self, grace_period=DEFAULT_GRACE_PERIOD_IN_S):
+        with self._lock:
+            if self.draining:
+                self._grace_period = grace_period  # allows to shorten the grace period of a running drain
+                self._persist()
+                self._wakeup.set()
+                return
+            self._state = Drain.DRAINING
+            self._started = time.time()
+            self._grace_period = grace_period
+            self._initial_agents = len(self._provider.list_running())
+            self._persist()
+            self._start_thread()
+        logger.info('Draining manager, %d agents running, grace period %ds' % (self._initial_agents, grace_period))
+
+    def resume(self):
+        """Continues a drain a previous manager did not finish"""
+        with self._lock:
+            if self._state != Drain.DRAINING or self._thread is not None:
+                return
+            self._start_thread()
+        logger.info('Resuming drain, %ds of grace period left' % max(0, self._started + self._grace_period - time.time()))
+
+    def _start_thread(self):
+        self._wakeup.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        with self._lock:
+            was_draining = self.draining
+            self._state = Drain.OFF
+            if was_draining:
+                self._persist()
+            self._wakeup.set()
+        logger.info('Stopped draining manager')
+
+    def _run(self):
+        while self._state == Drain.DRAINING and self._thread is current_thread():
+            try:
+                self.poll()
+            except Exception, e:
+                logger.error('Error while draining: %s' % e)
+            self._wakeup.wait(self._poll_interval)
+            self._wakeup.clear()
+
+    def poll(self):
+        """Stops the agents that may be stopped by now, marks the drain finished once no agent is left"""
+        running = self._provider.list_running()
+        with self._lock:
+            if self._state != Drain.DRAINING:
+                return
+            if not running:
+                self._state = Drain.DRAINED
+                self._persist()
+                logger.info('Manager drained')
+                return
+            grace_period_over = time.time() >= self._started + self._grace_period
+
+        for name in running:
+            if grace_period_over or self._is_idle(name):
+                try:
+                    self._jobs.submit(name, 'stop', 'stopping', lambda name=name: self._provider.stop(name))
+                except JobInProgressError:
+                    pass  # still stopping or busy otherwise, check again on next poll
+
+    def status(self):
+        status = {'state': self._state}
+        if self.draining:
+            running = len(self._provider.list_running())
+            status.update({
+                'started': self._started,
+                'grace_period': self._grace_period,
+                'remaining_grace_period': max(0, self._started + self._grace_period - time.time()),
+                'initial_agents': self._initial_agents,
+                'running_agents': running,
+                'stopped_agents': max(0, self._initial_agents - running)})
+        return status
+
+    def shutdown(self):
+        """Stops draining in this manager but keeps the drain state for the next one"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._wakeup.set()
+        if thread:
+            thread.join()
@@ -0,0 +1,133 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+import uuid
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock
+
+from pixelated.common import logger
+
+DEFAULT_JOB_WORKERS = 8
+MAX_FINISHED_JOBS = 1000
+
+
+class JobInProgressError(Exception):
+    pass
+
+
+class Job(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    __slots__ = ('id', 'agent', 'action', 'status', 'error', 'created', 'finished', '_done')
+
+    def __init__(self, agent, action):
+        self.id = uuid.uuid4().hex
+        self.agent = agent
+        self.action = action
+        self.status = Job.PENDING
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._done = Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self.done
+
+    def _finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def to_json(self):
+        return {'id': self.id, 'agent': self.agent, 'action': self.action, 'status': self.status, 'error': self.error}
+
+
+class LifecycleJobs(object):
+    """ Runs slow agent lifecycle operations like start and stop in the background.
+
+        While a job is pending or running the provider reports the given transitional
+        state for the agent, unless it is None. Only one job per agent can be active at a time.
+    """
+
+    __slots__ = ('_provider', '_pool', '_jobs', '_active', '_lock', '_on_finish')
+
+    def __init__(self, provider, workers=DEFAULT_JOB_WORKERS, on_finish=None):
+        self._provider = provider
+        self._pool = ThreadPool(workers)
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = Lock()
+        self._on_finish = on_finish
+
+    def submit(self, agent, action, transitional_state, operation):
+        with self._lock:
+            if agent in self._active:
+                raise JobInProgressError('Agent %s is busy with %s' % (agent, self._active[agent].action))
+            job = Job(agent, action)
+            self._active[agent] = job
+            self._jobs[job.id] = job
+            if transitional_state:
+                self._provider.begin_transition(agent, transitional_state)
+            self._prune_finished_jobs()
+
+        self._pool.apply_async(self._run, (job, operation))
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def active_job(self, agent):
+        return self._active.get(agent)
+
+    def _run(self, job, operation):
+        job.status = Job.RUNNING
+        status, error = Job.FAILED, 'interrupted'
+        try:
+            try:
+                operation()
+                status, error = Job.SUCCEEDED, None
+            except Exception, e:
+                logger.warn('Job %s for agent %s failed: %s' % (job.action, job.agent, e))
+                status, error = Job.FAILED, str(e)
+            finally:
+                with self._lock:
+                    self._provider.end_transition(job.agent)
+                    del self._active[job.agent]
+
+            if self._on_finish:
+                self._on_finish(job)
+        except Exception, e:
+            logger.exception('Finishing job %s for agent %s failed: %s' % (job.action, job.agent, e))
+        finally:
+            job._finish(status, error)  # waiters must never hang
+
+    def _prune_finished_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.iteritems() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        self._pool.close()
@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import fcntl
+import json
+import os
+import time
+from os.path import exists
+from threading import Lock
+
+from pixelated.common import logger
+
+DEFAULT_LEADER_POLL_INTERVAL_IN_S = 1
+
+
+class StateStore(object):
+    """ Durable key value store for manager state that must survive a restart or failover.
+
+        Everything lives in one JSON file that gets replaced atomically on every write, so a
+        manager that dies halfway leaves the previous state behind.
+    """
+
+    __slots__ = ('_path', '_state', '_lock')
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._state = self._load()
+
+    def _load(self):
+        if not exists(self._path):
+            return {}
+        try:
+            with open(self._path) as fd:
+                return json.load(fd)
+        except ValueError, e:
+            logger.error('Ignoring corrupt manager state in %s: %s' % (self._path, e))
+            return {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._state.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._state[key] = value
+            tmp_path = '%s.tmp' % self._path
+            with open(tmp_path, 'w') as fd:
+                json.dump(self._state, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(tmp_path, self._path)
+
+
+class LeaderLock(object):
+    """ Elects the active manager of an active/standby pair sharing a root path.
+
+        The active manager holds an exclusive lock on a file. The kernel releases it as soon as
+        the process dies, so the standby polling for the lock takes over within a poll interval.
+    """
+
+    __slots__ = ('_path', '_fd')
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    @property
+    def is_leader(self):
+        return self._fd is not None
+
+    def try_acquire(self):
+        if self._fd is not None:
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, '%d\n' % os.getpid())
+        self._fd = fd
+        return True
+
+    def acquire(self, poll_interval=DEFAULT_LEADER_POLL_INTERVAL_IN_S):
+        """Blocks until this manager became the active one"""
+        if not self.try_acquire():
+            logger.info('Another manager is active, waiting as standby')
+            while not self.try_acquire():
+                time.sleep(poll_interval)
+        logger.info('Became active manager')
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
@@ -24,15 +24,26 @@ try:
 except ImportError:
     from daemon.pidlockfile import TimeoutPIDLockFile
 from pixelated.client.cli import Cli
-from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient
+from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient, parse_manager_endpoints
+from pixelated.client.sharding import ShardedDispatcherClient, load_shard_overrides
+from pixelated.proxy.compression import DEFAULT_MIN_SIZE_IN_BYTES
+from pixelated.proxy.admission import DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_REQUESTS_PER_IP, DEFAULT_HEADER_TIMEOUT_IN_S, DEFAULT_BODY_TIMEOUT_IN_S
+from pixelated.proxy.breaker import DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT_IN_S
+from pixelated.proxy.priority import DEFAULT_AGENT_CONCURRENCY
+from pixelated.proxy.static_cache import DEFAULT_CACHE_SIZE_IN_BYTES, DEFAULT_STATIC_PREFIXES
+from pixelated.proxy.tls import DEFAULT_ECDH_CURVE
 from pixelated.proxy import DispatcherProxy
 from pixelated.manager import SSLConfig, DispatcherManager
+from pixelated.manager.bottle_adapter import DEFAULT_WORKERS
+from pixelated.authenticator import DEFAULT_HASH_WORKERS, DEFAULT_MAX_PENDING_HASHES
+from pixelated.provider.docker.multi_host import parse_docker_host
 from pixelated.common import init_logging, latest_available_ssl_version
 
 import argparse
 
 
 PID_ACQUIRE_TIMEOUT_IN_S = 1
+MANAGER_REQUEST_TIMEOUT_IN_S = 5  # the proxy asks the manager on its io loop
 
 
 def is_proxy():
@@ -76,8 +87,15 @@ def run_manager():
     parser.add_argument('-m', '--mailpile_bin', help='The mailpile executable', default='mailpile')
     parser.add_argument('-b', '--backend', help='the backend to use', default='fork', choices=['fork', 'docker'])
     parser.add_argument('--bind', help="bind to interface. Default 127.0.0.1", default='127.0.0.1')
+    parser.add_argument('--docker-host', dest='docker_hosts', metavar='URL[=ADDRESS]', help='docker host to run agents on, repeat to spread agents over several hosts. ADDRESS is where the proxy reaches the agents', type=parse_docker_host, action='append', default=[])
+    parser.add_argument('--docker-sync-data', dest='sync_data', help='copy agent data with rsync over ssh when migrating agents between docker hosts that do not share storage', default=False, action='store_true')
+    parser.add_argument('--agent-socket-dir', help='expose docker agents on unix sockets in this folder instead of TCP ports; the proxy has to run on the docker host', default=None)
     parser.add_argument('--sslcert', help='The SSL certficate to use', default=None)
     parser.add_argument('--sslkey', help='The SSL key to use', default=None)
+    parser.add_argument('--standby', dest='leader_election', help='run as one of an active/standby pair sharing the root path; waits until no other manager is active', default=False, action='store_true')
+    parser.add_argument('--workers', help='Number of threads serving the REST api, 0 for a single-threaded server. Default %d' % DEFAULT_WORKERS, type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--hash-workers', help='Number of threads hashing passwords, 0 hashes them on the REST api threads. Default %d' % DEFAULT_HASH_WORKERS, type=int, default=DEFAULT_HASH_WORKERS)
+    parser.add_argument('--max-pending-logins', dest='max_pending_hashes', help='max logins waiting for password hashing, more get a 503. Default %d' % DEFAULT_MAX_PENDING_HASHES, type=int, default=DEFAULT_MAX_PENDING_HASHES)
     parser.add_argument('--debug', help='Set log level to debug', default=False, action='store_true')
     parser.add_argument('--daemon', help='start in daemon mode and put process into background', default=False, action='store_true')
     parser.add_argument('--pidfile', help='path for pid file. By default none is created', default=None)
@@ -112,7 +130,8 @@ def run_manager():
 
     provider_ca = args.leap_provider_ca if args.leap_provider_fingerprint is None else False
 
-    manager = DispatcherManager(args.root_path, mailpile_bin, ssl_config, args.leap_provider, mailpile_virtualenv=venv, provider=args.backend, leap_provider_ca=provider_ca, leap_provider_fingerprint=args.leap_provider_fingerprint, bindaddr=args.bind)
+    manager = DispatcherManager(args.root_path, mailpile_bin, ssl_config, args.leap_provider, mailpile_virtualenv=venv, provider=args.backend, leap_provider_ca=provider_ca, leap_provider_fingerprint=args.leap_provider_fingerprint, bindaddr=args.bind, workers=args.workers, docker_hosts=args.docker_hosts, sync_data=args.sync_data, leader_election=args.leader_election, agent_socket_dir=args.agent_socket_dir,
+                                hash_workers=args.hash_workers, max_pending_hashes=args.max_pending_hashes)
 
     if args.daemon:
         pidfile = TimeoutPIDLockFile(args.pidfile, acquire_timeout=PID_ACQUIRE_TIMEOUT_IN_S) if args.pidfile else None
@@ -128,7 +147,25 @@ def run_manager():
 
 def run_proxy():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-m', '--manager', help='hostname:port of the manager')
+    parser.add_argument('-m', '--manager', action='append', help='hostname:port of the manager, a comma separated list spreads load over several managers. Repeat to shard users over several managers')
+    parser.add_argument('--shard-overrides', help='JSON file mapping users to the hostname:port of the manager they got migrated to', default=None)
+    parser.add_argument('--static-cache-size', help='MB of memory for caching static agent assets shared by all users, 0 disables the cache. Default %d' % (DEFAULT_CACHE_SIZE_IN_BYTES / 1024 / 1024), type=int, default=DEFAULT_CACHE_SIZE_IN_BYTES / 1024 / 1024)
+    parser.add_argument('--static-path', dest='static_prefixes', metavar='PREFIX', help='path prefix of static agent assets to cache, repeat for several. Default %s' % ' '.join(DEFAULT_STATIC_PREFIXES), action='append', default=None)
+    parser.add_argument('--compression-threshold', help='compress responses of at least that many bytes. Default %d' % DEFAULT_MIN_SIZE_IN_BYTES, type=int, default=DEFAULT_MIN_SIZE_IN_BYTES)
+    parser.add_argument('--no-compression', dest='compression', help='do not compress responses', default=True, action='store_false')
+    parser.add_argument('--stream-path', dest='stream_prefixes', metavar='PREFIX', help='path prefix of long poll requests the agent holds open, repeat for several. Event streams are always passed through', action='append', default=[])
+    parser.add_argument('--agent-concurrency', help='max requests sent to an agent at a time, more wait in the proxy with interactive ones first. 0 means no limit. Default %d' % DEFAULT_AGENT_CONCURRENCY, type=int, default=DEFAULT_AGENT_CONCURRENCY)
+    parser.add_argument('--background-path', dest='background_patterns', metavar='REGEX', help='uri pattern of XHR requests of low priority like polls, repeat for several', action='append', default=[])
+    parser.add_argument('--circuit-failures', help='after that many agent requests in a row without answer fail the requests of the agent fast until it answers again, 0 turns that off. Default %d' % DEFAULT_FAILURE_THRESHOLD, type=int, default=DEFAULT_FAILURE_THRESHOLD)
+    parser.add_argument('--circuit-reset', help='seconds between checks if an agent without answers is back. Default %d' % DEFAULT_RESET_TIMEOUT_IN_S, type=int, default=DEFAULT_RESET_TIMEOUT_IN_S)
+    parser.add_argument('--restart-hung-agents', help='let the manager restart agents that stopped answering', default=False, action='store_true')
+    parser.add_argument('--max-connections', help='max open client connections, more get a 503. 0 means unlimited. Default %d' % DEFAULT_MAX_CONNECTIONS, type=int, default=DEFAULT_MAX_CONNECTIONS)
+    parser.add_argument('--max-requests-per-ip', help='max concurrent requests per client address, more get a 503. 0 means unlimited. Default %d' % DEFAULT_MAX_REQUESTS_PER_IP, type=int, default=DEFAULT_MAX_REQUESTS_PER_IP)
+    parser.add_argument('--header-timeout', help='seconds a client may take to send request headers or idle between requests. 0 means unlimited. Default %d' % DEFAULT_HEADER_TIMEOUT_IN_S, type=int, default=DEFAULT_HEADER_TIMEOUT_IN_S)
+    parser.add_argument('--body-timeout', help='seconds a client may take to send a request body. 0 means unlimited. Default %d' % DEFAULT_BODY_TIMEOUT_IN_S, type=int, default=DEFAULT_BODY_TIMEOUT_IN_S)
+    parser.add_argument('--ecdh-curve', help='curve for the ECDHE key exchange of TLS connections. Default %s' % DEFAULT_ECDH_CURVE, default=DEFAULT_ECDH_CURVE)
+    parser.add_argument('--no-session-tickets', dest='session_tickets', help='resume TLS sessions only from the server side session cache', default=True, action='store_false')
+    parser.add_argument('--collapse-requests', help='merge identical GETs of a user that are in flight at the same time into one agent request', default=False, action='store_true')
     parser.add_argument('--banner', help='banner file to show on login screen', default='_login_screen_message.html')
     parser.add_argument('--bind', help="interface to bind to (default: 127.0.0.1)", default='127.0.0.1')
     parser.add_argument('--sslcert', help='proxy HTTP server SSL certificate', default=None)
@@ -142,7 +179,6 @@ def run_proxy():
 
     args = parser.parse_args(args=filter_args())
 
-    manager_hostname, manager_port = args.manager.split(':')
     certfile = args.sslcert if args.sslcert else None
     keyfile = args.sslkey if args.sslcert else None
     manager_cafile = certfile if args.fingerprint is None else False
@@ -150,11 +186,31 @@ def run_proxy():
     log_level = logging.DEBUG if args.debug else logging.INFO
     log_config = args.log_config
 
-    client = PixelatedDispatcherClient(manager_hostname, manager_port, cacert=manager_cafile, fingerprint=args.fingerprint, assert_hostname=args.verify_hostname)
+    clients = {}
+    for manager in args.manager:
+        manager_endpoints = parse_manager_endpoints(manager)
+        manager_hostname, manager_port = manager_endpoints[0]
+        shard = '%s:%d' % (manager_hostname, manager_port)
+        clients[shard] = PixelatedDispatcherClient(manager_hostname, manager_port, cacert=manager_cafile, fingerprint=args.fingerprint, assert_hostname=args.verify_hostname, endpoints=manager_endpoints[1:],
+                                                    timeout=MANAGER_REQUEST_TIMEOUT_IN_S)
+
+    if len(clients) > 1 or args.shard_overrides:
+        overrides = load_shard_overrides(args.shard_overrides) if args.shard_overrides else None
+        client = ShardedDispatcherClient(clients, overrides=overrides)
+    else:
+        client = clients.values()[0]
     client.validate_connection()
 
     dispatcher = DispatcherProxy(client, bindaddr=args.bind, keyfile=keyfile,
-                                 certfile=certfile, banner=args.banner, debug=args.debug)
+                                 certfile=certfile, banner=args.banner, debug=args.debug,
+                                 static_cache_size=args.static_cache_size * 1024 * 1024, static_prefixes=args.static_prefixes or DEFAULT_STATIC_PREFIXES,
+                                 compression_min_size=args.compression_threshold if args.compression else None, stream_prefixes=args.stream_prefixes,
+                                 collapse_requests=args.collapse_requests, agent_concurrency=args.agent_concurrency,
+                                 background_patterns=args.background_patterns, circuit_failures=args.circuit_failures,
+                                 circuit_reset=args.circuit_reset, restart_hung_agents=args.restart_hung_agents,
+                                 max_connections=args.max_connections, max_requests_per_ip=args.max_requests_per_ip,
+                                 header_timeout=args.header_timeout, body_timeout=args.body_timeout,
+                                 ecdh_curve=args.ecdh_curve, session_tickets=args.session_tickets)
 
     if args.daemon:
         pidfile = TimeoutPIDLockFile(args.pidfile, acquire_timeout=PID_ACQUIRE_TIMEOUT_IN_S) if args.pidfile else None
@@ -38,6 +38,8 @@ class LeapProviderConfig(object):
 
 
 class Provider(object):  # pragma: no cover
+    supports_migration = False
+
     def initialize(self):
         pass
 
@@ -59,8 +61,20 @@ class Provider(object):  # pragma: no cover
     def status(self, name):
         pass
 
+    def begin_transition(self, name, state):
+        pass
+
+    def end_transition(self, name):
+        pass
+
     def pass_credentials_to_agent(self, user_config, password):
         pass
 
     def memory_usage(self):
         pass
+
+    def migrate(self, user_config, host):
+        pass
+
+    def rebalance_plan(self, movable, watermark):
+        pass
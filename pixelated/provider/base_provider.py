@@ -23,6 +23,8 @@ import binascii
 import scrypt
 
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+from threading import RLock
 from pixelated.common import Watchdog
 from pixelated.provider import Provider, NotEnoughFreeMemory
 from pixelated.exceptions import InstanceNotFoundError
@@ -33,6 +35,8 @@ from pixelated.exceptions import InstanceAlreadyExistsError
 
 __author__ = 'fbernitt'
 
+DEFAULT_BATCH_PARALLELISM = 4
+
 
 class ProviderInitializingException(Exception):
     pass
@@ -43,13 +47,40 @@ def _mkdir_if_not_exists(dir, mode=0700):
         os.mkdir(dir, mode)
 
 
+def run_in_parallel(operation, names, parallelism=DEFAULT_BATCH_PARALLELISM):
+    """Calls operation(name) for all names using at most parallelism threads.
+
+    Returns a list of (name, error) tuples in the order of names; error is None if the operation succeeded.
+    """
+    def run(name):
+        try:
+            operation(name)
+            return name, None
+        except Exception, e:
+            return name, e
+
+    if not names:
+        return []
+
+    pool = ThreadPool(max(1, min(parallelism, len(names))))
+    try:
+        return pool.map(run, names)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class BaseProvider(Provider):
     CFG_FILE_NAME = 'agent.cfg'
 
-    __slots__ = ('_initializing')
+    __slots__ = ('_initializing', '_transitions', '_agent_locks', '_state_lock', '_pending_starts')
 
     def __init__(self):
         self._initializing = True
+        self._transitions = {}
+        self._agent_locks = {}
+        self._state_lock = RLock()
+        self._pending_starts = 0
 
     def initialize(self):
         self._initializing = False
@@ -68,40 +99,77 @@ class BaseProvider(Provider):
         if self.initializing:
             raise ProviderInitializingException()
 
+    def _agent_lock(self, name):
+        """Returns the lock that serializes all lifecycle operations of one agent"""
+        with self._state_lock:
+            return self._agent_locks.setdefault(name, RLock())
+
     def remove(self, user_config):
         self._ensure_initialized()
 
-        if user_config.username in self.list_running():
-            raise ValueError('Container %s is currently running. Please stop before removal!' % user_config.username)
+        with self._agent_lock(user_config.username):
+            if user_config.username in self.list_running():
+                raise ValueError('Container %s is currently running. Please stop before removal!' % user_config.username)
 
-        data_path = path.join(user_config.path, 'data')
-        if path.exists(data_path):
-            shutil.rmtree(data_path)
-        else:
-            raise ValueError('No container with name %s' % user_config.username)
+            data_path = path.join(user_config.path, 'data')
+            if path.exists(data_path):
+                shutil.rmtree(data_path)
+            else:
+                raise ValueError('No container with name %s' % user_config.username)
 
     def _start(self, user_config):
+        """Checks the agent may start and reserves memory for it. Call _start_finished once it started or failed"""
         name = user_config.username
         if name in self.list_running():
             raise InstanceAlreadyRunningError('instance %s already running' % name)
 
-        if not self._check_enough_free_memory():
+        with self._state_lock:  # starts of different agents must not all pass the check at once
+            if not self._check_enough_free_memory(self._pending_starts):
                 raise NotEnoughFreeMemory('Not enough memory to start instance %s!' % name)
+            self._pending_starts += 1
+
+        try:
+            _mkdir_if_not_exists(self._data_path(user_config))
+        except Exception:
+            self._start_finished()
+            raise
 
-        _mkdir_if_not_exists(self._data_path(user_config))
+    def _start_finished(self):
+        with self._state_lock:
+            self._pending_starts -= 1
 
-    def _check_enough_free_memory(self):
+    def _check_enough_free_memory(self, pending_starts=0):
         return True
 
     def _stop(self, name):
         if name not in self.list_running():
             raise InstanceNotRunningError('No running instance named %s' % name)
 
+    def begin_transition(self, name, state):
+        with self._state_lock:
+            self._transitions[name] = state
+
+    def end_transition(self, name):
+        with self._state_lock:
+            self._transitions.pop(name, None)
+
     def status(self, name):
-        if name in self.list_running():
-            return {'state': 'running', 'port': self._agent_port(name)}
-        else:
-            return {'state': 'stopped'}
+        transition = self._transitions.get(name)
+        if transition:
+            return {'state': transition}
+        try:
+            if name in self.list_running():
+                status = {'state': 'running'}
+                status.update(self._agent_endpoint(name))
+                return status
+        except KeyError:
+            pass  # agent got stopped concurrently, status does not wait for the agent lock
+        return {'state': 'stopped'}
+
+    def _agent_endpoint(self, name):
+        """Returns where the proxy reaches the agent"""
+        return {'port': self._agent_port(name)}
 
     def _agent_port(self, name):
         raise NotImplementedError
+
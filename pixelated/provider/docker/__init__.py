@@ -24,6 +24,7 @@ import time
 import tempfile
 import multiprocessing
 import socket
+from threading import Lock
 
 import pkg_resources
 import docker
@@ -43,6 +44,9 @@ __author__ = 'fbernitt'
 
 DOCKER_API_VERSION = '1.14'
 DOCKER_MEMORY_LIMIT = '300m'
+DOCKER_MEMORY_LIMIT_IN_BYTES = 300 * 1024 * 1024
+AGENT_SOCKET_MOUNT = '/mnt/run'
+AGENT_SOCKET_NAME = 'agent.sock'
 
 
 class CredentialsToDockerStdinWriter(object):
@@ -115,19 +119,27 @@ class TempDir(object):
 
 
 class DockerProvider(BaseProvider):
-    __slots__ = ('_docker_url', '_docker', '_ports', '_adapter', '_leap_provider_hostname', '_leap_provider_x509', '_credentials')
+    __slots__ = ('_docker_url', '_docker', '_ports', '_adapter', '_leap_provider_hostname', '_leap_provider_x509', '_credentials', '_prepare_lock', '_bind_address', '_agent_socket_dir', '_image_versions')
 
     DEFAULT_DOCKER_URL = 'http+unix://var/run/docker.sock'
+    DEFAULT_BIND_ADDRESS = '127.0.0.1'
 
-    def __init__(self, adapter, leap_provider_hostname, leap_provider_x509, docker_url=DEFAULT_DOCKER_URL):
+    def __init__(self, adapter, leap_provider_hostname, leap_provider_x509, docker_url=DEFAULT_DOCKER_URL, bind_address=DEFAULT_BIND_ADDRESS, agent_socket_dir=None):
+        """ With agent_socket_dir agents get exposed on a unix socket in a folder per agent
+            below it instead of a port on bind_address. The proxy has to run on the docker host.
+        """
         super(DockerProvider, self).__init__()
         self._docker_url = docker_url
+        self._bind_address = bind_address
+        self._agent_socket_dir = agent_socket_dir
+        self._image_versions = {}  # container id -> id of the image it runs, dropped on stop, pull and build
         self._docker = docker.Client(base_url=docker_url, version=DOCKER_API_VERSION)
         self._ports = set()
         self._adapter = adapter
         self._leap_provider_hostname = leap_provider_hostname
         self._leap_provider_x509 = leap_provider_x509
         self._credentials = {}
+        self._prepare_lock = Lock()  # all agents share the prepare container
         self._check_docker_connection()
 
     def _check_docker_connection(self):
@@ -165,8 +177,35 @@ class DockerProvider(BaseProvider):
                     path = None
                     self._build_image(path, fileobj)
                 logger.info('Finished image %s build in %d seconds' % ('%s:latest' % self._adapter.docker_image_name(), time.time() - start))
+        if self._agent_socket_dir and not self._image_supports_sockets():
+            logger.error('Image %s cannot expose agents on unix sockets (socat missing?), publishing agent ports on %s instead' % (self._adapter.docker_image_name(), self._bind_address))
+            self._agent_socket_dir = None
+        self._rediscover_ports()
         self._initializing = False
 
+    def _rediscover_ports(self):
+        """Takes over the ports of agents that are still running, e.g. started by a previous manager"""
+        ports = set()
+        for c in self._docker.containers():
+            for port in c.get('Ports') or []:
+                if port.get('PublicPort'):
+                    ports.add(port['PublicPort'])
+        with self._state_lock:
+            self._ports.update(ports)
+        if ports:
+            logger.info('Found %d running agents' % len(ports))
+
+    def _image_supports_sockets(self):
+        command = self._adapter.socket_check_command()
+        if command is None:
+            return False
+        c = self._docker.create_container(self._adapter.docker_image_name(), command)
+        try:
+            self._docker.start(c)
+            return self._docker.wait(c) == 0
+        finally:
+            self._docker.remove_container(c)
+
     def _image_exists(self, docker_image_name):
         imgs = self._docker.images()
         repo_tag = docker_image_name + ':latest'
@@ -177,6 +216,7 @@ class DockerProvider(BaseProvider):
         return False
 
     def _download_image(self, docker_image_name):
+        self._image_versions.clear()
         stream = self._docker.pull(repository=docker_image_name, tag='latest', stream=True)
         lines = []
         for event in stream:
@@ -193,6 +233,7 @@ class DockerProvider(BaseProvider):
                 os.kill(os.getpid(), signal.SIGTERM)
 
     def _build_image(self, path, fileobj):
+        self._image_versions.clear()
         stream = self._docker.build(path=path, fileobj=fileobj, tag='%s:latest' % self._adapter.docker_image_name())
         lines = []
         for event in stream:
@@ -237,11 +278,14 @@ class DockerProvider(BaseProvider):
     def pass_credentials_to_agent(self, user_config, password):
         self._credentials[user_config.username] = password  # remember crendentials until agent gets started
 
+    def passed_credentials(self, name):
+        return self._credentials.get(name)
+
     def _write_credentials_to_docker_stdin(self, user_config):
-        if user_config.username not in self._credentials:
+        password = self._credentials.get(user_config.username)
+        if password is None:
             return
 
-        password = self._credentials[user_config.username]
         p = CredentialsToDockerStdinWriter(self._docker_url, user_config.username, self._leap_provider_hostname, user_config.username, password)
         p.start()
 
@@ -253,29 +297,57 @@ class DockerProvider(BaseProvider):
     def start(self, user_config):
         self._ensure_initialized()
         name = user_config.username
-        self._start(user_config)
+        with self._agent_lock(name):
+            self._start(user_config)
+            try:
+                cm = self._map_container_by_name(all=True)
+                if name not in cm:
+                    self._setup_instance(user_config)
+                    uid = os.getuid()
+                    if self._agent_socket_dir:
+                        command = self._adapter.socket_run_command(self._leap_provider_x509, join(AGENT_SOCKET_MOUNT, AGENT_SOCKET_NAME))
+                        volumes = ['/mnt/user', AGENT_SOCKET_MOUNT]
+                    else:
+                        command = self._adapter.run_command(self._leap_provider_x509)
+                        volumes = ['/mnt/user']
+                    c = self._docker.create_container(self._adapter.docker_image_name(), command, mem_limit=DOCKER_MEMORY_LIMIT, user=uid, name=name, volumes=volumes, ports=[self._adapter.port()], environment=self._adapter.environment('/mnt/user'), stdin_open=True)
+                else:
+                    c = cm[name]
+                data_path = self._data_path(user_config)
 
-        cm = self._map_container_by_name(all=True)
-        if name not in cm:
-            self._setup_instance(user_config, cm)
-            uid = os.getuid()
-            c = self._docker.create_container(self._adapter.docker_image_name(), self._adapter.run_command(self._leap_provider_x509), mem_limit=DOCKER_MEMORY_LIMIT, user=uid, name=name, volumes=['/mnt/user'], ports=[self._adapter.port()], environment=self._adapter.environment('/mnt/user'), stdin_open=True)
-        else:
-            c = cm[name]
-        data_path = self._data_path(user_config)
+                self._add_leap_ca_to_user_data_path(data_path)
+
+                if self._agent_socket_dir:
+                    self._start_on_socket(c, name, data_path)
+                else:
+                    self._start_on_port(c, data_path)
 
-        self._add_leap_ca_to_user_data_path(data_path)
+                self._write_credentials_to_docker_stdin(user_config)
+            finally:
+                self._start_finished()
 
-        port = self._next_available_port()
-        self._ports.add(port)
+    def _start_on_port(self, container, data_path):
+        port = self._reserve_port()
+        try:
+            self._docker.start(
+                container,
+                binds={data_path: {'bind': '/mnt/user', 'ro': False}},
+                extra_hosts=self._extra_hosts(),
+                port_bindings={self._adapter.port(): (self._bind_address, port)})
+        except Exception:
+            self._release_port(port)
+            raise
 
+    def _start_on_socket(self, container, name, data_path):
+        socket_path = self._agent_socket_path(name)
+        _mkdir_if_not_exists(path.dirname(socket_path), mode=0750)
         self._docker.start(
-            c,
-            binds={data_path: {'bind': '/mnt/user', 'ro': False}},
-            extra_hosts=self._extra_hosts(),
-            port_bindings={self._adapter.port(): ('127.0.0.1', port)})
+            container,
+            binds={data_path: {'bind': '/mnt/user', 'ro': False}, path.dirname(socket_path): {'bind': AGENT_SOCKET_MOUNT, 'ro': False}},
+            extra_hosts=self._extra_hosts())
 
-        self._write_credentials_to_docker_stdin(user_config)
+    def _agent_socket_path(self, name):
+        return join(self._agent_socket_dir, name, AGENT_SOCKET_NAME)
 
     def _extra_hosts(self):
         fqdn = socket.getfqdn()
@@ -285,17 +357,19 @@ class DockerProvider(BaseProvider):
         print hostslist
         return hostslist
 
-    def _setup_instance(self, user_config, container_map):
+    def _setup_instance(self, user_config):
         data_path = join(user_config.path, 'data')
 
         container_name = '%s_prepare' % self._adapter.app_name()
-        if container_name not in container_map:
-            c = self._docker.create_container(self._adapter.docker_image_name(), self._adapter.setup_command(), name=container_name, volumes=['/mnt/user'], environment=self._adapter.environment('/mnt/user'))
-        else:
-            c = container_map[container_name]
+        with self._prepare_lock:
+            container_map = self._map_container_by_name(all=True)  # fresh, a concurrent first start may have created it
+            if container_name not in container_map:
+                c = self._docker.create_container(self._adapter.docker_image_name(), self._adapter.setup_command(), name=container_name, volumes=['/mnt/user'], environment=self._adapter.environment('/mnt/user'))
+            else:
+                c = container_map[container_name]
 
-        self._docker.start(c, binds={data_path: {'bind': '/mnt/user', 'ro': False}})
-        s = self._docker.wait(c)
+            self._docker.start(c, binds={data_path: {'bind': '/mnt/user', 'ro': False}})
+            s = self._docker.wait(c)
         if s != 0:
             raise Exception('Failed to initialize mailbox: %d!' % s)
 
@@ -324,34 +398,60 @@ class DockerProvider(BaseProvider):
         return names
 
     def stop(self, name):
-        self._stop(name)
-        if name in self._credentials:
-            del self._credentials[name]
-
-        for cname, c in self._map_container_by_name().iteritems():
-            if name == cname:
-                port = self._docker_container_port(name)
-                try:
-                    self._docker.stop(c, timeout=10)
-                except requests.exceptions.Timeout:
-                    self._docker.kill(c)
-                self._ports.remove(port)
-                return
-
-        raise ValueError
+        with self._agent_lock(name):
+            self._stop(name)
+            self._credentials.pop(name, None)
+
+            for cname, c in self._map_container_by_name().iteritems():
+                if name == cname:
+                    port = None if self._agent_socket_dir else self._docker_container_port(name)
+                    try:
+                        self._docker.stop(c, timeout=10)
+                    except requests.exceptions.Timeout:
+                        self._docker.kill(c)
+                    self._image_versions.pop(c.get('Id'), None)
+                    if port:
+                        self._release_port(port)
+                    return
+
+            raise ValueError
 
     def reset_data(self, user_config):
         self._ensure_initialized()
 
-        if user_config.username in self.list_running():
-            raise InstanceAlreadyRunningError('Container %s is currently running. Please stop before resetting data!' % user_config.username)
+        with self._agent_lock(user_config.username):
+            if user_config.username in self.list_running():
+                raise InstanceAlreadyRunningError('Container %s is currently running. Please stop before resetting data!' % user_config.username)
 
-        if path.exists(user_config.path):
-            data_path = self._data_path(user_config)
-            if path.exists(data_path):
-                shutil.rmtree(data_path)
+            if path.exists(user_config.path):
+                data_path = self._data_path(user_config)
+                if path.exists(data_path):
+                    shutil.rmtree(data_path)
+            else:
+                raise ValueError('No agent with name %s' % user_config.username)
+
+    def _agent_endpoint(self, name):
+        c = self._docker_container_by_name(name)
+        if self._agent_socket_dir:
+            endpoint = {'socket': self._agent_socket_path(name)}
         else:
-            raise ValueError('No agent with name %s' % user_config.username)
+            endpoint = {'port': c['Ports'][0]['PublicPort']}
+        version = self._image_version(c)
+        if version:
+            endpoint['version'] = version  # lets the proxy share cached static assets between agents of the same image
+        return endpoint
+
+    def _image_version(self, container):
+        container_id = container.get('Id')
+        if not container_id:
+            return None
+        if container_id not in self._image_versions:
+            try:
+                self._image_versions[container_id] = self._docker.inspect_container(container_id)['Image'][:12]
+            except Exception, e:
+                logger.warn('Failed to inspect container %s: %s' % (container_id, e))
+                return None
+        return self._image_versions[container_id]
 
     def _agent_port(self, name):
         return self._docker_container_port(name)
@@ -375,8 +475,19 @@ class DockerProvider(BaseProvider):
 
         return port
 
+    def _reserve_port(self):
+        with self._state_lock:
+            port = self._next_available_port()
+            self._ports.add(port)
+            return port
+
+    def _release_port(self, port):
+        with self._state_lock:
+            self._ports.discard(port)
+
     def _used_ports(self):
-        return self._ports
+        with self._state_lock:
+            return set(self._ports)
 
     def memory_usage(self):
         self._ensure_initialized()
@@ -401,3 +512,7 @@ class DockerProvider(BaseProvider):
 
     def _free_memory(self):
         return psutil.virtual_memory().free
+
+    def total_memory(self):
+        """Returns the memory of the docker host in bytes or None if docker does not report it"""
+        return self._docker.info().get('MemTotal')
@@ -27,6 +27,14 @@ class DockerAdapter(object):
     def run_command(self, leap_provider_x509):
         raise NotImplementedError
 
+    def socket_run_command(self, leap_provider_x509, socket_path):
+        """Like run_command but the agent gets exposed on a unix socket instead of its port"""
+        raise NotImplementedError
+
+    def socket_check_command(self):
+        """Command that exits with 0 if the image can expose the agent on a unix socket, None if it never can"""
+        return None
+
     def after_run(self):
         pass
 
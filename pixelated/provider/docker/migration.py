@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import subprocess
+
+from pixelated.common import logger
+
+DEFAULT_MEMORY_WATERMARK = 0.8
+LOCAL_ADDRESSES = ('127.0.0.1', 'localhost')
+
+
+class RsyncDataSync(object):
+    """ Copies agent data between docker hosts with rsync over ssh.
+
+        rsync only transfers what changed, so a second sync right after stopping
+        the agent is quick even if the first one copied the whole mailbox.
+    """
+
+    __slots__ = ('_rsync',)
+
+    def __init__(self, rsync='rsync'):
+        self._rsync = rsync
+
+    def sync(self, source_address, target_address, data_path):
+        if source_address == target_address:
+            return
+        subprocess.check_call(self.command(source_address, target_address, data_path))
+
+    def command(self, source_address, target_address, data_path):
+        if target_address in LOCAL_ADDRESSES:
+            return [self._rsync, '-a', '--delete', '%s:%s/' % (source_address, data_path), '%s/' % data_path]
+
+        command = [self._rsync, '-a', '--delete', '%s/' % data_path, '%s:%s/' % (target_address, data_path)]
+        return command if source_address in LOCAL_ADDRESSES else ['ssh', source_address] + command
+
+
+def plan_moves(hosts, agent_memory, watermark=DEFAULT_MEMORY_WATERMARK, movable=lambda name: True):
+    """ Greedily proposes agent moves that even out the memory usage of the hosts.
+
+        hosts is a list of (address, total_memory, running agents) tuples. An agent gets moved
+        from the fullest to the emptiest host if that reduces the imbalance or brings the
+        fullest host below the watermark. Only agents accepted by movable are moved, each
+        at most once. Hosts that do not report their memory are left alone.
+
+        Returns a list of {'agent', 'source', 'target'} dicts.
+    """
+    addresses = [address for address, total, running in hosts if total]
+    capacity = dict((address, total) for address, total, running in hosts if total)
+    agents = dict((address, list(running)) for address, total, running in hosts if total)
+
+    def usage(address, delta=0):
+        return (len(agents[address]) + delta) * agent_memory / float(capacity[address])
+
+    def worth_moving(source, target):
+        if usage(target, 1) <= usage(source, -1):
+            return True
+        return usage(source) > watermark and usage(target, 1) <= watermark
+
+    moves = []
+    moved = set()
+    exhausted = set()
+    while len(addresses) - len(exhausted) > 1:
+        ranked = sorted((address for address in addresses if address not in exhausted), key=usage)
+        source, target = ranked[-1], ranked[0]
+        if not worth_moving(source, target):
+            break
+
+        candidates = [name for name in agents[source] if name not in moved and movable(name)]
+        if not candidates:
+            exhausted.add(source)
+            continue
+
+        name = candidates[0]
+        agents[source].remove(name)
+        agents[target].append(name)
+        moved.add(name)
+        moves.append({'agent': name, 'source': source, 'target': target})
+
+    logger.debug('Planned %d agent moves' % len(moves))
+    return moves
@@ -0,0 +1,309 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+from threading import Thread
+from urlparse import urlparse
+
+from pixelated.common import logger
+from pixelated.exceptions import InstanceAlreadyRunningError, InstanceNotRunningError
+from pixelated.provider import NotEnoughFreeMemory
+from pixelated.provider.base_provider import BaseProvider, run_in_parallel
+from pixelated.provider.docker import DockerProvider, DOCKER_MEMORY_LIMIT_IN_BYTES
+from pixelated.provider.docker.migration import plan_moves, DEFAULT_MEMORY_WATERMARK
+
+HOST_RETRY_INTERVAL_IN_S = 60
+
+
+def parse_docker_host(value):
+    """Parses URL[=ADDRESS] into a (url, address) tuple.
+
+    The address is where the agent ports get published and where the proxy connects to.
+    It defaults to the hostname of tcp urls and to the loopback address otherwise.
+    """
+    if '=' in value:
+        url, address = value.split('=', 1)
+    else:
+        url, address = value, None
+    if not address:
+        address = urlparse(url).hostname if url.startswith('tcp://') else DockerProvider.DEFAULT_BIND_ADDRESS
+    return url, address
+
+
+class DockerHost(object):
+    __slots__ = ('url', 'address', 'provider', 'total_memory', 'pending')
+
+    def __init__(self, url, address, provider):
+        self.url = url
+        self.address = address
+        self.provider = provider
+        self.total_memory = None
+        self.pending = 0
+
+    def free_memory(self, running):
+        """Estimates the free memory by the memory limit of all agents placed on this host"""
+        if self.total_memory is None:
+            return None
+        return self.total_memory - (running + self.pending) * DOCKER_MEMORY_LIMIT_IN_BYTES
+
+    def __str__(self):
+        return self.url
+
+
+class MultiHostDockerProvider(BaseProvider):
+    """ Runs agents on a pool of docker hosts.
+
+        New agents are placed on the host with the most free memory, ties go to the host
+        with fewer running agents. The user data directories have to be available under
+        the same path on all docker hosts, either by a network file system or by passing
+        a data_sync that copies them when an agent gets migrated to another host.
+
+        Hosts that fail to initialize are retried every retry_interval seconds and join
+        the pool, together with the agents still running on them, once they are back.
+    """
+
+    __slots__ = ('_hosts', '_failed_hosts', '_retry_interval', '_placements', '_credentials', '_data_sync')
+
+    supports_migration = True
+
+    def __init__(self, adapter, leap_provider_hostname, leap_provider_x509, docker_hosts, data_sync=None, retry_interval=HOST_RETRY_INTERVAL_IN_S):
+        super(MultiHostDockerProvider, self).__init__()
+        self._hosts = [DockerHost(url, address, DockerProvider(adapter, leap_provider_hostname, leap_provider_x509, url, bind_address=address)) for url, address in docker_hosts]
+        self._failed_hosts = []
+        self._retry_interval = retry_interval
+        self._placements = {}
+        self._credentials = {}
+        self._data_sync = data_sync
+
+    def initialize(self):
+        failed = []
+        for host, error in run_in_parallel(self._initialize_host, self._hosts, parallelism=len(self._hosts)):
+            if error:
+                logger.error('Failed to initialize docker host %s: %s' % (host, error))
+                failed.append(host)
+        if len(failed) == len(self._hosts):
+            raise Exception('Failed to initialize any docker host')
+
+        self._hosts = [host for host in self._hosts if host not in failed]
+        self._failed_hosts = failed
+        self._initializing = False
+        if failed:
+            retry = Thread(target=self._retry_failed_hosts_periodically)
+            retry.daemon = True
+            retry.start()
+
+    def _initialize_host(self, host):
+        host.provider.initialize()
+        host.total_memory = host.provider.total_memory()
+        running = host.provider.list_running()
+        with self._state_lock:
+            for name in running:
+                self._placements[name] = host
+
+    def _retry_failed_hosts_periodically(self):
+        while self._failed_hosts:
+            time.sleep(self._retry_interval)
+            self.retry_failed_hosts()
+
+    def retry_failed_hosts(self):
+        """Adds the failed docker hosts that initialize by now back to the pool"""
+        for host in list(self._failed_hosts):
+            try:
+                self._initialize_host(host)
+            except Exception, e:
+                logger.warn('Docker host %s still not available: %s' % (host, e))
+                continue
+            with self._state_lock:
+                self._failed_hosts = [failed for failed in self._failed_hosts if failed is not host]
+                self._hosts = self._hosts + [host]  # replaced, not changed, as others iterate over it
+            logger.info('Docker host %s is back, %d agents running on it' % (host, len(host.provider.list_running())))
+
+    def placement(self, name):
+        """Returns the address of the docker host the agent was last placed on or None"""
+        host = self._placements.get(name)
+        return host.address if host else None
+
+    def pass_credentials_to_agent(self, user_config, password):
+        self._credentials[user_config.username] = password  # passed on to the docker host the agent gets placed on
+
+    def start(self, user_config):
+        self._ensure_initialized()
+        name = user_config.username
+        with self._agent_lock(name):
+            if name in self.list_running():
+                raise InstanceAlreadyRunningError('instance %s already running' % name)
+
+            host = self._reserve_host(name)
+            try:
+                password = self._credentials.pop(name, None)
+                if password is not None:
+                    host.provider.pass_credentials_to_agent(user_config, password)
+                host.provider.start(user_config)
+                with self._state_lock:
+                    self._placements[name] = host
+            finally:
+                with self._state_lock:
+                    host.pending -= 1
+
+    def migrate(self, user_config, address):
+        """Moves a running agent to the docker host with the given address.
+
+        The data gets synced once while the agent is still running and once more after
+        it got stopped, so the agent is only down for the second, incremental sync.
+        If the agent fails to start on the target it gets restarted on its old host.
+        """
+        self._ensure_initialized()
+        name = user_config.username
+        with self._agent_lock(name):
+            source = self._running_host(name)
+            if source is None:
+                raise InstanceNotRunningError('No running instance named %s' % name)
+            target = self._host_by_address(address)
+            if target is source:
+                return
+
+            running = len(target.provider.list_running())
+            with self._state_lock:
+                free = target.free_memory(running)
+                if free is not None and free < DOCKER_MEMORY_LIMIT_IN_BYTES:
+                    raise NotEnoughFreeMemory('Not enough memory on docker host %s to migrate instance %s!' % (target, name))
+                target.pending += 1
+            try:
+                self._move(user_config, source, target)
+            finally:
+                with self._state_lock:
+                    target.pending -= 1
+
+    def _move(self, user_config, source, target):
+        name = user_config.username
+        data_path = self._data_path(user_config)
+        password = source.provider.passed_credentials(name)
+
+        logger.info('Migrating agent %s from docker host %s to %s' % (name, source, target))
+        self._sync_data(source, target, data_path)
+        self.begin_transition(name, 'migrating')
+        try:
+            source.provider.stop(name)
+            try:
+                self._sync_data(source, target, data_path)
+                self._start_on(target, user_config, password)
+            except Exception, e:
+                logger.error('Failed to migrate agent %s to docker host %s, restarting it on %s: %s' % (name, target, source, e))
+                self._start_on(source, user_config, password)
+                raise
+
+            with self._state_lock:
+                self._placements[name] = target
+        finally:
+            self.end_transition(name)
+
+    def _start_on(self, host, user_config, password):
+        if password is not None:
+            host.provider.pass_credentials_to_agent(user_config, password)
+        host.provider.start(user_config)
+
+    def _sync_data(self, source, target, data_path):
+        if self._data_sync:
+            self._data_sync.sync(source.address, target.address, data_path)
+
+    def _host_by_address(self, address):
+        for host in self._hosts:
+            if host.address == address:
+                return host
+        raise ValueError('Unknown docker host %s' % address)
+
+    def rebalance_plan(self, movable, watermark=DEFAULT_MEMORY_WATERMARK):
+        """Proposes migrations of movable agents that even out the memory usage of the docker hosts"""
+        self._ensure_initialized()
+        hosts = [(host.address, host.total_memory, host.provider.list_running()) for host in self._hosts]
+        return plan_moves(hosts, DOCKER_MEMORY_LIMIT_IN_BYTES, watermark, movable)
+
+    def _reserve_host(self, name):
+        running = dict((host, len(host.provider.list_running())) for host in self._hosts)
+        with self._state_lock:
+            candidates = []
+            for host in self._hosts:
+                free = host.free_memory(running[host])
+                if free is None or free >= DOCKER_MEMORY_LIMIT_IN_BYTES:
+                    candidates.append((free or 0, -(running[host] + host.pending), host))
+            if not candidates:
+                raise NotEnoughFreeMemory('Not enough memory on any docker host to start instance %s!' % name)
+
+            host = max(candidates, key=lambda candidate: candidate[:2])[2]
+            host.pending += 1
+            logger.info('Placing agent %s on docker host %s' % (name, host))
+            return host
+
+    def stop(self, name):
+        with self._agent_lock(name):
+            self._credentials.pop(name, None)
+            host = self._running_host(name)
+            if host is None:
+                raise InstanceNotRunningError('No running instance named %s' % name)
+            host.provider.stop(name)
+
+    def _running_host(self, name):
+        placed = self._placements.get(name)
+        hosts = [placed] + [host for host in self._hosts if host is not placed] if placed else self._hosts
+        for host in hosts:
+            if name in host.provider.list_running():
+                return host
+        return None
+
+    def reset_data(self, user_config):
+        self._ensure_initialized()
+        with self._agent_lock(user_config.username):
+            if user_config.username in self.list_running():
+                raise InstanceAlreadyRunningError('Container %s is currently running. Please stop before resetting data!' % user_config.username)
+            host = self._placements.get(user_config.username) or self._hosts[0]  # the data lives where the agent ran last
+            host.provider.reset_data(user_config)
+
+    def list_running(self):
+        self._ensure_initialized()
+        running = []
+        for host in self._hosts:
+            running.extend(host.provider.list_running())
+        return running
+
+    def status(self, name):
+        status = super(MultiHostDockerProvider, self).status(name)
+        if status['state'] == 'running':
+            status['host'] = self._placed_host(name).address
+        return status
+
+    def _agent_endpoint(self, name):
+        return self._placed_host(name).provider._agent_endpoint(name)
+
+    def _placed_host(self, name):
+        host = self._placements.get(name) or self._running_host(name)
+        if host is None:
+            raise KeyError(name)
+        return host
+
+    def memory_usage(self):
+        self._ensure_initialized()
+
+        usage = 0
+        agents = []
+        for host in self._hosts:
+            host_usage = host.provider.memory_usage()
+            usage += host_usage['total_usage']
+            for agent in host_usage['agents']:
+                agent['host'] = host.address
+                agents.append(agent)
+
+        avg = usage / len(agents) if len(agents) > 0 else 0
+
+        return {'total_usage': usage, 'average_usage': avg, 'agents': agents}
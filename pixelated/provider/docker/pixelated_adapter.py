@@ -33,13 +33,25 @@ class PixelatedDockerAdapter(DockerAdapter):
         return 'pixelated/pixelated-user-agent'
 
     def run_command(self, leap_provider_x509):
+        return '/bin/bash -l -c "%s"' % self._agent_command(leap_provider_x509, '0.0.0.0')
+
+    def socket_run_command(self, leap_provider_x509, socket_path):
+        # the agent only speaks TCP, so socat relays the socket to the agent listening on loopback inside the container.
+        # The relay still copies every byte and forks per connection.
+        relay = 'socat UNIX-LISTEN:%s,fork,unlink-early,mode=660 TCP:127.0.0.1:%d' % (socket_path, self.PIXELATED_PORT)
+        return '/bin/bash -l -c "%s & exec %s"' % (relay, self._agent_command(leap_provider_x509, '127.0.0.1'))
+
+    def socket_check_command(self):
+        return '/bin/sh -c "command -v socat"'
+
+    def _agent_command(self, leap_provider_x509, host):
         extra_args = ""
         if leap_provider_x509.has_ca_bundle():
             extra_args = ' --leap-provider-cert /mnt/user/dispatcher-leap-provider-ca.crt'
         if leap_provider_x509.has_fingerprint():
             extra_args = ' --leap-provider-cert-fingerprint %s' % leap_provider_x509.fingerprint
 
-        return '/bin/bash -l -c "/usr/bin/pixelated-user-agent --leap-home /mnt/user --host 0.0.0.0 --port 4567 --organization-mode%s"' % extra_args
+        return '/usr/bin/pixelated-user-agent --leap-home /mnt/user --host %s --port %d --organization-mode%s' % (host, self.PIXELATED_PORT, extra_args)
 
     def setup_command(self):
         return '/bin/true'
@@ -35,21 +35,24 @@ class ForkProvider(BaseProvider):
 
     def start(self, user_config):
         name = user_config.username
-        self._start(user_config)
+        with self._agent_lock(name):
+            self._start(user_config)
+            try:
+                gnupg_path = path.join(user_config.path, 'gnupg')
+                _mkdir_if_not_exists(gnupg_path)
 
-        gnupg_path = path.join(user_config.path, 'gnupg')
-        _mkdir_if_not_exists(gnupg_path)
+                self._runner.initialize(name)
+                process = self._runner.start(name)
 
-        self._runner.initialize(name)
-        process = self._runner.start(name)
-
-        self._running[name] = process
+                self._running[name] = process
+            finally:
+                self._start_finished()
 
     def stop(self, name):
-        self._stop(name)
+        with self._agent_lock(name):
+            self._stop(name)
 
-        self._running[name].terminate()
-        del self._running[name]
+            self._running.pop(name).terminate()
 
     def reset_data(self, user_config):
         raise Exception('Not yet implemented')
@@ -60,7 +63,7 @@ class ForkProvider(BaseProvider):
     def memory_usage(self):
         usage = 0
         agents = []
-        for name, process in self._running.iteritems():
+        for name, process in self._running.items():  # copy, agents may get started or stopped meanwhile
             usage += process.memory_usage()
             agents.append({'name': name, 'memory_usage': process.memory_usage()})
 
@@ -68,8 +71,8 @@ class ForkProvider(BaseProvider):
 
         return {'total_usage': usage, 'average_usage': avg, 'agents': agents}
 
-    def _check_enough_free_memory(self):
-        needed = self.memory_usage()['average_usage']
+    def _check_enough_free_memory(self, pending_starts=0):
+        needed = self.memory_usage()['average_usage'] * (1 + pending_starts)  # pending agents do not use memory yet
         free = self._free_memory()
 
         return needed < free
@@ -16,11 +16,12 @@
 import os
 
 import subprocess
+from threading import Lock
 from pixelated.provider.fork.adapter import ForkedProcess, Adapter
 
 
 class ForkRunner(Adapter):
-    __slots__ = ('_root_path', '_ports', '_adapter')
+    __slots__ = ('_root_path', '_ports', '_ports_lock', '_adapter')
 
     def __init__(self, root_path, adapter):
         if not os.path.isdir(root_path):
@@ -28,6 +29,7 @@ class ForkRunner(Adapter):
 
         self._root_path = root_path
         self._ports = set()
+        self._ports_lock = Lock()
         self._adapter = adapter
 
     def _gnupg_home(self, name):
@@ -45,14 +47,19 @@ class ForkRunner(Adapter):
     def start(self, name):
         env = self._prepare_env(name)
 
-        port = self._next_available_port()
+        port = self._reserve_port()
         self._set_next_port(name, port)
-        self._ports.add(port)
 
         p = subprocess.Popen(self._adapter.run_command(), stdin=subprocess.PIPE, close_fds=True, env=env)
 
         return ForkedProcess(p, port)
 
+    def _reserve_port(self):
+        with self._ports_lock:
+            port = self._next_available_port()
+            self._ports.add(port)
+            return port
+
     def _next_available_port(self):
         inital_port = 5000
 
@@ -20,10 +20,20 @@ import sys
 from tornado import web
 from tornado.web import HTTPError
 from tornado.httpclient import AsyncHTTPClient
-from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders
 
 from pixelated.client.dispatcher_api_client import PixelatedHTTPError, PixelatedNotAvailableHTTPError
 from pixelated.common import logger
+from pixelated.common.metrics import Metrics
+from pixelated.common.static_assets import load_static_manifest
+from pixelated.proxy.admission import Admission, AdmissionHTTPServer, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_REQUESTS_PER_IP, DEFAULT_HEADER_TIMEOUT_IN_S, DEFAULT_BODY_TIMEOUT_IN_S
+from pixelated.proxy.breaker import AgentHealth, DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT_IN_S
+from pixelated.proxy.collapsing import RequestCollapser
+from pixelated.proxy.priority import RequestClassifier, UpstreamScheduler, DEFAULT_AGENT_CONCURRENCY, DEFAULT_BACKGROUND_PATTERNS
+from pixelated.proxy.compression import Compression, DEFAULT_MIN_SIZE_IN_BYTES, parse_accept_encoding
+from pixelated.proxy.static_cache import StaticAssetCache, DEFAULT_CACHE_SIZE_IN_BYTES, DEFAULT_STATIC_PREFIXES, STATIC_MAX_AGE_IN_S
+from pixelated.proxy.tunnel import Tunnel, is_websocket_upgrade, request_head
+from pixelated.proxy.tls import create_ssl_context, TLSStats, DEFAULT_ECDH_CURVE
 
 import os
 import tornado.ioloop
@@ -38,18 +48,34 @@ from tornado import gen
 from pixelated.common import latest_available_ssl_version, DEFAULT_CIPHERS
 from tornado.httpclient import AsyncHTTPClient
 import threading
+import pycurl
 
 COOKIE_NAME = 'pixelated_user'
 
 REQUEST_TIMEOUT = 60
+STREAM_REQUEST_TIMEOUT = 24 * 60 * 60  # long polls and event streams are held open by the agent
+DEFAULT_STREAM_PREFIXES = ()
 TIMEOUT_WAIT_FOR_AGENT_TO_BE_UP = 5
+TIMEOUT_WAIT_FOR_AGENT_TO_START = 60
 TIMEOUT_WAIT_STEP = 0.5
+PROBE_TIMEOUT = 5
+AGENT_COMING_UP_STATES = ('starting', 'migrating')
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection', 'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade')
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+FILES_PATH = os.path.join(os.path.dirname(__file__), '..', 'files')
+STATIC_PATH = os.path.join(FILES_PATH, 'static')
+STATIC_BUILD_PATH = os.path.join(FILES_PATH, 'static_build')  # written by setup.py build_static
+IMMUTABLE_MAX_AGE_IN_S = 365 * 24 * 60 * 60
+PROXY_HEADERS = ('X-Xss-Protection', 'X-Frame-Options', 'X-Content-Type-Options', 'Strict-Transport-Security', 'Content-Disposition')  # the proxy's policy wins
 
 
 class BaseHandler(tornado.web.RequestHandler):
 
     def initialize(self, client):
         self._client = client
+        self._stream_status = None
+        self._stream_headers = None
+        self._stream_compressor = None
 
     def prepare(self):
         # add some security headers
@@ -78,19 +104,24 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             return None
 
-    def forward(self, port=None, host=None):
+    def forward(self, port=None, host=None, socket_path=None):
 
         url = "%s://%s:%s%s" % (
             'http', host or "127.0.0.1", port or 80, self.request.uri)
+        streaming = self._is_streaming_request()
         try:
             response = AsyncHTTPClient().fetch(
                 tornado.httpclient.HTTPRequest(
                     url=url,
                     method=self.request.method,
                     body=None if not self.request.body else self.request.body,
-                    headers=self.request.headers,
+                    headers=self._agent_request_headers(),
                     follow_redirects=False,
-                    request_timeout=REQUEST_TIMEOUT),
+                    use_gzip=False,  # pass bodies through as the agent encoded them
+                    request_timeout=STREAM_REQUEST_TIMEOUT if streaming else REQUEST_TIMEOUT,
+                    header_callback=self._on_agent_header_line if streaming else None,
+                    streaming_callback=self._on_agent_chunk if streaming else None,
+                    prepare_curl_callback=_unix_socket_callback(socket_path)),
                 self.handle_response)
             return response
         except tornado.httpclient.HTTPError, x:
@@ -102,23 +133,90 @@ class BaseHandler(tornado.web.RequestHandler):
             self.write("Internal server error:\n" + ''.join(traceback.format_exception(*sys.exc_info())))
             self.finish()
 
+    def _is_streaming_request(self):
+        """Streamed responses are passed on to the client chunk by chunk as they arrive"""
+        return False
+
+    def _on_agent_header_line(self, line):
+        if line.startswith('HTTP/'):
+            status = line.strip().split(' ', 2)
+            self._stream_status = (int(status[1]), status[2] if len(status) > 2 else None)
+            self._stream_headers = HTTPHeaders()
+        elif line.strip():
+            self._stream_headers.parse_line(line)
+        elif self._stream_status and self._stream_status[0] != 100:  # end of the final response's headers
+            code, reason = self._stream_status
+            self._pass_status_and_headers(code, reason, self._stream_headers)
+            encoding = None if 'Content-Encoding' in self._headers else self._negotiate_encoding(self._headers.get('Content-Type'), None)
+            if encoding:
+                self._stream_compressor = self.settings['compression'].stream(encoding)
+                self._set_content_encoding(encoding)
+            self.flush()
+
+    def _on_agent_chunk(self, chunk):
+        if self.request.connection.stream.closed():
+            return 0  # makes curl abort the transfer instead of holding the agent connection open
+        self.write(self._stream_compressor.compress(chunk) if self._stream_compressor else chunk)
+        self.flush()
+
+    def _agent_request_headers(self):
+        headers = _end_to_end_headers(self.request.headers)
+        if 'If-None-Match' in headers:
+            # If-None-Match compares weakly anyway, so undo weakening the ETag for compression
+            headers['If-None-Match'] = headers['If-None-Match'].replace('W/', '')
+        return headers
+
     def handle_response(self, response):
-        if response.error:
+        if self._headers_written:  # streamed response, everything got passed on already
+            if response.error and response.code == 599:
+                logger.error('Stream from user %s agent ended: %s' % (self.current_user, response.error))
+            if self._stream_compressor and not self.request.connection.stream.closed():
+                self.write(self._stream_compressor.finish())
+            self.finish()
+        elif response.code == 599:  # no response at all, e.g. connection refused or timeout
             logger.error('Got error from user %s agent: %s' % (self.current_user, response.error))
             self.set_status(503)
             self.write("Could not connect to instance %s: %s\n" % (self.current_user, str(response.error)))
             self.finish()
         else:
-            self.set_status(response.code)
-            for header in ("Date", "Cache-Control", 'Pragma', "Server", "Content-Type", "Location", "Set-Cookie"):
-                v = response.headers.get(header)
-                if v:
-                    self.set_header(header, v)
-
-            if response.body:
-                self.write(response.body)
+            # error statuses like 304, 404 or 500 are answers of the agent as well and get passed through
+            self._pass_status_and_headers(response.code, response.reason, response.headers)
+            if response.body and response.code != 304:
+                self._write_body(response.body)
             self.finish()
 
+    def _pass_status_and_headers(self, code, reason, agent_headers):
+        self.set_status(code, reason=reason)
+        headers = _end_to_end_headers(agent_headers)
+        for name in set(headers.keys()):
+            if name in PROXY_HEADERS and name in self._headers:
+                continue
+            values = headers.get_list(name)
+            self.set_header(name, values[0])
+            for value in values[1:]:
+                self.add_header(name, value)
+
+    def _write_body(self, body):
+        encoding = None if 'Content-Encoding' in self._headers else self._negotiate_encoding(self._headers.get('Content-Type'), len(body))
+        if encoding:
+            body = self.settings['compression'].compress(encoding, body)
+            self._set_content_encoding(encoding)
+        self.write(body)
+
+    def _negotiate_encoding(self, content_type, length):
+        compression = self.settings.get('compression')
+        if compression is None or self.request.method == 'HEAD' or self.get_status() != 200:
+            return None
+        return compression.negotiate(self.request.headers.get('Accept-Encoding'), content_type, length)
+
+    def _set_content_encoding(self, encoding):
+        self.set_header('Content-Encoding', encoding)
+        self.clear_header('Content-Length')
+        self.add_header('Vary', 'Accept-Encoding')
+        etag = self._headers.get('Etag')
+        if etag and not etag.startswith('W/'):
+            self.set_header('Etag', 'W/%s' % etag)  # the compressed body is a different representation
+
     def logout(self):
         if self.current_user:
             StopServerThread(self._client, self.current_user).start()
@@ -144,8 +242,83 @@ def ajax_authenticated(method):
     return wrapper
 
 
+def _end_to_end_headers(headers):
+    """Returns a copy of the headers without the hop-by-hop ones, which only apply to a single connection"""
+    hop_by_hop = set(HOP_BY_HOP_HEADERS)
+    hop_by_hop.update(name.strip().lower() for name in headers.get('Connection', '').split(',') if name.strip())
+
+    end_to_end = HTTPHeaders()
+    for name, value in headers.get_all():
+        if name.lower() not in hop_by_hop:
+            end_to_end.add(name, value)
+    return end_to_end
+
+
+def _unix_socket_callback(socket_path):
+    """Makes curl connect to the agent's unix socket instead of the host and port in the url"""
+    if not socket_path:
+        return None
+
+    def prepare_curl(curl):
+        curl.setopt(pycurl.UNIX_SOCKET_PATH, socket_path)
+    return prepare_curl
+
+
+def _forward_to_agent(handler, runtime):
+    if runtime.get('socket'):
+        handler.forward(host='localhost', socket_path=runtime['socket'])
+    else:
+        handler.forward(runtime['port'], runtime.get('host', '127.0.0.1'))
+
+
+def _agent_address(runtime):
+    return runtime['socket'] if runtime.get('socket') else (runtime.get('host', '127.0.0.1'), runtime['port'])
+
+
+def _probe_agent(runtime, callback):
+    """Checks if the agent answers at all, calling callback(healthy)"""
+    url = 'http://localhost/' if runtime.get('socket') else 'http://%s:%s/' % (runtime.get('host', '127.0.0.1'), runtime['port'])
+    request = tornado.httpclient.HTTPRequest(url=url, follow_redirects=False, request_timeout=PROBE_TIMEOUT,
+                                             prepare_curl_callback=_unix_socket_callback(runtime.get('socket')))
+    AsyncHTTPClient().fetch(request, lambda response: callback(response.code != 599))
+
+
+def _probe_current_agent(client, user, callback):
+    """Probes the agent where the manager says it runs now, calling callback(None) if it does not run any more"""
+    try:
+        runtime = client.get_agent_runtime(user)
+    except Exception, e:
+        logger.warn('Failed to look up agent of %s for probing: %s' % (user, e))
+        callback(False)
+        return
+    if runtime['state'] == 'running':
+        _probe_agent(runtime, callback)
+    else:
+        callback(False if runtime['state'] in AGENT_COMING_UP_STATES else None)
+
+
+def _agent_may_still_come_up(runtime, waited):
+    if runtime['state'] in AGENT_COMING_UP_STATES:
+        return waited < TIMEOUT_WAIT_FOR_AGENT_TO_START
+    return runtime['state'] != 'running' and waited < TIMEOUT_WAIT_FOR_AGENT_TO_BE_UP
+
+
 class MainHandler(BaseHandler):
-    __slots__ = '_client'
+    __slots__ = ('_client', '_static_cache', '_cache_key', '_stream_prefixes', '_collapser', '_collapse_key', '_classifier', '_scheduler', '_scheduled', '_health', '_runtime', '_forwarded_at')
+
+    def initialize(self, client, static_cache=None, stream_prefixes=DEFAULT_STREAM_PREFIXES, collapser=None, classifier=None, scheduler=None, health=None):
+        super(MainHandler, self).initialize(client)
+        self._static_cache = static_cache
+        self._cache_key = None
+        self._stream_prefixes = tuple(stream_prefixes)
+        self._collapser = collapser
+        self._collapse_key = None
+        self._classifier = classifier
+        self._scheduler = scheduler
+        self._scheduled = None  # (user, priority, submit time) while holding an agent slot
+        self._health = health
+        self._runtime = None
+        self._forwarded_at = None
 
     @ajax_authenticated
     @tornado.web.authenticated
@@ -153,8 +326,12 @@ class MainHandler(BaseHandler):
     def get(self):
         runtime = self._client.get_agent_runtime(self.current_user)
         if runtime['state'] == 'running':
-            port = runtime['port']
-            self.forward(port, '127.0.0.1')
+            if is_websocket_upgrade(self.request):
+                self._tunnel_to_agent(runtime)
+            elif not self._serve_from_static_cache(runtime) and not self._wait_for_identical_request():
+                self._schedule_forward(runtime)
+        elif runtime['state'] in AGENT_COMING_UP_STATES:
+            self._retry_later()
         else:
             self.logout()
             if _is_ajax_request(self.request):
@@ -185,6 +362,163 @@ class MainHandler(BaseHandler):
         # agent should do it after user has logged in
         pass
 
+    def _retry_later(self, seconds=1):
+        self.set_status(503)
+        self.set_header('Retry-After', str(seconds))
+        self.finish()
+
+    def _wait_for_identical_request(self):
+        if not self._collapser or self._is_streaming_request():
+            return False
+        key = self._collapser.key(self.current_user, self.request)
+        if key is None:
+            return False
+        if self._collapser.join(key, self):
+            return True
+        self._collapse_key = key
+        return False
+
+    def _release_waiting_requests(self):
+        if self._collapse_key is None:
+            return []
+        waiters = self._collapser.complete(self._collapse_key)
+        self._collapse_key = None
+        return waiters
+
+    def on_finish(self):
+        # the agent request failed without a response, e.g. it could not be sent at all
+        for waiter in self._release_waiting_requests():
+            waiter._retry_later()
+        self._release_agent_slot()
+
+    def _schedule_forward(self, runtime):
+        self._runtime = runtime
+        if self._health and not self._health.allow(self.current_user, _agent_address(runtime)):
+            self._retry_later(self._health.retry_after(self.current_user))
+            return
+        if self._scheduler is None or self._is_streaming_request():
+            _forward_to_agent(self, runtime)
+            return
+        user, priority, submitted = self.current_user, self._classifier.classify(self.request), time.time()
+
+        def start():
+            self._scheduled = (user, priority, submitted)
+            if self.request.connection.stream.closed():
+                self._release_agent_slot()  # client gave up while waiting
+            else:
+                _forward_to_agent(self, runtime)
+        self._scheduler.submit(user, priority, start)
+
+    def _release_agent_slot(self):
+        if self._scheduled is None:
+            return
+        scheduled, self._scheduled = self._scheduled, None
+        self._scheduler.release(*scheduled)
+
+    def forward(self, port=None, host=None, socket_path=None):
+        self._forwarded_at = time.time()
+        return super(MainHandler, self).forward(port, host, socket_path)
+
+    def _record_agent_health(self, response):
+        if self._health is None or self._forwarded_at is None or self._is_streaming_request():
+            return
+        if response.code == 599:
+            self._health.failure(self.current_user, functools.partial(_probe_current_agent, self._client, self.current_user), _agent_address(self._runtime))
+        else:
+            self._health.success(self.current_user, time.time() - self._forwarded_at)
+
+    def _tunnel_to_agent(self, runtime):
+        Tunnel(self.request.connection.stream, self._on_tunnel_failed).open(_agent_address(runtime), request_head(self.request))
+
+    def _on_tunnel_failed(self):
+        self.set_status(503)
+        self.write('Could not connect to instance %s\n' % self.current_user)
+        self.finish()
+
+    def _is_streaming_request(self):
+        return 'text/event-stream' in self.request.headers.get('Accept', '') or self.request.uri.startswith(self._stream_prefixes)
+
+    def _serve_from_static_cache(self, runtime):
+        version = runtime.get('version')
+        if not self._static_cache or not version or self.request.method != 'GET' or not self._static_cache.is_static(self.request.uri):
+            return False
+        self._cache_key = (version, self.request.uri)
+        asset = self._static_cache.get(*self._cache_key)
+        if asset is None:
+            return False
+        self._write_static_asset(asset)
+        return True
+
+    def _agent_request_headers(self):
+        headers = super(MainHandler, self)._agent_request_headers()
+        if self._cache_key and 'Accept-Encoding' in headers:
+            del headers['Accept-Encoding']  # the cache only keeps unencoded bodies
+        return headers
+
+    def handle_response(self, response):
+        self._record_agent_health(response)
+        for waiter in self._release_waiting_requests():
+            try:
+                waiter.handle_response(response)
+            except Exception, e:
+                logger.error('Error answering merged request of %s: %s' % (self.current_user, e))
+
+        if self._cache_key and not response.error:
+            asset = self._static_cache.put(self._cache_key[0], self._cache_key[1], response)
+            if asset:
+                self._write_static_asset(asset)
+                return
+        super(MainHandler, self).handle_response(response)
+
+    def _write_static_asset(self, asset):
+        self.clear_header('Pragma')
+        self.set_header('Cache-Control', 'private, max-age=%d' % STATIC_MAX_AGE_IN_S)
+        self.set_header('ETag', asset.etag)
+        for name, value in asset.headers.iteritems():
+            self.set_header(name, value)
+
+        if asset.matches(self.request.headers.get('If-None-Match', '')):
+            self.set_status(304)
+            self.finish()
+            return
+
+        encoding = self._negotiate_encoding(asset.headers.get('Content-Type'), len(asset.body))
+        if encoding:
+            self._set_content_encoding(encoding)
+            self.write(self._static_cache.encoded(asset, encoding, self.settings['compression'].compress))
+        else:
+            self.write(asset.body)
+        self.finish()
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    """Exposes the proxy metrics as JSON, only to clients on the same machine"""
+
+    def initialize(self, metrics, static_cache=None, scheduler=None, health=None, admission=None, tls=None):
+        self._metrics = metrics
+        self._admission = admission
+        self._tls = tls
+        self._static_cache = static_cache
+        self._scheduler = scheduler
+        self._health = health
+
+    def get(self):
+        if self.request.remote_ip not in LOOPBACK_ADDRESSES:
+            raise HTTPError(404)
+        stats = self._metrics.snapshot()
+        if self._static_cache:
+            stats['static_cache'] = self._static_cache.stats()
+        if self._scheduler:
+            stats['scheduler'] = self._scheduler.stats()
+        if self._health:
+            stats['circuits'] = self._health.stats()
+        if self._admission:
+            stats['admission'] = self._admission.stats()
+        if self._tls:
+            stats['tls'] = self._tls.snapshot()
+        self.set_header('Cache-Control', 'no-cache,no-store,must-revalidate,private')
+        self.write(stats)
+
 
 class AuthLoginHandler(BaseHandler):
 
@@ -221,13 +555,13 @@ class AuthLoginHandler(BaseHandler):
             logger.info('Starting agent for %s' % username)
             runtime = self._client.get_agent_runtime(username)
             if runtime['state'] != 'running':
-                self._client.start(username)
+                if runtime['state'] not in AGENT_COMING_UP_STATES:
+                    self._client.start(username)
 
                 # wait til agent is running
                 runtime = self._client.get_agent_runtime(username)
-                max_wait_seconds = TIMEOUT_WAIT_FOR_AGENT_TO_BE_UP
                 waited = 0
-                while runtime['state'] != 'running' and waited < max_wait_seconds:
+                while _agent_may_still_come_up(runtime, waited):
                     yield gen.Task(tornado.ioloop.IOLoop.current().add_timeout, time.time() + TIMEOUT_WAIT_STEP)
                     runtime = self._client.get_agent_runtime(username)
                     waited += TIMEOUT_WAIT_STEP
@@ -235,7 +569,6 @@ class AuthLoginHandler(BaseHandler):
                 # wait till agent is up and serving
                 if runtime['state'] == 'running':
                     yield gen.Task(self._wait_til_agent_is_up, runtime)
-                    port = runtime['port']
                     self.redirect(u'/')
                 else:
                     logger.warn('Agent not running, redirecting user to login page')
@@ -259,8 +592,11 @@ class AuthLoginHandler(BaseHandler):
         max_wait = TIMEOUT_WAIT_FOR_AGENT_TO_BE_UP
         waited = 0
         agent_up = False
-        port = agent_runtime['port']
-        url = 'http://127.0.0.1:%d/' % port
+        socket_path = agent_runtime.get('socket')
+        if socket_path:
+            url = 'http://localhost/'
+        else:
+            url = 'http://%s:%d/' % (agent_runtime.get('host', '127.0.0.1'), agent_runtime['port'])
 
         logger.error('Checking for user agent on url %s' % url)
         start = time.time()
@@ -273,7 +609,7 @@ class AuthLoginHandler(BaseHandler):
                 response = yield AsyncHTTPClient(force_instance=True).fetch(
                     tornado.httpclient.HTTPRequest(
                         connect_timeout=REQUEST_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
-                        url=url, allow_ipv6=False), _some_callback)
+                        url=url, allow_ipv6=False, prepare_curl_callback=_unix_socket_callback(socket_path)), _some_callback)
                 if response.code == 200:
                     logger.info('Got 200, agent seems to be up')
                     waited = max_wait
@@ -313,6 +649,25 @@ class StopServerThread(threading.Thread):
             raise
 
 
+class RestartServerThread(threading.Thread):
+    def __init__(self, client, agent_name):
+        threading.Thread.__init__(self)
+        self._client = client
+        self._agent_name = agent_name
+
+    def run(self):
+        try:
+            logger.info('Restarting agent of %s' % self._agent_name)
+            self._client.stop(self._agent_name)
+            waited = 0
+            while self._client.get_agent_runtime(self._agent_name)['state'] != 'stopped' and waited < TIMEOUT_WAIT_FOR_AGENT_TO_START:
+                time.sleep(TIMEOUT_WAIT_STEP)
+                waited += TIMEOUT_WAIT_STEP
+            self._client.start(self._agent_name)
+        except Exception, e:
+            logger.error('Error while restarting agent of %s: %s' % (self._agent_name, e))
+
+
 class AuthLogoutHandler(BaseHandler):
 
     def get(self):  # keep it for the tests
@@ -332,20 +687,65 @@ class AuthLogoutHandler(BaseHandler):
 
 
 class CachingStaticFileHandler(web.StaticFileHandler):
+    """ Serves the dispatcher's own static files.
+
+        If they got built with setup.py build_static, static_url refers to fingerprinted names
+        that are cached for a year, and gzipped variants are sent to clients accepting them.
+    """
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        fingerprinted = settings.get('static_manifest', {}).get(path)
+        if fingerprinted:
+            return settings.get('static_url_prefix', '/static/') + fingerprinted
+        return super(CachingStaticFileHandler, cls).make_static_url(settings, path, include_version)
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(CachingStaticFileHandler, self).validate_absolute_path(root, absolute_path)
+        self._precompressed = absolute_path is not None and os.path.isfile(absolute_path + '.gz')
+        if self._precompressed and self._accepts_gzip():
+            return absolute_path + '.gz'
+        return absolute_path
+
+    def _accepts_gzip(self):
+        accepted = parse_accept_encoding(self.request.headers.get('Accept-Encoding', ''))
+        return accepted.get('gzip', accepted.get('*', 0)) > 0
+
+    def _is_fingerprinted(self):
+        return self.path in self.settings.get('static_manifest', {}).values()
+
     def get_cache_time(self, path, modified, mime_type):
-        return 60 * 60 * 1
+        return IMMUTABLE_MAX_AGE_IN_S if self._is_fingerprinted() else 60 * 60 * 1
 
     def set_headers(self):
         super(CachingStaticFileHandler, self).set_headers()
+        if self._is_fingerprinted():
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE_IN_S)
+        if self._precompressed:
+            self.set_header('Vary', 'Accept-Encoding')
+            if self.absolute_path.endswith('.gz'):
+                self.set_header('Content-Encoding', 'gzip')
         self.set_header('X-XSS-Protection', '1; mode=block')
         self.set_header('X-Frame-Options', 'DENY')
         self.set_header('X-Content-Type-Options', 'nosniff')
 
 
 class DispatcherProxy(object):
-    __slots__ = ('_port', '_client', '_bindaddr', '_ioloop', '_certfile', '_keyfile', '_server', '_banner', '_debug')
-
-    def __init__(self, dispatcher_client, bindaddr='127.0.0.1', port=8080, certfile=None, keyfile=None, banner=None, debug=False):
+    __slots__ = ('_port', '_client', '_bindaddr', '_ioloop', '_certfile', '_keyfile', '_server', '_banner', '_debug', '_static_cache', '_metrics', '_compression', '_stream_prefixes', '_collapser', '_classifier', '_scheduler', '_health', '_admission',
+                 '_ecdh_curve', '_session_tickets', '_tls')
+
+    def __init__(self, dispatcher_client, bindaddr='127.0.0.1', port=8080, certfile=None, keyfile=None, banner=None, debug=False, static_cache_size=DEFAULT_CACHE_SIZE_IN_BYTES, static_prefixes=DEFAULT_STATIC_PREFIXES, compression_min_size=DEFAULT_MIN_SIZE_IN_BYTES, stream_prefixes=DEFAULT_STREAM_PREFIXES, collapse_requests=False,
+                 agent_concurrency=DEFAULT_AGENT_CONCURRENCY, background_patterns=DEFAULT_BACKGROUND_PATTERNS,
+                 circuit_failures=DEFAULT_FAILURE_THRESHOLD, circuit_reset=DEFAULT_RESET_TIMEOUT_IN_S, restart_hung_agents=False,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_requests_per_ip=DEFAULT_MAX_REQUESTS_PER_IP,
+                 header_timeout=DEFAULT_HEADER_TIMEOUT_IN_S, body_timeout=DEFAULT_BODY_TIMEOUT_IN_S, ecdh_curve=DEFAULT_ECDH_CURVE, session_tickets=True):
+        """ compression_min_size of None turns off compressing responses, requests below stream_prefixes may be held open by the agent.
+            With collapse_requests identical GETs of a user in flight at the same time get merged into one agent request.
+            At most agent_concurrency requests are sent to an agent at a time, interactive ones first. 0 means no limit.
+            After circuit_failures requests without answer, requests to the agent fail fast until it answers again, 0 turns that off.
+            Connections and requests per client address over the limits get a 503, 0 means unlimited.
+            TLS key exchange uses ecdh_curve, session_tickets=False leaves resumption to the server side session cache.
+        """
         self._port = port
         self._client = dispatcher_client
         self._bindaddr = bindaddr
@@ -355,27 +755,49 @@ class DispatcherProxy(object):
         self._ioloop = None
         self._server = None
         self._debug = debug
+        self._static_cache = StaticAssetCache(static_prefixes, max_size=static_cache_size) if static_cache_size else None
+        self._metrics = Metrics()
+        self._compression = Compression(compression_min_size, metrics=self._metrics) if compression_min_size is not None else None
+        self._stream_prefixes = stream_prefixes
+        self._collapser = RequestCollapser(self._metrics) if collapse_requests else None
+        self._classifier = RequestClassifier(background_patterns)
+        self._scheduler = UpstreamScheduler(agent_concurrency, self._metrics) if agent_concurrency else None
+        on_open = self._restart_agent if restart_hung_agents else None
+        self._health = AgentHealth(circuit_failures, circuit_reset, self._metrics, on_open=on_open) if circuit_failures else None
+        self._admission = Admission(max_connections, max_requests_per_ip, header_timeout, body_timeout, metrics=self._metrics)
+        self._ecdh_curve = ecdh_curve
+        self._session_tickets = session_tickets
+        self._tls = None
 
         AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
 
     def create_app(self):
+        static_manifest = load_static_manifest(STATIC_BUILD_PATH)
         app = tornado.web.Application(
             [
                 (r"/auth/login", AuthLoginHandler, dict(client=self._client, banner=self._banner)),
                 (r"/auth/logout", AuthLogoutHandler, dict(client=self._client)),
                 (r"/dispatcher_static/", CachingStaticFileHandler),
-                (r"/.*", MainHandler, dict(client=self._client))
+                (r"/dispatcher_stats", StatsHandler, dict(metrics=self._metrics, static_cache=self._static_cache, scheduler=self._scheduler, health=self._health,
+                                                               admission=self._admission, tls=self._tls)),
+                (r"/.*", MainHandler, dict(client=self._client, static_cache=self._static_cache, stream_prefixes=self._stream_prefixes, collapser=self._collapser,
+                                                  classifier=self._classifier, scheduler=self._scheduler, health=self._health))
             ],
             cookie_secret=base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes),
             login_url='/auth/login',
-            template_path=os.path.join(os.path.dirname(__file__), '..', 'files', "templates"),
-            static_path=os.path.join(os.path.dirname(__file__), '..', 'files', "static"),
+            template_path=os.path.join(FILES_PATH, "templates"),
+            static_path=STATIC_BUILD_PATH if static_manifest else STATIC_PATH,
+            static_manifest=static_manifest,
             static_url_prefix='/dispatcher_static/',  # needs to be bound to a different prefix as agent uses static
             static_handler_class=CachingStaticFileHandler,
             xsrf_cookies=False,
+            compression=self._compression,
             debug=self._debug)
         return app
 
+    def _restart_agent(self, agent_name):
+        RestartServerThread(self._client, agent_name).start()
+
     @property
     def ssl_options(self):
         if self._certfile:
@@ -390,14 +812,18 @@ class DispatcherProxy(object):
 
     def serve_forever(self):
         try:
-            app = self.create_app()
-            # app.listen(port=self._port, address=self._bindaddr, ssl_options=self.ssl_options)
-            if self.ssl_options:
-                logger.info('Using SSL certfile %s and keyfile %s' % (self.ssl_options['certfile'], self.ssl_options['keyfile']))
+            ssl_options = self.ssl_options
+            if ssl_options:
+                logger.info('Using SSL certfile %s and keyfile %s' % (ssl_options['certfile'], ssl_options['keyfile']))
+                ssl_context = create_ssl_context(ssl_options, self._ecdh_curve, self._session_tickets)
+                self._tls = TLSStats(ssl_context)
             else:
                 logger.warn('No SSL configured!')
+                ssl_context = None
+            app = self.create_app()
+            # app.listen(port=self._port, address=self._bindaddr, ssl_options=self.ssl_options)
             logger.info('Listening on %s:%d' % (self._bindaddr, self._port))
-            self._server = HTTPServer(app, ssl_options=self.ssl_options)
+            self._server = AdmissionHTTPServer(app, self._admission, ssl_options=ssl_context)
             self._server.listen(port=self._port, address=self._bindaddr)
             self._ioloop = tornado.ioloop.IOLoop.instance()
             self._ioloop.start()  # this is a blocking call, server has stopped on next line
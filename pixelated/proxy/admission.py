@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from tornado.httpserver import HTTPServer, HTTPConnection
+
+from pixelated.common import logger
+
+DEFAULT_MAX_CONNECTIONS = 1000
+DEFAULT_MAX_REQUESTS_PER_IP = 50
+DEFAULT_HEADER_TIMEOUT_IN_S = 20
+DEFAULT_BODY_TIMEOUT_IN_S = 60
+DEFAULT_RETRY_AFTER_IN_S = 5
+SERVICE_UNAVAILABLE = 'HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+class Admission(object):
+    """ Limits the connections of the proxy and the concurrent requests per client address.
+
+        A limit or timeout of 0 means unlimited. Only used from the proxy's IOLoop.
+    """
+
+    __slots__ = ('max_connections', 'max_requests_per_ip', 'header_timeout', 'body_timeout', 'retry_after', '_connections', '_requests', '_metrics')
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_requests_per_ip=DEFAULT_MAX_REQUESTS_PER_IP, header_timeout=DEFAULT_HEADER_TIMEOUT_IN_S,
+                 body_timeout=DEFAULT_BODY_TIMEOUT_IN_S, retry_after=DEFAULT_RETRY_AFTER_IN_S, metrics=None):
+        self.max_connections = max_connections
+        self.max_requests_per_ip = max_requests_per_ip
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.retry_after = retry_after
+        self._connections = 0
+        self._requests = {}
+        self._metrics = metrics
+
+    @property
+    def rejection(self):
+        return SERVICE_UNAVAILABLE % self.retry_after
+
+    def admit_connection(self):
+        if self.max_connections and self._connections >= self.max_connections:
+            self.count('admission.rejected.connections')
+            return False
+        self._connections += 1
+        return True
+
+    def connection_closed(self):
+        self._connections -= 1
+
+    def admit_request(self, ip):
+        requests = self._requests.get(ip, 0)
+        if self.max_requests_per_ip and requests >= self.max_requests_per_ip:
+            self.count('admission.rejected.requests')
+            return False
+        self._requests[ip] = requests + 1
+        return True
+
+    def request_finished(self, ip):
+        requests = self._requests.pop(ip, 0) - 1
+        if requests > 0:
+            self._requests[ip] = requests
+
+    def count(self, name):
+        if self._metrics:
+            self._metrics.count(name)
+
+    def stats(self):
+        return {'connections': self._connections, 'requests': sum(self._requests.itervalues()), 'clients': len(self._requests)}
+
+
+class AdmittedConnection(HTTPConnection):
+    """ HTTPConnection that counts against the admission limits.
+
+        Clients have header_timeout seconds to send the headers of a request, also while
+        idling between keep-alive requests, and body_timeout seconds for the body.
+        Connections of clients that are too slow get closed.
+    """
+
+    def __init__(self, stream, address, request_callback, no_keep_alive=False, xheaders=False, protocol=None, admission=None):
+        self._admission = admission
+        self._admitted_callback = request_callback
+        self._request_ip = None
+        self._timeout = None
+        HTTPConnection.__init__(self, stream, address, self._admit, no_keep_alive, xheaders, protocol)
+        self._start_timeout(admission.header_timeout, 'headers')
+
+    def _start_timeout(self, seconds, phase):
+        self._cancel_timeout()
+        if seconds and not self.stream.closed():
+            self._timeout = self.stream.io_loop.add_timeout(time.time() + seconds, lambda: self._on_timeout(phase))
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            self.stream.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _on_timeout(self, phase):
+        self._timeout = None
+        logger.info('Closing connection of %s, no request %s within time' % (self.address[0] if self.address else 'unknown', phase))
+        self._admission.count('admission.timeouts.%s' % phase)
+        self.close()
+
+    def _on_headers(self, data):
+        self._cancel_timeout()
+        HTTPConnection._on_headers(self, data)
+        if self._request is not None and self._request_ip is None and int(self._request.headers.get('Content-Length') or 0):
+            self._start_timeout(self._admission.body_timeout, 'body')  # still reading the body
+
+    def _admit(self, request):
+        self._cancel_timeout()
+        if not self._admission.admit_request(request.remote_ip):
+            self.no_keep_alive = True
+            request.write(self._admission.rejection)
+            request.finish()
+            return
+        self._request_ip = request.remote_ip
+        self._admitted_callback(request)
+
+    def _release_request(self):
+        if self._request_ip is not None:
+            self._admission.request_finished(self._request_ip)
+            self._request_ip = None
+
+    def _finish_request(self):
+        self._release_request()
+        HTTPConnection._finish_request(self)
+        self._start_timeout(self._admission.header_timeout, 'headers')
+
+    def _on_connection_close(self):
+        self._cancel_timeout()
+        self._release_request()
+        self._admission.connection_closed()
+        HTTPConnection._on_connection_close(self)
+
+
+class AdmissionHTTPServer(HTTPServer):
+    """HTTPServer that sheds connections over the admission limits with a 503"""
+
+    def __init__(self, request_callback, admission, **kwargs):
+        HTTPServer.__init__(self, request_callback, **kwargs)
+        self._admission = admission
+
+    def handle_stream(self, stream, address):
+        if not self._admission.admit_connection():
+            stream.write(self._admission.rejection, callback=stream.close)
+            return
+        AdmittedConnection(stream, address, self.request_callback, self.no_keep_alive, self.xheaders, self.protocol, admission=self._admission)
@@ -0,0 +1,132 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+
+from pixelated.common import logger
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT_IN_S = 30
+LATENCY_WEIGHT = 0.2  # of the newest sample in the moving average
+MAX_LATENCY_ENTRIES = 1000
+
+
+class _AgentState(object):
+    __slots__ = ('failures', 'address', 'opened_at')
+
+    def __init__(self, address):
+        self.failures = 0
+        self.address = address
+        self.opened_at = None
+
+
+class AgentHealth(object):
+    """ Circuit breaker for the agents behind the proxy.
+
+        After failure_threshold consecutive requests to an agent got no response, its
+        circuit opens and requests fail fast instead of waiting for the request timeout.
+        Every reset_timeout seconds the agent gets probed in the background, the circuit
+        closes as soon as a probe gets an answer. A request for an agent that moved to
+        another address, e.g. after a restart or migration, resets its circuit. Only agents
+        with failures are tracked. Only used from the proxy's IOLoop.
+    """
+
+    __slots__ = ('_failure_threshold', '_reset_timeout', '_agents', '_latencies', '_metrics', '_on_open', '_io_loop')
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT_IN_S, metrics=None, on_open=None, io_loop=None):
+        """on_open(agent) gets called whenever the circuit of an agent opens"""
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._agents = {}
+        self._latencies = OrderedDict()  # of the agents that answered last
+        self._metrics = metrics
+        self._on_open = on_open
+        self._io_loop = io_loop
+
+    def allow(self, agent, address=None):
+        state = self._agents.get(agent)
+        if state is not None and address is not None and state.address != address:
+            logger.info('Agent of %s moved to %s, resetting its circuit' % (agent, address))
+            self._forget(agent)
+            return True
+        return state is None or state.opened_at is None
+
+    def retry_after(self, agent):
+        """Seconds until the next probe of an agent with open circuit"""
+        state = self._agents[agent]
+        return max(1, int(state.opened_at + self._reset_timeout - time.time()))
+
+    def success(self, agent, latency):
+        previous = self._latencies.pop(agent, None)
+        self._latencies[agent] = latency if previous is None else (1 - LATENCY_WEIGHT) * previous + LATENCY_WEIGHT * latency
+        if len(self._latencies) > MAX_LATENCY_ENTRIES:
+            self._latencies.popitem(last=False)
+        state = self._agents.get(agent)
+        if state is not None and state.opened_at is not None:
+            self._close(agent)
+        else:
+            self._agents.pop(agent, None)
+
+    def failure(self, agent, probe, address=None):
+        """probe(callback) checks if the agent is back, calling callback(healthy). healthy is None if the agent is gone"""
+        state = self._agents.get(agent)
+        if state is None or (address is not None and state.address != address):
+            state = self._agents[agent] = _AgentState(address)
+        state.failures += 1
+        if state.opened_at is None and state.failures >= self._failure_threshold:
+            logger.warn('Agent of %s failed %d times in a row, failing its requests fast' % (agent, state.failures))
+            state.opened_at = time.time()
+            self._count('breaker.opened')
+            self._schedule_probe(agent, state, probe)
+            if self._on_open:
+                self._on_open(agent)
+
+    def _schedule_probe(self, agent, state, probe):
+        io_loop = self._io_loop or IOLoop.current()
+        io_loop.add_timeout(time.time() + self._reset_timeout, lambda: probe(lambda healthy: self._on_probed(agent, state, probe, healthy)))
+
+    def _on_probed(self, agent, state, probe, healthy):
+        if self._agents.get(agent) is not state or state.opened_at is None:
+            return  # closed or reset meanwhile
+        if healthy is None:
+            logger.info('Agent of %s is gone, forgetting its circuit' % agent)
+            self._forget(agent)
+        elif healthy:
+            self._close(agent)
+        else:
+            state.opened_at = time.time()
+            self._schedule_probe(agent, state, probe)
+
+    def _close(self, agent):
+        logger.info('Agent of %s is back, closing its circuit' % agent)
+        del self._agents[agent]
+        self._count('breaker.closed')
+
+    def _forget(self, agent):
+        del self._agents[agent]
+        self._count('breaker.reset')
+
+    def _count(self, name):
+        if self._metrics:
+            self._metrics.count(name)
+
+    def stats(self):
+        return {
+            'open': sorted(agent for agent, state in self._agents.iteritems() if state.opened_at is not None),
+            'latency': dict(self._latencies)
+        }
@@ -0,0 +1,58 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+
+# request headers the agent's answer may depend on, requests only get merged if all of them match
+KEY_HEADERS = ('Accept', 'Accept-Encoding', 'Accept-Language', 'Authorization', 'Cookie', 'If-Modified-Since', 'If-None-Match', 'Range', 'X-Requested-With', 'X-Xsrf-Token')
+
+
+class RequestCollapser(object):
+    """ Merges identical GETs of a user that are in flight at the same time.
+
+        The first request goes to the agent, the ones arriving before its response
+        wait for it and get the same response. Only used from the proxy's IOLoop,
+        so there is no locking.
+    """
+
+    __slots__ = ('_in_flight', '_metrics')
+
+    def __init__(self, metrics=None):
+        self._in_flight = {}
+        self._metrics = metrics
+
+    def key(self, user, request):
+        """Returns the key identical requests share or None if the request may not be merged"""
+        if request.method != 'GET' or not user:
+            return None
+        return (user, request.uri) + tuple(request.headers.get(name) for name in KEY_HEADERS)
+
+    def join(self, key, handler):
+        """Returns True if handler waits for an identical request in flight, False if it has to send it itself"""
+        waiters = self._in_flight.get(key)
+        if waiters is None:
+            self._in_flight[key] = []
+            self._count('collapsing.upstream')
+            return False
+        waiters.append(handler)
+        self._count('collapsing.collapsed')
+        return True
+
+    def complete(self, key):
+        """Ends the request in flight for key, returns the handlers waiting for its response"""
+        return self._in_flight.pop(key, [])
+
+    def _count(self, name):
+        if self._metrics:
+            self._metrics.count(name)
@@ -0,0 +1,162 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/x-javascript', 'application/xml', 'image/svg+xml')
+DEFAULT_MIN_SIZE_IN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def parse_accept_encoding(accept_encoding):
+    """Returns the encodings the client accepts, mapped to their quality"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding] = quality
+    return accepted
+
+
+class GzipEncoder(object):
+    __slots__ = ('_compressor',)
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def sync(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder(object):
+    __slots__ = ('_compressor',)
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def sync(self):
+        return self._compressor.flush()
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+ENCODERS = {'gzip': GzipEncoder, 'br': BrotliEncoder}
+
+
+class StreamCompressor(object):
+    """Compresses a streamed response chunk by chunk, every chunk can be decoded by the client as soon as it arrives"""
+
+    __slots__ = ('_compression', '_encoding', '_encoder', '_size', '_compressed_size', '_cpu_time')
+
+    def __init__(self, compression, encoding):
+        self._compression = compression
+        self._encoding = encoding
+        self._encoder = compression.encoder(encoding)
+        self._size = 0
+        self._compressed_size = 0
+        self._cpu_time = 0
+
+    def compress(self, chunk):
+        return self._measure(chunk, lambda: self._encoder.compress(chunk) + self._encoder.sync())
+
+    def finish(self):
+        compressed = self._measure('', self._encoder.flush)
+        self._compression.record(self._encoding, self._size, self._compressed_size, self._cpu_time)
+        return compressed
+
+    def _measure(self, chunk, compress):
+        start = time.clock()
+        compressed = compress()
+        self._cpu_time += time.clock() - start
+        self._size += len(chunk)
+        self._compressed_size += len(compressed)
+        return compressed
+
+
+class Compression(object):
+    """ Decides which responses get compressed and how.
+
+        Only compressible content types of at least min_size bytes are compressed, brotli
+        is preferred over gzip if the brotli module is installed. Streamed responses are
+        compressed chunk by chunk by a StreamCompressor, which flushes the encoder after every
+        chunk so events are not held back. The CPU time spent and the bytes saved are recorded
+        in the metrics.
+    """
+
+    __slots__ = ('_min_size', '_encodings', '_metrics')
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE_IN_BYTES, use_brotli=True, metrics=None):
+        self._min_size = min_size
+        self._encodings = ('br', 'gzip') if use_brotli and brotli else ('gzip',)
+        self._metrics = metrics
+
+    def negotiate(self, accept_encoding, content_type, length=None):
+        """Returns the encoding to use or None if the response should be sent as is. A length of None means unknown, e.g. streamed"""
+        if length is not None and length < self._min_size:
+            return None
+        if not content_type or not content_type.split(';')[0].strip().lower().startswith(COMPRESSIBLE_TYPES):
+            return None
+        accepted = parse_accept_encoding(accept_encoding or '')
+        for encoding in self._encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
+    def encoder(self, encoding):
+        return ENCODERS[encoding]()
+
+    def stream(self, encoding):
+        return StreamCompressor(self, encoding)
+
+    def compress(self, encoding, data):
+        start = time.clock()
+        encoder = self.encoder(encoding)
+        compressed = encoder.compress(data) + encoder.flush()
+        self.record(encoding, len(data), len(compressed), time.clock() - start)
+        return compressed
+
+    def record(self, encoding, size, compressed_size, cpu_time):
+        if self._metrics:
+            self._metrics.count('compression.%s.responses' % encoding)
+            self._metrics.count('compression.%s.bytes_in' % encoding, size)
+            self._metrics.count('compression.%s.bytes_out' % encoding, compressed_size)
+            self._metrics.time('compression.%s.cpu' % encoding, cpu_time)
@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import re
+import time
+from collections import deque
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+PRIORITIES = (INTERACTIVE, BACKGROUND)  # highest first
+PRIORITY_HEADER = 'X-Pixelated-Priority'
+PREFETCH_HEADERS = ('Purpose', 'Sec-Purpose', 'X-Moz')
+DEFAULT_AGENT_CONCURRENCY = 6
+DEFAULT_BACKGROUND_PATTERNS = ()
+
+
+class RequestClassifier(object):
+    """ Puts requests into priority classes.
+
+        An explicit X-Pixelated-Priority header wins. Prefetches and XHR requests whose
+        uri matches one of the background patterns, e.g. timer driven polls, are background
+        requests. Everything else is interactive.
+    """
+
+    __slots__ = ('_background_patterns',)
+
+    def __init__(self, background_patterns=DEFAULT_BACKGROUND_PATTERNS):
+        self._background_patterns = [re.compile(pattern) for pattern in background_patterns]
+
+    def classify(self, request):
+        priority = request.headers.get(PRIORITY_HEADER, '').strip().lower()
+        if priority in PRIORITIES:
+            return priority
+        if any('prefetch' in request.headers.get(name, '').lower() for name in PREFETCH_HEADERS):
+            return BACKGROUND
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest' and any(pattern.search(request.uri) for pattern in self._background_patterns):
+            return BACKGROUND
+        return INTERACTIVE
+
+
+class _AgentQueue(object):
+    __slots__ = ('in_flight', 'waiting')
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiting = dict((priority, deque()) for priority in PRIORITIES)
+
+    def next(self):
+        for priority in PRIORITIES:
+            if self.waiting[priority]:
+                return (priority,) + self.waiting[priority].popleft()
+        return None
+
+
+class UpstreamScheduler(object):
+    """ Limits the requests in flight per agent, the ones over the limit wait in the proxy.
+
+        Whenever an agent request completes, the oldest waiting request of the highest
+        priority class gets sent next. Interactive requests follow user actions, so background
+        ones cannot starve for long. Only used from the proxy's IOLoop, so there is no locking.
+    """
+
+    __slots__ = ('_max_in_flight', '_agents', '_metrics')
+
+    def __init__(self, max_in_flight=DEFAULT_AGENT_CONCURRENCY, metrics=None):
+        self._max_in_flight = max_in_flight
+        self._agents = {}
+        self._metrics = metrics
+
+    def submit(self, agent, priority, start):
+        """Calls start once the agent has a free slot, the caller has to release it when done"""
+        queue = self._agents.setdefault(agent, _AgentQueue())
+        self._count('priority.%s.requests' % priority)
+        if queue.in_flight < self._max_in_flight:
+            queue.in_flight += 1
+            self._start(priority, start, time.time())
+        else:
+            queue.waiting[priority].append((start, time.time()))
+
+    def release(self, agent, priority, submitted_at):
+        """Frees the slot of a request submitted at submitted_at, recording its latency"""
+        if self._metrics:
+            self._metrics.time('priority.%s.latency' % priority, time.time() - submitted_at)
+        queue = self._agents.get(agent)
+        if queue is None:
+            return
+        queue.in_flight -= 1
+        waiting = queue.next()
+        if waiting:
+            queue.in_flight += 1
+            self._start(*waiting)
+        elif queue.in_flight <= 0:
+            del self._agents[agent]
+
+    def _start(self, priority, start, queued_at):
+        if self._metrics:
+            self._metrics.time('priority.%s.queue_wait' % priority, time.time() - queued_at)
+        start()
+
+    def _count(self, name):
+        if self._metrics:
+            self._metrics.count(name)
+
+    def stats(self):
+        waiting = dict((priority, 0) for priority in PRIORITIES)
+        in_flight = 0
+        for queue in self._agents.itervalues():
+            in_flight += queue.in_flight
+            for priority in PRIORITIES:
+                waiting[priority] += len(queue.waiting[priority])
+        return {'agents': len(self._agents), 'in_flight': in_flight, 'waiting': waiting}
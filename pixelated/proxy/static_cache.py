@@ -0,0 +1,126 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+from hashlib import md5
+
+DEFAULT_STATIC_PREFIXES = ('/assets/', '/bower_components/', '/css/', '/fonts/', '/images/', '/js/')
+DEFAULT_CACHE_SIZE_IN_BYTES = 64 * 1024 * 1024
+MAX_ENTRY_SIZE_IN_BYTES = 4 * 1024 * 1024
+STATIC_MAX_AGE_IN_S = 24 * 60 * 60
+CACHED_HEADERS = ('Content-Type', 'Last-Modified')
+UNCACHEABLE_DIRECTIVES = ('private', 'no-store', 'no-cache')
+
+
+class CachedAsset(object):
+    __slots__ = ('body', 'headers', 'etag', 'encoded')
+
+    def __init__(self, version, body, headers):
+        self.body = body
+        self.headers = headers
+        self.etag = '"%s-%s"' % (version, md5(body).hexdigest())
+        self.encoded = {}  # compressed variants of the body by content encoding
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body) for body in self.encoded.itervalues())
+
+    def matches(self, if_none_match):
+        """Tells if the etag is one of the whole, possibly weak, tags of an If-None-Match header"""
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == self.etag:
+                return True
+        return False
+
+
+def _header_tokens(value):
+    return [token.split('=', 1)[0].strip().lower() for token in value.split(',') if token.strip()]
+
+
+def _may_be_shared(headers):
+    """Only responses that are neither private to a user nor vary by more than the encoding may be shared"""
+    if any(directive in UNCACHEABLE_DIRECTIVES for directive in _header_tokens(headers.get('Cache-Control', ''))):
+        return False
+    return all(name == 'accept-encoding' for name in _header_tokens(headers.get('Vary', '')))
+
+
+class StaticAssetCache(object):
+    """ LRU cache for the static assets of agents, shared by all users.
+
+        All agents running the same image serve the same assets, so they are keyed by
+        image version and uri. Only uris below the static prefixes get cached.
+    """
+
+    __slots__ = ('_prefixes', '_max_size', '_max_entry_size', '_entries', '_size', '_hits', '_misses')
+
+    def __init__(self, prefixes=DEFAULT_STATIC_PREFIXES, max_size=DEFAULT_CACHE_SIZE_IN_BYTES, max_entry_size=MAX_ENTRY_SIZE_IN_BYTES):
+        self._prefixes = tuple(prefixes)
+        self._max_size = max_size
+        self._max_entry_size = min(max_entry_size, max_size)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    def is_static(self, uri):
+        return uri.startswith(self._prefixes)
+
+    def get(self, version, uri):
+        asset = self._entries.pop((version, uri), None)
+        if asset is None:
+            self._misses += 1
+            return None
+        self._entries[(version, uri)] = asset  # most recently used go last
+        self._hits += 1
+        return asset
+
+    def put(self, version, uri, response):
+        """Caches a successful agent response, returns the cached asset or None if it may not be cached"""
+        if response.code != 200 or 'Set-Cookie' in response.headers or response.headers.get('Content-Encoding', 'identity') != 'identity':
+            return None
+        if not _may_be_shared(response.headers):
+            return None
+        body = response.body or ''
+        if len(body) > self._max_entry_size:
+            return None
+
+        headers = dict((name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers)
+        asset = CachedAsset(version, body, headers)
+        old = self._entries.pop((version, uri), None)
+        if old is not None:
+            self._size -= old.size
+        self._entries[(version, uri)] = asset
+        self._size += asset.size
+        self._evict()
+        return asset
+
+    def encoded(self, asset, encoding, compress):
+        """Returns the asset body compressed with encoding, compressing it only once"""
+        body = asset.encoded.get(encoding)
+        if body is None:
+            body = compress(encoding, asset.body)
+            asset.encoded[encoding] = body
+            self._size += len(body)
+            self._evict()
+        return body
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            key, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self._size, 'hits': self._hits, 'misses': self._misses}
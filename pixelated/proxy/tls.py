@@ -0,0 +1,64 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import ssl
+import time
+
+DEFAULT_ECDH_CURVE = 'prime256v1'
+OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)  # not exported by python 2's ssl module
+OP_NO_COMPRESSION = getattr(ssl, 'OP_NO_COMPRESSION', 0x20000)
+
+
+def create_ssl_context(ssl_options, ecdh_curve=DEFAULT_ECDH_CURVE, session_tickets=True):
+    """ Builds the server context for the tornado ssl_options dict (certfile, keyfile, ssl_version, ciphers).
+
+        The context is created once, so the OpenSSL session cache and the session ticket key
+        live as long as the proxy and returning clients can resume their sessions with an
+        abbreviated handshake.
+    """
+    context = ssl.SSLContext(ssl_options['ssl_version'])
+    context.load_cert_chain(ssl_options['certfile'], ssl_options.get('keyfile'))
+    context.set_ciphers(ssl_options['ciphers'])
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_SINGLE_ECDH_USE | OP_NO_COMPRESSION
+    if ecdh_curve:
+        context.set_ecdh_curve(ecdh_curve)
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+    return context
+
+
+class TLSStats(object):
+    """Handshake rate and session resumption ratio of a server context"""
+
+    __slots__ = ('_context', '_last_time', '_last_handshakes')
+
+    def __init__(self, context):
+        self._context = context
+        self._last_time = time.time()
+        self._last_handshakes = 0
+
+    def snapshot(self):
+        stats = self._context.session_stats()
+        handshakes = stats['accept_good']
+        now = time.time()
+        rate = (handshakes - self._last_handshakes) / max(now - self._last_time, 1e-6)
+        self._last_time, self._last_handshakes = now, handshakes
+        return {
+            'handshakes': handshakes,
+            'resumed': stats['hits'],
+            'resumption_ratio': float(stats['hits']) / handshakes if handshakes else 0.0,
+            'handshakes_per_second': rate,  # since the previous snapshot
+            'session_cache': {'size': stats['number'], 'misses': stats['misses'], 'timeouts': stats['timeouts'], 'full': stats['cache_full']}
+        }
@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import socket
+
+from tornado.iostream import IOStream
+
+from pixelated.common import logger
+
+
+def is_websocket_upgrade(request):
+    connection = [token.strip().lower() for token in request.headers.get('Connection', '').split(',')]
+    return request.method == 'GET' and request.headers.get('Upgrade', '').lower() == 'websocket' and 'upgrade' in connection
+
+
+def request_head(request):
+    """Serializes the request line and headers of request, including the hop-by-hop ones the upgrade needs"""
+    lines = ['%s %s HTTP/1.1' % (request.method, request.uri)]
+    lines.extend('%s: %s' % (name, value) for name, value in request.headers.get_all())
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+class Tunnel(object):
+    """ Pipes the raw bytes of an upgraded client connection to an agent and back.
+
+        The agent answers the forwarded upgrade request itself, from then on the proxy
+        does not look at the traffic anymore. Once either side closes, the other one
+        gets closed as soon as everything received so far is written to it.
+    """
+
+    __slots__ = ('_client', '_agent', '_on_failure', '_connected')
+
+    def __init__(self, client_stream, on_failure):
+        self._client = client_stream
+        self._agent = None
+        self._on_failure = on_failure
+        self._connected = False
+
+    def open(self, address, head):
+        """Connects to the agent at address, a (host, port) tuple or a unix socket path, and sends head"""
+        family = socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET
+        self._agent = IOStream(socket.socket(family, socket.SOCK_STREAM))
+        self._agent.set_close_callback(self._on_agent_closed)
+        self._agent.connect(address, lambda: self._on_connected(head))
+
+    def _on_connected(self, head):
+        self._connected = True
+        self._agent.write(head)
+        self._client.read_until_close(lambda data: self._close_when_written(self._agent), streaming_callback=self._pipe_to(self._agent))
+        self._agent.read_until_close(lambda data: self._close_when_written(self._client), streaming_callback=self._pipe_to(self._client))
+
+    def _pipe_to(self, stream):
+        def pipe(data):
+            if data and not stream.closed():
+                stream.write(data)
+        return pipe
+
+    def _close_when_written(self, stream):
+        if not stream.closed():
+            stream.write('', callback=stream.close)
+
+    def _on_agent_closed(self):
+        if not self._connected:
+            logger.error('Could not open tunnel to agent: %s' % self._agent.error)
+            self._on_failure()
+
+    def close(self):
+        for stream in (self._client, self._agent):
+            if stream and not stream.closed():
+                stream.close()
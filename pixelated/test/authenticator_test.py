@@ -14,12 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import unittest
+from threading import Event, Thread
 
 from mock import MagicMock, patch
 
 from pixelated.exceptions import UserNotExistError
 from pixelated.users import Users, UserConfig
-from pixelated.authenticator import Authenticator
+from pixelated.authenticator import Authenticator, PasswordHashingPool, HashingBusyError, hash_password
 from pixelated.bitmask_libraries.leap_config import LeapConfig
 from pixelated.bitmask_libraries.leap_provider import LeapProvider
 from leap.auth import SRPAuth
@@ -142,3 +143,101 @@ class AuthenticatorTest(unittest.TestCase):
         srp_mock.return_value.authenticate.assert_called_once_with('name', 'password')
         self.users.update_config.assert_called_once_with(user_config)
         self.assertTrue(result)
+
+    def test_passwords_get_hashed_by_the_hashing_pool(self):
+        cfg = UserConfig('name', None)
+        cfg['auth.salt'] = 'some salt'
+        cfg['auth.hashed_password'] = 'some hash'
+        self.users.has_user_config.return_value = True
+        self.users.config.return_value = cfg
+        hashing_pool = MagicMock(spec=PasswordHashingPool)
+        hashing_pool.hash.return_value = 'some hash'
+
+        auth = Authenticator(self.users, self.provider, hashing_pool=hashing_pool)
+
+        self.assertTrue(auth.authenticate('name', 'password'))
+        hashing_pool.hash.assert_called_once_with('password', 'some salt', shed=True)
+
+    def test_adding_credentials_waits_for_the_hashing_pool(self):
+        self.users.config.return_value = UserConfig('name', None)
+        hashing_pool = MagicMock(spec=PasswordHashingPool)
+        hashing_pool.hash.return_value = 'some hash'
+
+        Authenticator(self.users, self.provider, hashing_pool=hashing_pool).add_credentials('name', 'password')
+
+        self.assertFalse(hashing_pool.hash.call_args[1]['shed'])
+
+
+class PasswordHashingPoolTest(unittest.TestCase):
+
+    def test_hashes_on_worker_threads(self):
+        hashing_pool = PasswordHashingPool(workers=1)
+        try:
+            self.assertEqual(hash_password(u'password', 'some salt'), hashing_pool.hash(u'password', 'some salt'))
+        finally:
+            hashing_pool.shutdown()
+
+    @patch('pixelated.authenticator.hash_password')
+    def test_logins_over_the_queue_limit_fail_fast(self, hash_mock):
+        release = Event()
+
+        def slow_hash(password, salt):
+            release.wait()
+            return 'some hash'
+        hash_mock.side_effect = slow_hash
+        hashing_pool = PasswordHashingPool(workers=1, max_pending=1)
+        try:
+            pending = Thread(target=hashing_pool.hash, args=('password', 'some salt'))
+            pending.start()
+            while not hashing_pool.stats()['pending']:
+                pass
+
+            self.assertRaises(HashingBusyError, hashing_pool.hash, 'password', 'some salt')
+
+            release.set()
+            pending.join()
+            self.assertEqual('some hash', hashing_pool.hash('password', 'some salt'))
+            self.assertEqual(0, hashing_pool.stats()['pending'])
+        finally:
+            release.set()
+            hashing_pool.shutdown()
+
+    @patch('pixelated.authenticator.HASH_TIMEOUT_IN_S', 0.01)
+    @patch('pixelated.authenticator.hash_password')
+    def test_timed_out_hash_stays_pending_until_its_worker_finished(self, hash_mock):
+        release = Event()
+
+        def slow_hash(password, salt):
+            release.wait()
+            return 'some hash'
+        hash_mock.side_effect = slow_hash
+        hashing_pool = PasswordHashingPool(workers=1, max_pending=1)
+        try:
+            self.assertRaises(HashingBusyError, hashing_pool.hash, 'password', 'some salt')
+            self.assertEqual(1, hashing_pool.stats()['pending'])
+            self.assertRaises(HashingBusyError, hashing_pool.hash, 'password', 'some salt')
+
+            release.set()
+            while hashing_pool.stats()['pending']:
+                pass
+            self.assertEqual('some hash', hashing_pool.hash('password', 'some salt'))
+        finally:
+            release.set()
+            hashing_pool.shutdown()
+
+    @patch('pixelated.authenticator.hash_password')
+    def test_adding_credentials_is_not_shed(self, hash_mock):
+        hash_mock.return_value = 'some hash'
+        hashing_pool = PasswordHashingPool(workers=1, max_pending=0)
+        try:
+            self.assertEqual('some hash', hashing_pool.hash('password', 'some salt', shed=False))
+            self.assertEqual(0, hashing_pool.stats()['pending'])
+        finally:
+            hashing_pool.shutdown()
+
+    def test_authenticator_exposes_hashing_stats(self):
+        hashing_pool = MagicMock(spec=PasswordHashingPool)
+        hashing_pool.stats.return_value = {'pending': 0, 'max_pending': 4}
+
+        self.assertEqual({'pending': 0, 'max_pending': 4}, Authenticator(MagicMock(), MagicMock(), hashing_pool=hashing_pool).hashing_stats())
+        self.assertIsNone(Authenticator(MagicMock(), MagicMock()).hashing_stats())
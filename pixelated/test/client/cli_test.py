@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import StringIO
+from tempfile import NamedTemporaryFile
 
 from mock import MagicMock, patch
 
@@ -47,12 +48,12 @@ class CliTest(unittest.TestCase):
 
     def test_cli_supports_running(self):
         self.apimock.list.return_value = [
-            {'name': 'first', 'state': 'stopped', 'uri': 'https://localhost:12345/agents/first'},
             {'name': 'second', 'state': 'running', 'uri': 'https://localhost:12345/agents/second'},
         ]
 
         Cli(['running'], out=self.buffer).run()
 
+        self.apimock.list.assert_called_once_with(state='running')
         self.assertEqual('second\n', self.buffer.getvalue())
 
     @patch('getpass.getpass')
@@ -73,6 +74,35 @@ class CliTest(unittest.TestCase):
 
         self.apimock.stop.assert_called_once_with('first')
 
+    def test_cli_supports_starting_multiple_agents(self):
+        self.apimock.batch.return_value = [{'name': 'first', 'status': 202, 'job': {'id': 'some-job'}}, {'name': 'second', 'status': 409, 'message': 'already running'}]
+        self.apimock.wait_for_job.return_value = {'id': 'some-job', 'status': 'succeeded', 'error': None}
+
+        Cli(['start', 'first', 'second'], out=self.buffer).run()
+
+        self.apimock.batch.assert_called_once_with('start', ['first', 'second'])
+        self.apimock.wait_for_job.assert_called_once_with('some-job')
+        self.assertEqual('first:\tsucceeded\nsecond:\tfailed (409) already running\n', self.buffer.getvalue())
+
+    def test_cli_reads_agent_names_from_file(self):
+        self.apimock.batch.return_value = []
+
+        with NamedTemporaryFile() as names_file:
+            names_file.write('first\n\nsecond\n')
+            names_file.flush()
+
+            Cli(['stop', '--file', names_file.name], out=self.buffer).run()
+
+        self.apimock.batch.assert_called_once_with('stop', ['first', 'second'])
+
+    @patch('sys.stderr')
+    def test_cli_needs_names_for_start_and_stop(self, stderr_mock):
+        Cli(['start'], out=self.buffer).run()
+        Cli(['stop'], out=self.buffer).run()
+
+        self.assertFalse(self.apimock.batch.called)
+        self.assertFalse(self.apimock.start.called)
+
     def test_supports_info_running(self):
         self.apimock.get_agent_runtime.return_value = {'state': 'running', 'port': 1234}
 
@@ -89,6 +119,64 @@ class CliTest(unittest.TestCase):
         self.apimock.get_agent_runtime.assert_called_once_with('first')
         self.assertEqual('Not running\n', self.buffer.getvalue())
 
+    def test_supports_info_starting(self):
+        self.apimock.get_agent_runtime.return_value = {'state': 'starting'}
+
+        Cli(['info', 'first'], out=self.buffer).run()
+
+        self.assertEqual('Starting\n', self.buffer.getvalue())
+
+    def test_cli_waits_for_start_to_finish(self):
+        self.apimock.start.return_value = {'state': 'starting', 'job': {'id': 'some-job', 'status': 'pending'}}
+        self.apimock.wait_for_job.return_value = {'id': 'some-job', 'status': 'failed', 'error': 'Not enough memory'}
+
+        Cli(['start', '--wait', 'first'], out=self.buffer).run()
+
+        self.apimock.wait_for_job.assert_called_once_with('some-job')
+        self.assertEqual('first:\tfailed Not enough memory\n', self.buffer.getvalue())
+
+    def test_migrate(self):
+        self.apimock.migrate.return_value = {'state': 'running', 'job': {'id': 'some-job', 'status': 'pending'}}
+        self.apimock.wait_for_job.return_value = {'id': 'some-job', 'status': 'succeeded', 'error': None}
+
+        Cli(['migrate', '--force', '--wait', 'first', '10.0.0.2'], out=self.buffer).run()
+
+        self.apimock.migrate.assert_called_once_with('first', '10.0.0.2', force=True)
+        self.assertEqual('first:\tsucceeded\n', self.buffer.getvalue())
+
+    def test_rebalance_dry_run_only_shows_plan(self):
+        self.apimock.rebalance_plan.return_value = [{'agent': 'first', 'source': 'one', 'target': 'two'}]
+
+        Cli(['rebalance', '--dry-run', '--watermark', '0.7'], out=self.buffer).run()
+
+        self.apimock.rebalance_plan.assert_called_once_with(0.7)
+        self.assertFalse(self.apimock.rebalance.called)
+        self.assertEqual('first:\tone -> two\n', self.buffer.getvalue())
+
+    def test_rebalance(self):
+        self.apimock.rebalance.return_value = [{'agent': 'first', 'source': 'one', 'target': 'two', 'job': {}}, {'agent': 'second', 'source': 'one', 'target': 'two', 'error': 'busy'}]
+
+        Cli(['rebalance'], out=self.buffer).run()
+
+        self.apimock.rebalance.assert_called_once_with(None)
+        self.assertEqual('first:\tone -> two\nsecond:\tone -> two\tfailed busy\n', self.buffer.getvalue())
+
+    def test_drain(self):
+        self.apimock.drain.return_value = {'state': 'draining', 'started': 1000, 'grace_period': 60, 'remaining_grace_period': 42, 'initial_agents': 3, 'running_agents': 2, 'stopped_agents': 1}
+
+        Cli(['drain', '--grace-period', '60'], out=self.buffer).run()
+
+        self.apimock.drain.assert_called_once_with(60)
+        self.assertEqual('state:\tdraining\nagents:\t1 of 3 stopped, 2 running\ngrace period:\t42s left\n', self.buffer.getvalue())
+
+    def test_drain_cancel(self):
+        self.apimock.cancel_drain.return_value = {'state': 'off'}
+
+        Cli(['drain', '--cancel'], out=self.buffer).run()
+
+        self.assertEqual('state:\toff\n', self.buffer.getvalue())
+        self.assertFalse(self.apimock.drain.called)
+
     def test_memory_usage(self):
         self.apimock.memory_usage.return_value = {'total_usage': 1234, 'average_usage': 1234, 'agents': [{'name': 'testagent', 'memory_usage': 1234}]}
 
@@ -119,12 +207,22 @@ class CliTest(unittest.TestCase):
         self.assertEqual('first\n', self.buffer.getvalue())
         self.assertFalse(self._last_ssl)
 
+    def test_multiple_managers(self):
+        self.apimock.list.return_value = []
+
+        Cli(['--manager', 'one:4449,two:4450', 'list'], out=self.buffer).run()
+
+        self.assertEqual('one', self._last_host)
+        self.assertEqual([('two', 4450)], self._last_endpoints)
+
     def _override_create_cli(self):
         mock = self.apimock
         running_test = self
         running_test._last_cacert = None
 
-        def override_create_cli(self, host, port, cacert, ssl, fingerprint):
+        def override_create_cli(self, host, port, cacert, ssl, fingerprint, endpoints=None):
+            running_test._last_host = host
+            running_test._last_endpoints = endpoints
             running_test._last_cacert = cacert
             running_test._last_ssl = ssl
             return mock
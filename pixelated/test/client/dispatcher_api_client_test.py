@@ -18,7 +18,7 @@ import unittest
 from requests.exceptions import ConnectionError
 from httmock import HTTMock, all_requests, urlmatch
 from mock import patch, ANY
-from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient, PixelatedHTTPError, PixelatedNotAvailableHTTPError, VERIFY_HOSTNAME
+from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient, PixelatedHTTPError, PixelatedNotAvailableHTTPError, VERIFY_HOSTNAME, JOB_POLL_INTERVAL_IN_S
 
 
 __author__ = 'fbernitt'
@@ -67,24 +67,55 @@ class MultipileClientTest(unittest.TestCase):
 
         with HTTMock(list_agents, not_found_handler):
             agents = self.client.list()
-            self.assertEqual(expected, agents)
+            self.assertEqual(expected, list(agents))
 
     def test_running(self):
         expected = [
-            {'name': 'first', 'state': 'stopped', 'uri': 'https://localhost:12345/agents/first'},
-            {'name': 'second', 'state': 'stopped', 'uri': 'https://localhost:12345/agents/second'},
+            {'name': 'second', 'state': 'running', 'uri': 'https://localhost:12345/agents/second'},
         ]
 
         @urlmatch(path='/agents')
         def list_agents(url, request):
+            if 'state=running' not in url.query:
+                return {'status_code': 400}
             return {
                 'status_code': 200,
                 'content': {'agents': expected}
             }
 
         with HTTMock(list_agents, not_found_handler):
-            agents = self.client.list()
-            self.assertEqual(expected, agents)
+            agents = self.client.list(state='running')
+            self.assertEqual(expected, list(agents))
+
+    def test_list_fetches_further_pages_lazily(self):
+        pages = {
+            'limit=1': {'agents': [{'name': 'first'}], 'next': 'first'},
+            'cursor=first&limit=1': {'agents': [{'name': 'second'}], 'next': 'second'},
+            'cursor=second&limit=1': {'agents': []}
+        }
+        self.requested = []
+
+        @urlmatch(path='/agents')
+        def list_agents(url, request):
+            self.requested.append(url.query)
+            return {'status_code': 200, 'content': pages[url.query]}
+
+        with HTTMock(list_agents, not_found_handler):
+            agents = self.client.list(page_size=1)
+            self.assertEqual(['limit=1'], self.requested)
+
+            self.assertEqual([{'name': 'first'}, {'name': 'second'}], list(agents))
+            self.assertEqual(['limit=1', 'cursor=first&limit=1', 'cursor=second&limit=1'], self.requested)
+
+    def test_list_passes_filters(self):
+        @urlmatch(path='/agents')
+        def list_agents(url, request):
+            if url.query != 'limit=500&prefix=fi&state=running':
+                return {'status_code': 400}
+            return {'status_code': 200, 'content': {'agents': [{'name': 'first'}]}}
+
+        with HTTMock(list_agents, not_found_handler):
+            self.assertEqual([{'name': 'first'}], list(self.client.list(state='running', prefix='fi')))
 
     def test_get_agent(self):
         expected = {'name': 'first', 'state': 'stopped', 'uri': 'https://localhost:12345/agents/first'}
@@ -186,6 +217,44 @@ class MultipileClientTest(unittest.TestCase):
             usage = self.client.memory_usage()
             self.assertEqual(expected, usage)
 
+    def test_batch(self):
+        expected = [{'name': 'first', 'status': 200, 'state': 'running'}, {'name': 'second', 'status': 404, 'message': 'unknown'}]
+
+        @urlmatch(path=r'^/batch$', method='POST')
+        def batch(url, request):
+            if request.body != '{"action": "start", "agents": ["first", "second"]}':
+                return {'status_code': 400}
+            return {'status_code': 200, 'content': {'results': expected}}
+
+        with HTTMock(batch, not_found_handler):
+            self.assertEqual(expected, self.client.batch('start', ['first', 'second']))
+
+    @patch('pixelated.client.dispatcher_api_client.time.sleep')
+    def test_wait_for_job_backs_off_when_manager_answers_right_away(self, sleep_mock):
+        responses = [{'id': 'some-job', 'status': 'running', 'error': None}, {'id': 'some-job', 'status': 'succeeded', 'error': None}]
+
+        @urlmatch(path=r'^/jobs/some-job/wait$')
+        def wait_for_job(url, request):
+            return {'status_code': 202 if len(responses) > 1 else 200, 'content': responses.pop(0)}
+
+        with HTTMock(wait_for_job, not_found_handler):
+            self.assertEqual('succeeded', self.client.wait_for_job('some-job')['status'])
+
+        sleep_mock.assert_called_once_with(JOB_POLL_INTERVAL_IN_S)
+
+    def test_wait_for_job_until_finished(self):
+        responses = [{'id': 'some-job', 'status': 'running', 'error': None}, {'id': 'some-job', 'status': 'succeeded', 'error': None}]
+
+        @urlmatch(path=r'^/jobs/some-job/wait$')
+        def wait_for_job(url, request):
+            return {'status_code': 202 if len(responses) > 1 else 200, 'content': responses.pop(0)}
+
+        with HTTMock(wait_for_job, not_found_handler):
+            job = self.client.wait_for_job('some-job')
+
+        self.assertEqual('succeeded', job['status'])
+        self.assertEqual([], responses)
+
     @patch('requests.Session')
     def test_that_certificates_are_verified_by_default(self, requests_mock):
         session = requests_mock.return_value
@@ -203,13 +272,13 @@ class MultipileClientTest(unittest.TestCase):
 
     def _assert_cacert_used(self, session, cacert):
         self.client.list()
-        session.get.assert_called_once_with('https://localhost:12345/agents', verify=cacert)
+        session.get.assert_called_once_with('https://localhost:12345/agents?limit=500', verify=cacert, timeout=30)
 
         self.client.add('test', 'password')
-        session.post.assert_called_once_with('https://localhost:12345/agents', verify=cacert, data='{"password": "password", "name": "test"}', headers={'Content-Type': 'application/json'})
+        session.post.assert_called_once_with('https://localhost:12345/agents', verify=cacert, data='{"password": "password", "name": "test"}', headers={'Content-Type': 'application/json'}, timeout=30)
 
         self.client.start('test')
-        session.put.assert_called_once_with('https://localhost:12345/agents/test/state', verify=cacert, data='{"state": "running"}', headers={'Content-Type': 'application/json'})
+        session.put.assert_called_once_with('https://localhost:12345/agents/test/state', verify=cacert, data='{"state": "running"}', headers={'Content-Type': 'application/json'}, timeout=30)
 
     def test_that_call_without_ssl_is_possible(self):
         self.client = PixelatedDispatcherClient('localhost', 12345, ssl=False)
@@ -247,10 +316,159 @@ class MultipileClientTest(unittest.TestCase):
         self.client.validate_connection()
 
         session.mount.assert_called_once_with('https://', ANY)
-        session.get.assert_called_once_with('https://localhost:12345/agents', verify=some_ca)
+        session.get.assert_called_once_with('https://localhost:12345/agents?limit=1', verify=some_ca, timeout=30)
         adapter = session.mount.call_args[0][1]
         self.assertEqual(some_fingerprint, adapter._assert_fingerprint)
 
+    @patch('requests.Session')
+    def test_session_is_reused_for_all_calls(self, session_mock):
+        self.client = PixelatedDispatcherClient('localhost', 12345, pool_size=25, timeout=5)
+        session = session_mock.return_value
+        session.get.return_value.status_code = 200
+        session.put.return_value.status_code = 200
+
+        self.client.get_agent('first')
+        self.client.get_agent_runtime('first')
+        self.client.start('first')
+
+        session_mock.assert_called_once_with()
+        session.mount.assert_called_once_with('https://', ANY)
+        self.assertEqual(25, session.mount.call_args[0][1]._pool_maxsize)
+        session.get.assert_called_with('https://localhost:12345/agents/first/runtime', verify=True, timeout=5)
+
+    @patch('pixelated.client.dispatcher_api_client.time.sleep')
+    def test_idempotent_calls_fail_over_to_next_manager(self, sleep_mock):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        calls = []
+
+        @urlmatch(path='/agents/some')
+        def get_agent(url, request):
+            calls.append(url.netloc)
+            if url.netloc == 'first:4443':
+                raise ConnectionError('Test Error')
+            return {'status_code': 200, 'content': {'name': 'some'}}
+
+        with HTTMock(get_agent, not_found_handler):
+            self.assertEqual({'name': 'some'}, self.client.get_agent('some'))
+            self.assertEqual({'name': 'some'}, self.client.get_agent('some'))
+
+        self.assertEqual(['first:4443', 'second:4443', 'second:4443'], calls)
+        self.assertFalse(sleep_mock.called)
+
+    def test_manager_answering_503_is_skipped(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+
+        @urlmatch(path='/agents/some/state')
+        def start_agent(url, request):
+            if url.netloc == 'first:4443':
+                return {'status_code': 503, 'reason': 'Manager is draining'}
+            return {'status_code': 202, 'content': {'state': 'starting'}}
+
+        with HTTMock(start_agent, not_found_handler):
+            self.assertEqual({'state': 'starting'}, self.client.start('some'))
+
+    def test_503_is_raised_if_no_other_manager_is_left(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        calls = []
+
+        @urlmatch(path='/agents/some/state')
+        def start_agent(url, request):
+            calls.append(url.netloc)
+            return {'status_code': 503, 'reason': 'Manager is draining'}
+
+        with HTTMock(start_agent, not_found_handler):
+            self.assertRaises(PixelatedNotAvailableHTTPError, self.client.start, 'some')
+
+        self.assertEqual(2, len(calls))
+
+    def test_post_is_not_retried(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        calls = []
+
+        @urlmatch(path='/agents')
+        def add_agent(url, request):
+            calls.append(url.netloc)
+            raise ConnectionError('Test Error')
+
+        with HTTMock(add_agent, not_found_handler):
+            self.assertRaises(ConnectionError, self.client.add, 'test', 'password')
+
+        self.assertEqual(1, len(calls))
+
+    @patch('pixelated.client.dispatcher_api_client.time.sleep')
+    def test_gives_up_without_sleeping_if_all_managers_are_down(self, sleep_mock):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)], retries=2)
+        calls = []
+
+        @urlmatch(path='/agents/some')
+        def get_agent(url, request):
+            calls.append(url.netloc)
+            raise ConnectionError('Test Error')
+
+        with HTTMock(get_agent, not_found_handler):
+            self.assertRaises(ConnectionError, self.client.get_agent, 'some')
+
+        self.assertEqual(['first:4443', 'second:4443'], calls)
+        self.assertFalse(sleep_mock.called)
+
+    def test_state_change_is_not_retried(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        calls = []
+
+        @urlmatch(path='/agents/some/state')
+        def start_agent(url, request):
+            calls.append(url.netloc)
+            raise ConnectionError('Test Error')
+
+        with HTTMock(start_agent, not_found_handler):
+            self.assertRaises(ConnectionError, self.client.start, 'some')
+
+        self.assertEqual(1, len(calls))
+
+    def test_jobs_are_looked_up_on_the_manager_that_created_them(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        first, second = self.client._endpoints
+        first.outstanding = 1
+        calls = []
+
+        @urlmatch(path='/agents/some/state')
+        def start_agent(url, request):
+            return {'status_code': 202, 'content': {'state': 'stopped', 'job': {'id': 'some-job', 'status': 'pending', 'error': None}}}
+
+        @urlmatch(path=r'^/jobs/some-job')
+        def get_job(url, request):
+            calls.append(url.netloc)
+            return {'status_code': 200, 'content': {'id': 'some-job', 'status': 'succeeded', 'error': None}}
+
+        with HTTMock(start_agent, get_job, not_found_handler):
+            self.client.start('some')
+            first.outstanding, second.outstanding = 0, 1
+            self.client.get_job('some-job')
+            self.client.wait_for_job('some-job')
+
+        self.assertEqual(['second:4443', 'second:4443'], calls)
+
+    def test_requests_go_to_manager_with_fewest_outstanding_requests(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        first, second = self.client._endpoints
+
+        first.outstanding = 3
+        self.assertIs(second, self.client._acquire_endpoint([]))
+        self.assertIs(second, self.client._acquire_endpoint([]))
+        self.assertIs(second, self.client._acquire_endpoint([]))
+        self.assertIs(first, self.client._acquire_endpoint([second]))
+
+    def test_failed_manager_is_skipped_until_backoff_expired(self):
+        self.client = PixelatedDispatcherClient('first', 4443, ssl=False, endpoints=[('second', 4443)])
+        first, second = self.client._endpoints
+        second.outstanding = 5
+
+        self.client._release_endpoint(self.client._acquire_endpoint([]), failed=True)
+
+        self.assertIs(second, self.client._acquire_endpoint([]))
+        first.retry_at = 0
+        self.assertIs(first, self.client._acquire_endpoint([]))
+
     def test_validate_connection_ignores_http_status_code(self):
 
         @urlmatch(path='/agents')
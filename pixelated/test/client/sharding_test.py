@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import unittest
+from tempfile import NamedTemporaryFile
+
+from mock import MagicMock
+
+from pixelated.client.dispatcher_api_client import PixelatedDispatcherClient
+from pixelated.client.sharding import HashRing, ShardedDispatcherClient, load_shard_overrides
+
+USERS = ['user%d' % i for i in range(1000)]
+
+
+class HashRingTest(unittest.TestCase):
+    def test_same_key_always_maps_to_same_shard(self):
+        ring = HashRing(['a:4443', 'b:4443'])
+
+        self.assertEqual(ring.shard_for('alice'), HashRing(['b:4443', 'a:4443']).shard_for('alice'))
+
+    def test_spreads_keys_over_all_shards(self):
+        ring = HashRing(['a:4443', 'b:4443', 'c:4443'])
+
+        counts = {}
+        for user in USERS:
+            shard = ring.shard_for(user)
+            counts[shard] = counts.get(shard, 0) + 1
+
+        self.assertEqual(3, len(counts))
+        self.assertTrue(min(counts.values()) > 200, counts)
+
+    def test_adding_a_shard_only_moves_users_to_the_new_shard(self):
+        before = HashRing(['a:4443', 'b:4443', 'c:4443'])
+        after = HashRing(['a:4443', 'b:4443', 'c:4443', 'd:4443'])
+
+        moved = [user for user in USERS if before.shard_for(user) != after.shard_for(user)]
+
+        self.assertTrue(len(moved) < len(USERS) / 2)
+        self.assertEqual(set(['d:4443']), set(after.shard_for(user) for user in moved))
+
+    def test_needs_a_shard(self):
+        self.assertRaises(ValueError, HashRing, [])
+
+
+class ShardedDispatcherClientTest(unittest.TestCase):
+    def setUp(self):
+        self.first = MagicMock(spec=PixelatedDispatcherClient)
+        self.second = MagicMock(spec=PixelatedDispatcherClient)
+        self.client = ShardedDispatcherClient({'first:4443': self.first, 'second:4443': self.second})
+
+    def _user_on(self, shard):
+        return [user for user in USERS if self.client.shard_for(user) == shard][0]
+
+    def test_user_calls_go_to_the_users_shard(self):
+        user = self._user_on('second:4443')
+
+        self.client.get_agent_runtime(user)
+        self.client.authenticate(user, 'password')
+        self.client.start(user)
+
+        self.second.get_agent_runtime.assert_called_once_with(user)
+        self.second.authenticate.assert_called_once_with(user, 'password')
+        self.second.start.assert_called_once_with(user)
+        self.assertFalse(self.first.method_calls)
+
+    def test_override_moves_user_to_other_shard(self):
+        user = self._user_on('second:4443')
+
+        self.client.update_overrides({user: 'first:4443'})
+        self.client.stop(user)
+
+        self.assertEqual('first:4443', self.client.shard_for(user))
+        self.first.stop.assert_called_once_with(user)
+
+    def test_overrides_must_refer_to_known_shards(self):
+        self.assertRaises(ValueError, self.client.update_overrides, {'user': 'unknown:4443'})
+
+    def test_list_merges_agents_of_all_shards(self):
+        self.first.list.return_value = iter([{'name': 'a'}, {'name': 'c'}])
+        self.second.list.return_value = iter([{'name': 'b'}])
+
+        agents = list(self.client.list(state='running'))
+
+        self.assertEqual(['a', 'b', 'c'], [agent['name'] for agent in agents])
+        self.first.list.assert_called_once_with(state='running', prefix=None)
+
+    def test_validates_connection_to_all_shards(self):
+        self.client.validate_connection()
+
+        self.assertTrue(self.first.validate_connection.called)
+        self.assertTrue(self.second.validate_connection.called)
+
+    def test_load_overrides_from_file(self):
+        with NamedTemporaryFile(delete=False) as fd:
+            json.dump({'alice': 'first:4443'}, fd)
+        try:
+            self.assertEqual({'alice': 'first:4443'}, load_shard_overrides(fd.name))
+        finally:
+            os.remove(fd.name)
@@ -0,0 +1,37 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from pixelated.common.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counts(self):
+        metrics = Metrics()
+
+        metrics.count('requests')
+        metrics.count('bytes', 100)
+        metrics.count('bytes', 50)
+
+        self.assertEqual({'requests': 1, 'bytes': 150}, metrics.snapshot()['counters'])
+
+    def test_timers_track_count_total_max_and_mean(self):
+        metrics = Metrics()
+
+        metrics.time('cpu', 0.5)
+        metrics.time('cpu', 1.5)
+
+        self.assertEqual({'count': 2, 'total': 2.0, 'max': 1.5, 'mean': 1.0}, metrics.snapshot()['timers']['cpu'])
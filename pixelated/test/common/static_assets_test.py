@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import os
+import unittest
+from os.path import join, exists
+
+from tempdir import TempDir
+
+from pixelated.common.static_assets import build_static_assets, load_static_manifest, fingerprinted_name
+
+
+class StaticAssetsTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = TempDir()
+        self.static_path = join(self._tmpdir.name, 'static')
+        self.build_path = join(self._tmpdir.name, 'build')
+        os.mkdir(self.static_path)
+        self._write('logo.png', '\x89PNG')
+        self._write('site.css', 'body { background: url("logo.png"); }')
+
+    def tearDown(self):
+        self._tmpdir.dissolve()
+
+    def _write(self, name, content):
+        with open(join(self.static_path, name), 'wb') as fd:
+            fd.write(content)
+
+    def _read(self, name):
+        with open(join(self.build_path, name), 'rb') as fd:
+            return fd.read()
+
+    def test_fingerprint_changes_with_content(self):
+        self.assertNotEqual(fingerprinted_name('site.css', 'a'), fingerprinted_name('site.css', 'b'))
+        self.assertTrue(fingerprinted_name('site.css', 'a').startswith('site.'))
+        self.assertTrue(fingerprinted_name('site.css', 'a').endswith('.css'))
+
+    def test_build_writes_fingerprinted_files_and_manifest(self):
+        manifest = build_static_assets(self.static_path, self.build_path)
+
+        self.assertEqual(manifest, load_static_manifest(self.build_path))
+        self.assertEqual(fingerprinted_name('logo.png', '\x89PNG'), manifest['logo.png'])
+        self.assertEqual('\x89PNG', self._read(manifest['logo.png']))
+        self.assertEqual('\x89PNG', self._read('logo.png'))
+
+    def test_css_references_fingerprinted_names(self):
+        manifest = build_static_assets(self.static_path, self.build_path)
+
+        self.assertEqual('body { background: url("%s"); }' % manifest['logo.png'], self._read(manifest['site.css']))
+
+    def test_only_compressible_files_get_gzipped_variant(self):
+        manifest = build_static_assets(self.static_path, self.build_path)
+
+        self.assertEqual(self._read(manifest['site.css']), gzip.open(join(self.build_path, manifest['site.css'] + '.gz')).read())
+        self.assertFalse(exists(join(self.build_path, manifest['logo.png'] + '.gz')))
+
+    def test_no_manifest_without_build(self):
+        self.assertEqual({}, load_static_manifest(self.build_path))
@@ -121,7 +121,7 @@ class SmokeTest(unittest.TestCase):
             self.assertSuccess(self.get('https://localhost:4443/agents'), json_body={
                 'agents': [{'name': 'test', 'state': 'stopped', 'uri': 'http://localhost:4443/agents/test'}]})
             self.assertSuccess(
-                self.put('https://localhost:4443/agents/test/state', json_data={'state': 'running'}))
+                self.wait_for_job(self.put('https://localhost:4443/agents/test/state', json_data={'state': 'running'})))
             self.assertSuccess(self.get('https://localhost:4443/agents/test/runtime'),
                                json_body={'state': 'running', 'port': 5000})
             time.sleep(2)  # let mailpile start
@@ -146,7 +146,7 @@ class SmokeTest(unittest.TestCase):
                 #                                form_data={'username': 'test', 'password': 'test'}))
                 # start agent
                 self.assertSuccess(
-                    self.put('https://localhost:4443/agents/test/state', json_data={'state': 'running'}))
+                    self.wait_for_job(self.put('https://localhost:4443/agents/test/state', json_data={'state': 'running'})))
                 # let mailpile start
                 time.sleep(1)
                 self.assertMemoryUsage(
@@ -160,6 +160,12 @@ class SmokeTest(unittest.TestCase):
                     # shutdown mailple
                     self.put('https://localhost:4443/agents/test/state', json_data={'state': 'stopped'})
 
+    def wait_for_job(self, response):
+        self.assertEqual(202, response.status_code)
+        r = self.get(response.headers['Location'].replace('http:', 'https:') + '/wait')
+        self.assertEqual('succeeded', r.json()['status'], msg=r.json()['error'])
+        return r
+
     def assertSuccess(self, response, body=None, json_body=None):
         status = response.status_code
         self.assertTrue(200 <= status < 300, msg='%d: %s' % (response.status_code, response.reason))
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import patch, MagicMock
+
+from pixelated.manager.activity import AgentActivity
+from pixelated.manager.state import StateStore
+
+
+class AgentActivityTest(unittest.TestCase):
+    def test_unseen_agents_are_idle(self):
+        activity = AgentActivity()
+
+        self.assertIsNone(activity.idle_for('first'))
+        self.assertTrue(activity.is_idle('first'))
+
+    @patch('pixelated.manager.activity.time.time')
+    def test_agents_become_idle_after_timeout(self, time_mock):
+        activity = AgentActivity(idle_timeout=60)
+        time_mock.return_value = 1000
+        activity.touch('first')
+
+        time_mock.return_value = 1059
+        self.assertEqual(59, activity.idle_for('first'))
+        self.assertFalse(activity.is_idle('first'))
+
+        time_mock.return_value = 1060
+        self.assertTrue(activity.is_idle('first'))
+
+    @patch('pixelated.manager.activity.time.time')
+    def test_persists_activity_at_most_once_per_interval(self, time_mock):
+        store = MagicMock(spec=StateStore)
+        store.get.return_value = {}
+        time_mock.return_value = 1000
+        activity = AgentActivity(store=store, persist_interval=60)
+
+        time_mock.return_value = 1030
+        activity.touch('first')
+        self.assertFalse(store.set.called)
+
+        time_mock.return_value = 1060
+        activity.touch('second')
+        store.set.assert_called_once_with('activity', {'first': 1030, 'second': 1060})
+
+    @patch('pixelated.manager.activity.time.time')
+    def test_restores_persisted_activity(self, time_mock):
+        store = MagicMock(spec=StateStore)
+        store.get.return_value = {'first': 1000}
+        time_mock.return_value = 1010
+
+        activity = AgentActivity(idle_timeout=60, store=store)
+
+        self.assertEqual(10, activity.idle_for('first'))
+        self.assertFalse(activity.is_idle('first'))
@@ -0,0 +1,128 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import MagicMock, patch
+
+from pixelated.manager.agent_snapshot import AgentStateSnapshot
+from pixelated.provider import Provider
+
+
+class AgentStateSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = MagicMock(spec=Provider)
+        self.provider.status.return_value = {'state': 'stopped'}
+        self.snapshot = AgentStateSnapshot(self.provider, max_age=60)
+
+    def test_refresh_returns_states_of_all_agents(self):
+        version, states = self.snapshot.refresh(['first', 'second'])
+
+        self.assertEqual([('first', 'stopped'), ('second', 'stopped')], states)
+
+    def test_unchanged_agents_are_not_queried_twice(self):
+        self.snapshot.refresh(['first', 'second'])
+        self.provider.status.reset_mock()
+
+        self.snapshot.refresh(['first', 'second'])
+
+        self.assertFalse(self.provider.status.called)
+
+    def test_only_invalidated_agents_are_queried(self):
+        self.snapshot.refresh(['first', 'second'])
+        self.provider.status.reset_mock()
+
+        self.snapshot.invalidate('second')
+        self.snapshot.refresh(['first', 'second'])
+
+        self.provider.status.assert_called_once_with('second')
+
+    def test_version_is_stable_without_changes(self):
+        version, _ = self.snapshot.refresh(['first'])
+        self.snapshot.invalidate('first')
+
+        self.assertEqual(version, self.snapshot.refresh(['first'])[0])
+
+    def test_version_changes_with_state(self):
+        version, _ = self.snapshot.refresh(['first'])
+        self.snapshot.record('first', 'running')
+
+        new_version, states = self.snapshot.refresh(['first'])
+
+        self.assertNotEqual(version, new_version)
+        self.assertEqual([('first', 'running')], states)
+
+    def test_version_changes_if_agents_get_added_or_removed(self):
+        names = ['first']
+        self.snapshot.refresh(self.snapshot.sorted_names(names))
+        version = self.snapshot.version
+        names.append('second')
+        self.snapshot.sorted_names(names)
+        added_version = self.snapshot.version
+        self.snapshot.sorted_names(['second'])
+
+        self.assertEqual(3, len({version, added_version, self.snapshot.version}))
+
+    def test_names_are_only_sorted_again_if_they_changed(self):
+        names = ['b', 'a']
+        sorted_names = self.snapshot.sorted_names(names)
+        self.assertEqual(['a', 'b'], sorted_names)
+
+        self.assertIs(sorted_names, self.snapshot.sorted_names(names))
+
+        names.append('0')
+        self.assertEqual(['0', 'a', 'b'], self.snapshot.sorted_names(names))
+
+    def test_states_of_removed_agents_are_dropped(self):
+        self.snapshot.refresh(self.snapshot.sorted_names(['first', 'second']))
+
+        self.snapshot.sorted_names(['second'])
+
+        self.assertEqual(['second'], self.snapshot._states.keys())
+
+    @patch('pixelated.manager.agent_snapshot.time.time')
+    def test_outdated_entries_get_refreshed(self, time_mock):
+        time_mock.return_value = 1000
+        self.snapshot.refresh(['first'])
+        self.provider.status.reset_mock()
+
+        time_mock.return_value = 1061
+        self.snapshot.refresh(['first'])
+
+        self.provider.status.assert_called_once_with('first')
+
+    def test_etags_differ_between_snapshots(self):
+        other = AgentStateSnapshot(self.provider)
+
+        self.assertNotEqual(self.snapshot.etag(), other.etag())
+
+    def test_provider_is_asked_without_holding_the_lock(self):
+        def status(name):
+            self.assertFalse(self.snapshot._lock.locked())
+            return {'state': 'running'}
+        self.provider.status.side_effect = status
+
+        self.assertEqual([('first', 'running')], self.snapshot.refresh(['first'])[1])
+
+    def test_agent_invalidated_while_fetching_gets_fetched_again(self):
+        def status(name):
+            self.snapshot.invalidate(name)  # e.g. a job finished meanwhile
+            return {'state': 'starting'}
+        self.provider.status.side_effect = status
+        self.snapshot.refresh(['first'])
+        self.provider.status.side_effect = None
+        self.provider.status.return_value = {'state': 'running'}
+
+        self.assertEqual([('first', 'running')], self.snapshot.refresh(['first'])[1])
@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import socket
+import time
+import unittest
+from StringIO import StringIO
+from threading import Thread
+
+from mock import MagicMock, patch
+
+from pixelated.manager.bottle_adapter import RequestBody, ThreadPoolWSGIServer, KeepAliveWSGIRequestHandler
+
+
+class RequestBodyTest(unittest.TestCase):
+    def test_read_stops_at_end_of_body(self):
+        body = RequestBody(StringIO('{"state": "running"}GET /next HTTP/1.1'), 20)
+
+        self.assertEqual('{"state": "running"}', body.read())
+        self.assertEqual('', body.read())
+
+    def test_readline_stops_at_end_of_body(self):
+        body = RequestBody(StringIO('first\nsecondGET'), 12)
+
+        self.assertEqual(['first\n', 'second'], list(body))
+
+    def test_drain_skips_unread_body(self):
+        rfile = StringIO('unread bodyGET /next HTTP/1.1')
+        body = RequestBody(rfile, 11)
+        body.read(3)
+
+        body.drain()
+
+        self.assertEqual('GET /next HTTP/1.1', rfile.read())
+
+
+class ThreadPoolWSGIServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadPoolWSGIServer(('localhost', 0), KeepAliveWSGIRequestHandler)
+        self.server.workers = 1
+        self.server.queue_size = 1
+
+    def tearDown(self):
+        self.server.server_close()
+
+    def test_drops_connections_if_queue_is_full(self):
+        self.server.workers = 0  # nobody takes connections from the queue
+        self.server.start_workers()
+        request = MagicMock()
+
+        self.server.process_request(MagicMock(), ('127.0.0.1', 1234))
+        self.server.process_request(request, ('127.0.0.1', 1235))
+
+        request.close.assert_called_once_with()
+        self.assertEqual(1, self.server.stats()['connections_rejected'])
+        self.assertEqual(1, self.server.stats()['queue_depth'])
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+
+class KeepAliveWSGIRequestHandlerTest(unittest.TestCase):
+    def setUp(self):
+        KeepAliveWSGIRequestHandler.quiet = True
+        self.server = ThreadPoolWSGIServer(('localhost', 0), KeepAliveWSGIRequestHandler)
+        self.server.workers = 1
+        self.server.set_app(echo_app)
+        self.server.start_workers()
+        self.thread = Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.client = socket.create_connection(self.server.server_address)
+
+    def tearDown(self):
+        KeepAliveWSGIRequestHandler.quiet = False
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    @patch('pixelated.manager.bottle_adapter.KEEP_ALIVE_TIMEOUT_IN_S', 0.2)
+    def test_slow_request_body_is_not_cut_off_by_keep_alive_timeout(self):
+        self.client.sendall('PUT / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n\r\nsl')
+        time.sleep(0.5)
+        self.client.sendall('ow')
+
+        self.assertTrue(self.client.recv(4096).endswith('\r\n\r\nslow'))
+
+    @patch('pixelated.manager.bottle_adapter.KEEP_ALIVE_TIMEOUT_IN_S', 0.2)
+    def test_idle_connection_gets_closed_after_keep_alive_timeout(self):
+        self.client.sendall('PUT / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\nok')
+        self.assertTrue(self.client.recv(4096).endswith('ok'))
+
+        self.client.settimeout(5)
+        self.assertEqual('', self.client.recv(4096))
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+
+from mock import MagicMock, patch, ANY
+
+from pixelated.manager.drain import Drain
+from pixelated.manager.jobs import LifecycleJobs, JobInProgressError
+from pixelated.manager.state import StateStore
+from pixelated.provider import Provider
+
+
+class DrainTest(unittest.TestCase):
+    def setUp(self):
+        self.running = ['busy', 'idle']
+        self.provider = MagicMock(spec=Provider)
+        self.provider.list_running.side_effect = lambda: list(self.running)
+        self.provider.stop.side_effect = self.running.remove
+        self.jobs = MagicMock(spec=LifecycleJobs)
+        self.jobs.submit.side_effect = lambda name, action, state, operation: operation()
+        self.drain = Drain(self.provider, self.jobs, lambda name: name == 'idle')
+
+    def test_not_draining_by_default(self):
+        self.assertFalse(self.drain.draining)
+        self.assertEqual({'state': 'off'}, self.drain.status())
+
+    @patch('pixelated.manager.drain.Thread')
+    def test_idle_agents_get_stopped_right_away(self, thread_mock):
+        self.drain.begin(grace_period=60)
+
+        self.drain.poll()
+
+        self.assertTrue(self.drain.draining)
+        self.assertEqual(['busy'], self.running)
+        self.jobs.submit.assert_called_once_with('idle', 'stop', 'stopping', ANY)
+        status = self.drain.status()
+        self.assertEqual(('draining', 2, 1, 1), (status['state'], status['initial_agents'], status['running_agents'], status['stopped_agents']))
+        self.assertTrue(0 < status['remaining_grace_period'] <= 60)
+
+    @patch('pixelated.manager.drain.Thread')
+    def test_agents_in_use_get_stopped_after_grace_period(self, thread_mock):
+        self.drain.begin(grace_period=0)
+
+        self.drain.poll()
+        self.assertEqual([], self.running)
+
+        self.drain.poll()
+        self.assertEqual('drained', self.drain.status()['state'])
+        self.assertTrue(self.drain.draining)
+
+    @patch('pixelated.manager.drain.Thread')
+    def test_busy_agents_get_retried_on_next_poll(self, thread_mock):
+        self.jobs.submit.side_effect = JobInProgressError
+        self.drain.begin(grace_period=0)
+
+        self.drain.poll()
+
+        self.assertEqual(['busy', 'idle'], self.running)
+        self.assertEqual('draining', self.drain.status()['state'])
+
+    @patch('pixelated.manager.drain.Thread')
+    def test_cancel_stops_draining(self, thread_mock):
+        self.drain.begin(grace_period=60)
+
+        self.drain.cancel()
+        self.drain.poll()
+
+        self.assertFalse(self.drain.draining)
+        self.assertEqual(['busy', 'idle'], self.running)
+
+    @patch('pixelated.manager.drain.Thread')
+    def test_drain_state_survives_restart(self, thread_mock):
+        state = {}
+        store = MagicMock(spec=StateStore)
+        store.get.side_effect = lambda key, default=None: state.get(key, default)
+        store.set.side_effect = state.__setitem__
+        Drain(self.provider, self.jobs, lambda name: False, store=store).begin(grace_period=60)
+
+        restarted = Drain(self.provider, self.jobs, lambda name: False, store=store)
+        restarted.resume()
+
+        self.assertEqual('draining', restarted.status()['state'])
+        self.assertEqual(60, restarted.status()['grace_period'])
+        self.assertEqual(2, thread_mock.return_value.start.call_count)
+
+        restarted.cancel()
+        self.assertFalse(Drain(self.provider, self.jobs, lambda name: False, store=store).draining)
+
+    def test_resume_without_drain_does_nothing(self):
+        self.drain.resume()
+
+        self.assertFalse(self.drain.draining)
+        self.assertEqual({'state': 'off'}, self.drain.status())
+
+    def test_drains_in_background(self):
+        drain = Drain(self.provider, self.jobs, lambda name: True, poll_interval=0.01)
+
+        drain.begin()
+        deadline = time.time() + 5
+        while drain.status()['state'] != 'drained' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual('drained', drain.status()['state'])
+        drain.shutdown()
+
+        self.assertEqual([], self.running)
+        self.assertEqual('drained', drain.status()['state'])
+
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+from threading import Event
+
+from mock import MagicMock
+
+from pixelated.manager.jobs import LifecycleJobs, Job, JobInProgressError
+from pixelated.provider import Provider
+
+
+class LifecycleJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = MagicMock(spec=Provider)
+        self.finished = []
+        self.jobs = LifecycleJobs(self.provider, workers=2, on_finish=self.finished.append)
+
+    def tearDown(self):
+        self.jobs.shutdown()
+
+    def test_job_runs_operation_in_background(self):
+        operation = MagicMock()
+
+        job = self.jobs.submit('first', 'start', 'starting', operation)
+
+        self.assertTrue(job.wait(5))
+        operation.assert_called_once_with()
+        self.assertEqual(Job.SUCCEEDED, job.status)
+        self.assertEqual([job], self.finished)
+
+    def test_transitional_state_lasts_while_job_is_active(self):
+        release = Event()
+        job = self.jobs.submit('first', 'stop', 'stopping', lambda: release.wait(5))
+
+        self.provider.begin_transition.assert_called_once_with('first', 'stopping')
+        self.assertFalse(self.provider.end_transition.called)
+        self.assertIs(job, self.jobs.active_job('first'))
+
+        release.set()
+        job.wait(5)
+
+        self.provider.end_transition.assert_called_once_with('first')
+        self.assertIsNone(self.jobs.active_job('first'))
+
+    def test_only_one_job_per_agent(self):
+        release = Event()
+        job = self.jobs.submit('first', 'start', 'starting', lambda: release.wait(5))
+        try:
+            self.assertRaises(JobInProgressError, self.jobs.submit, 'first', 'stop', 'stopping', MagicMock())
+        finally:
+            release.set()
+        job.wait(5)
+
+    def test_failing_operation_fails_job(self):
+        job = self.jobs.submit('first', 'start', 'starting', MagicMock(side_effect=Exception('out of memory')))
+
+        job.wait(5)
+
+        self.assertEqual(Job.FAILED, job.status)
+        self.assertEqual('out of memory', job.error)
+        self.provider.end_transition.assert_called_once_with('first')
+
+    def test_job_finishes_even_if_finish_callback_fails(self):
+        jobs = LifecycleJobs(self.provider, workers=1, on_finish=MagicMock(side_effect=Exception('snapshot broken')))
+        try:
+            job = jobs.submit('first', 'start', 'starting', MagicMock())
+
+            self.assertTrue(job.wait(5))
+            self.assertEqual(Job.SUCCEEDED, job.status)
+            self.assertIsNone(jobs.active_job('first'))
+        finally:
+            jobs.shutdown()
+
+    def test_jobs_can_be_looked_up_by_id(self):
+        job = self.jobs.submit('first', 'start', 'starting', MagicMock())
+
+        self.assertIs(job, self.jobs.get(job.id))
+        self.assertIsNone(self.jobs.get('unknown'))
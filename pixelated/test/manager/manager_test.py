@@ -18,15 +18,19 @@ from pixelated.test.util import EnforceTLSv1Adapter
 
 import unittest
 import time
+from threading import Event, Thread, BoundedSemaphore
 import json
 import requests
 from mock import MagicMock, patch
 from pixelated.provider import Provider
 from pixelated.manager import RESTfulServer, SSLConfig, DispatcherManager
+from pixelated.manager.activity import AgentActivity
+from pixelated.manager.state import StateStore
+from pixelated.provider.docker.migration import RsyncDataSync
 from pixelated.test.util import certfile, keyfile, cafile
-from pixelated.exceptions import InstanceAlreadyExistsError, InstanceAlreadyRunningError, UserAlreadyExistsError
+from pixelated.exceptions import InstanceAlreadyExistsError, InstanceAlreadyRunningError, UserAlreadyExistsError, UserNotExistError
 from pixelated.users import Users, UserConfig
-from pixelated.authenticator import Authenticator
+from pixelated.authenticator import Authenticator, HashingBusyError
 from pixelated.common import latest_available_ssl_version, DEFAULT_CIPHERS
 from tempdir import TempDir
 from os.path import join
@@ -61,6 +65,9 @@ class RESTfulServerTest(unittest.TestCase):
         self.mock_provider.reset_mock()
         self.mock_users.reset_mock()
         self.mock_authenticator.reset_mock()
+        self.mock_authenticator.hashing_stats.return_value = None
+        RESTfulServerTest.server._agent_snapshot.invalidate_all()
+        RESTfulServerTest.server._activity = AgentActivity()
 
         self.ssl_request = requests.Session()
         self.ssl_request.mount('https://', EnforceTLSv1Adapter())
@@ -68,11 +75,16 @@ class RESTfulServerTest(unittest.TestCase):
         self._tmpdir = TempDir()
         self._root_path = self._tmpdir.name
 
+        self._hashing_pool_patcher = patch('pixelated.manager.PasswordHashingPool')
+        self.hashing_pool_mock = self._hashing_pool_patcher.start()
+
     def tearDown(self):
+        self._hashing_pool_patcher.stop()
+        self.ssl_request.close()
         self._tmpdir.dissolve()
 
-    def get(self, url):
-        return self.ssl_request.get(url, verify=cafile())
+    def get(self, url, headers=None):
+        return self.ssl_request.get(url, headers=headers, verify=cafile())
 
     def put(self, url, data=None):
         if data:
@@ -122,6 +134,121 @@ class RESTfulServerTest(unittest.TestCase):
                 {'name': 'second', 'state': 'stopped', 'uri': 'http://localhost:4443/agents/second'}
             ]}, r)
 
+    def test_list_agents_filtered_by_state(self):
+        # given
+        self.mock_provider.status.side_effect = lambda name: {'state': 'running' if name == 'second' else 'stopped'}
+        self.mock_users.list.return_value = ['first', 'second', 'third']
+
+        try:
+            # when
+            r = self.get('https://localhost:4443/agents?state=running')
+
+            # then
+            self.assertSuccessJson({'agents': [{'name': 'second', 'state': 'running', 'uri': 'http://localhost:4443/agents/second'}]}, r)
+        finally:
+            self.mock_provider.status.side_effect = None
+
+    def test_list_agents_filtered_by_prefix(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['alice', 'bob', 'alfred', 'carl']
+
+        # when
+        r = self.get('https://localhost:4443/agents?prefix=al')
+
+        # then
+        self.assertEqual(['alfred', 'alice'], [agent['name'] for agent in r.json()['agents']])
+
+    def test_list_agents_paginated(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['d', 'c', 'b', 'a', 'e']
+
+        # when
+        first = self.get('https://localhost:4443/agents?limit=2').json()
+        second = self.get('https://localhost:4443/agents?limit=2&cursor=%s' % first['next']).json()
+        last = self.get('https://localhost:4443/agents?limit=2&cursor=%s' % second['next']).json()
+
+        # then
+        self.assertEqual(['a', 'b'], [agent['name'] for agent in first['agents']])
+        self.assertEqual(['c', 'd'], [agent['name'] for agent in second['agents']])
+        self.assertEqual(['e'], [agent['name'] for agent in last['agents']])
+        self.assertFalse('next' in last)
+
+    def test_list_agents_page_only_refreshes_its_agents(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['d', 'c', 'b', 'a', 'e']
+
+        # when
+        self.get('https://localhost:4443/agents?limit=2&cursor=b').json()
+
+        # then
+        self.assertEqual(['c', 'd', 'e'], sorted(call[0][0] for call in self.mock_provider.status.call_args_list))
+
+    def test_list_agents_rejects_invalid_limit(self):
+        self.mock_users.list.return_value = []
+
+        r = self.get('https://localhost:4443/agents?limit=0')
+
+        self.assertEqual(400, r.status_code)
+
+    def test_list_agents_provides_etag(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['first']
+
+        # when
+        r = self.get('https://localhost:4443/agents')
+
+        # then
+        self.assertEqual(200, r.status_code)
+        self.assertTrue(r.headers['ETag'])
+
+    def test_list_agents_returns_not_modified_if_etag_matches(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['first', 'second']
+        etag = self.get('https://localhost:4443/agents').headers['ETag']
+
+        # when
+        r = self.get('https://localhost:4443/agents', headers={'If-None-Match': etag})
+
+        # then
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(etag, r.headers['ETag'])
+
+    def test_list_agents_etag_changes_if_agent_state_changes(self):
+        # given
+        user_config = UserConfig('first', None)
+        self.mock_users.config.return_value = user_config
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['first']
+        etag = self.get('https://localhost:4443/agents').headers['ETag']
+        job = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'}).json()['job']
+        self.get(job['uri'].replace('http:', 'https:') + '/wait')
+        self.mock_provider.status.return_value = {'state': 'running'}
+
+        # when
+        r = self.get('https://localhost:4443/agents', headers={'If-None-Match': etag})
+
+        # then
+        self.assertSuccessJson({'agents': [{'name': 'first', 'state': 'running', 'uri': 'http://localhost:4443/agents/first'}]}, r)
+        self.assertNotEqual(etag, r.headers['ETag'])
+
+    def test_list_agents_does_not_query_provider_for_unchanged_agents(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_users.list.return_value = ['first', 'second']
+        self.get('https://localhost:4443/agents')
+        self.mock_provider.status.reset_mock()
+
+        # when
+        self.get('https://localhost:4443/agents')
+
+        # then
+        self.assertFalse(self.mock_provider.status.called)
+
     def test_add_agent(self):
         # given
         self.mock_provider.status.return_value = {'state': 'stopped'}
@@ -177,10 +304,13 @@ class RESTfulServerTest(unittest.TestCase):
         # then
         self.assertSuccessJson({'state': 'running'}, r)
 
+    def wait_for_job(self, response):
+        return self.get(response.headers['Location'].replace('http:', 'https:') + '/wait?timeout=5')
+
     def test_start_agent(self):
         # given
         user_config = UserConfig('first', None)
-        self.mock_provider.status.return_value = {'state': 'running'}
+        self.mock_provider.status.return_value = {'state': 'stopped'}
         self.mock_users.config.return_value = user_config
         payload = {'state': 'running'}
 
@@ -188,12 +318,21 @@ class RESTfulServerTest(unittest.TestCase):
         r = self.put('https://localhost:4443/agents/first/state', data=payload)
 
         # then
-        self.assertSuccessJson({'state': 'running'}, r)
+        self.assertEqual(202, r.status_code)
+        job = r.json()['job']
+        self.assertEqual('http://localhost:4443/jobs/%s' % job['id'], r.headers['Location'])
+        self.assertEqual(job['uri'], r.headers['Location'])
+        self.assertEqual(('first', 'start'), (job['agent'], job['action']))
+        self.mock_provider.begin_transition.assert_called_once_with('first', 'starting')
+
+        r = self.wait_for_job(r)
+        self.assertSuccessJson(dict(job, status='succeeded', error=None), r)
         self.mock_provider.start.assert_called_with(user_config)
+        self.mock_provider.end_transition.assert_called_once_with('first')
 
     def test_start_agent_twice_returns_conflict(self):
         # given
-        self.mock_provider.start.side_effect = InstanceAlreadyRunningError
+        self.mock_provider.status.return_value = {'state': 'running'}
         payload = {'state': 'running'}
 
         # when
@@ -201,19 +340,98 @@ class RESTfulServerTest(unittest.TestCase):
 
         # then
         self.assertEqual(409, r.status_code)
+        self.assertFalse(self.mock_provider.start.called)
 
-    def test_stop_agent(self):
+    def test_start_agent_while_job_in_progress_returns_conflict(self):
+        # given
+        release = Event()
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_provider.start.side_effect = lambda user_config: release.wait(5)
+        payload = {'state': 'running'}
+        try:
+            first = self.put('https://localhost:4443/agents/first/state', data=payload)
+
+            # when
+            r = self.put('https://localhost:4443/agents/first/state', data=payload)
+
+            # then
+            self.assertEqual(409, r.status_code)
+            self.assertEqual(202, self.get(first.headers['Location'].replace('http:', 'https:') + '/wait?timeout=0.1').status_code)
+            release.set()
+            self.assertEqual('succeeded', self.wait_for_job(first).json()['status'])
+        finally:
+            release.set()
+            self.mock_provider.start.side_effect = None
+
+    def test_job_wait_returns_right_away_when_enough_workers_wait(self):
+        # given
+        release = Event()
+        self.mock_provider.status.side_effect = None
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_provider.start.side_effect = lambda user_config: release.wait(5)
+        try:
+            r = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'})
+            with patch.object(RESTfulServerTest.server, '_job_waiters', BoundedSemaphore(1)) as waiters:
+                waiters.acquire()
+                started = time.time()
+
+                # when
+                wait = self.get(r.headers['Location'].replace('http:', 'https:') + '/wait?timeout=5')
+
+            # then
+            self.assertEqual(202, wait.status_code)
+            self.assertEqual('running', wait.json()['status'])
+            self.assertLess(time.time() - started, 2)
+        finally:
+            release.set()
+            self.mock_provider.start.side_effect = None
+
+    def test_failed_start_is_reported_by_job(self):
         # given
         self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_provider.start.side_effect = InstanceAlreadyRunningError('instance first already running')
+        try:
+            r = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'})
+
+            # when
+            r = self.wait_for_job(r)
+
+            # then
+            self.assertEqual('failed', r.json()['status'])
+            self.assertEqual('instance first already running', r.json()['error'])
+            self.mock_provider.end_transition.assert_called_once_with('first')
+        finally:
+            self.mock_provider.start.side_effect = None
+
+    def test_get_unknown_job_returns_not_found(self):
+        self.assertEqual(404, self.get('https://localhost:4443/jobs/unknown').status_code)
+        self.assertEqual(404, self.get('https://localhost:4443/jobs/unknown/wait').status_code)
+
+    def test_stop_agent(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'running'}
         payload = {'state': 'stopped'}
 
         # when
         r = self.put('https://localhost:4443/agents/first/state', data=payload)
 
         # then
-        self.assertSuccessJson({'state': 'stopped'}, r)
+        self.assertEqual(202, r.status_code)
+        self.mock_provider.begin_transition.assert_called_once_with('first', 'stopping')
+        self.assertEqual('succeeded', self.wait_for_job(r).json()['status'])
         self.mock_provider.stop.assert_called_with('first')
 
+    def test_stop_stopped_agent_returns_conflict(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+
+        # when
+        r = self.put('https://localhost:4443/agents/first/state', data={'state': 'stopped'})
+
+        # then
+        self.assertEqual(409, r.status_code)
+        self.assertFalse(self.mock_provider.stop.called)
+
     def test_reset_agent_data(self):
         # given
         user_config = UserConfig('first', None)
@@ -250,6 +468,124 @@ class RESTfulServerTest(unittest.TestCase):
         # then
         self.assertSuccessJson({'state': 'running', 'port': 1234}, r)
 
+    def wait_for_batch_job(self, result):
+        return self.get('https://localhost:4443/jobs/%s/wait?timeout=5' % result['job']['id']).json()
+
+    def test_batch_start_agents(self):
+        # given
+        self.mock_users.config.side_effect = lambda name: UserConfig(name, None)
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        payload = {'action': 'start', 'agents': ['first', 'second']}
+
+        try:
+            # when
+            r = self.post('https://localhost:4443/batch', data=payload)
+
+            # then
+            self.assertEqual(202, r.status_code)
+            results = r.json()['results']
+            self.assertEqual([('first', 202), ('second', 202)], [(result['name'], result['status']) for result in results])
+            self.assertEqual(['succeeded', 'succeeded'], [self.wait_for_batch_job(result)['status'] for result in results])
+            self.mock_provider.start.assert_any_call(UserConfig('first', None))
+            self.mock_provider.start.assert_any_call(UserConfig('second', None))
+            self.mock_provider.begin_transition.assert_any_call('first', 'starting')
+        finally:
+            self.mock_users.config.side_effect = None
+
+    def test_batch_reports_results_per_agent(self):
+        # given
+        def config(name):
+            if name == 'unknown':
+                raise UserNotExistError('no such user')
+            return UserConfig(name, None)
+
+        self.mock_users.config.side_effect = config
+        self.mock_provider.status.side_effect = lambda name: {'state': 'running' if name == 'running' else 'stopped'}
+        payload = {'action': 'start', 'agents': ['first', 'unknown', 'running']}
+
+        try:
+            # when
+            r = self.post('https://localhost:4443/batch', data=payload)
+
+            # then
+            self.assertEqual([202, 404, 409], [result['status'] for result in r.json()['results']])
+            self.assertEqual('no such user', r.json()['results'][1]['message'])
+            self.wait_for_batch_job(r.json()['results'][0])
+        finally:
+            self.mock_users.config.side_effect = None
+            self.mock_provider.status.side_effect = None
+
+    def test_batch_stop_agents(self):
+        # given
+        self.mock_provider.status.return_value = {'state': 'running'}
+        payload = {'action': 'stop', 'agents': ['first', 'second']}
+
+        # when
+        r = self.post('https://localhost:4443/batch', data=payload)
+
+        # then
+        self.assertEqual(202, r.status_code)
+        for result in r.json()['results']:
+            self.assertEqual('succeeded', self.wait_for_batch_job(result)['status'])
+        self.mock_provider.stop.assert_any_call('first')
+        self.mock_provider.stop.assert_any_call('second')
+
+    def test_batch_reset_data_runs_as_job(self):
+        # given
+        self.mock_users.config.side_effect = lambda name: UserConfig(name, None)
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+
+        try:
+            # when
+            r = self.post('https://localhost:4443/batch', data={'action': 'reset_data', 'agents': ['first']})
+
+            # then
+            self.assertEqual('succeeded', self.wait_for_batch_job(r.json()['results'][0])['status'])
+            self.mock_provider.reset_data.assert_called_once_with(UserConfig('first', None))
+            self.mock_provider.begin_transition.assert_any_call('first', 'resetting')
+        finally:
+            self.mock_users.config.side_effect = None
+
+    def test_batch_conflicts_with_job_in_progress(self):
+        # given
+        started = Event()
+        release = Event()
+        self.mock_users.config.side_effect = lambda name: UserConfig(name, None)
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_provider.start.side_effect = lambda user_config: started.set() or release.wait(5)
+
+        try:
+            first = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'})
+            started.wait(5)
+
+            # when
+            r = self.post('https://localhost:4443/batch', data={'action': 'start', 'agents': ['first']})
+
+            # then
+            self.assertEqual(409, r.json()['results'][0]['status'])
+        finally:
+            release.set()
+            self.wait_for_job(first)
+            self.mock_users.config.side_effect = None
+            self.mock_provider.start.side_effect = None
+
+    def test_batch_start_is_rejected_while_draining(self):
+        with patch.object(RESTfulServerTest.server._drain, '_state', 'draining'):
+            r = self.post('https://localhost:4443/batch', data={'action': 'start', 'agents': ['first']})
+
+        self.assertEqual(503, r.status_code)
+        self.assertFalse(self.mock_provider.start.called)
+
+    def test_batch_rejects_unknown_action(self):
+        r = self.post('https://localhost:4443/batch', data={'action': 'explode', 'agents': ['first']})
+
+        self.assertEqual(400, r.status_code)
+
+    def test_batch_rejects_agents_that_are_no_list(self):
+        self.assertEqual(400, self.post('https://localhost:4443/batch', data={'action': 'stop', 'agents': 'first'}).status_code)
+        self.assertEqual(400, self.post('https://localhost:4443/batch', data={'action': 'stop', 'agents': []}).status_code)
+        self.assertEqual(400, self.post('https://localhost:4443/batch', data={'action': 'stop'}).status_code)
+
     def test_user_can_be_authenticated_and_passes_credentials_to_provider(self):
         # given
         user_config = UserConfig('first', None)
@@ -275,6 +611,22 @@ class RESTfulServerTest(unittest.TestCase):
         # then
         self.assertEqual(403, r.status_code)
 
+    def test_user_authenticate_gets_service_unavailable_while_password_hashing_is_busy(self):
+        # given
+        self.mock_authenticator.authenticate.side_effect = HashingBusyError('32 password hashes pending')
+        payload = {'password': 'some password'}
+
+        # when
+        try:
+            r = self.post('https://localhost:4443/agents/first/authenticate', data=payload)
+        finally:
+            self.mock_authenticator.authenticate.side_effect = None
+
+        # then
+        self.assertEqual(503, r.status_code)
+        self.assertEqual('1', r.headers['Retry-After'])
+        self.assertFalse(self.mock_provider.pass_credentials_to_agent.called)
+
     def test_stats_get_memory_usage(self):
         # given
         expected = {'total_usage': 1234, 'average_usage': 1234, 'agents': [{'name': 'test', 'memory_usage': 1234}]}
@@ -303,7 +655,7 @@ class RESTfulServerTest(unittest.TestCase):
     @patch('pixelated.manager.SSLWSGIRefServerAdapter')
     @patch('pixelated.manager.run')    # mock run call to avoid actually startng the server
     def test_that_ssl_server_adapter_gets_used_when_ssl_config_is_provided(self, run_mock, ssl_adapter_mock):
-        server = RESTfulServer(RESTfulServerTest.ssl_config, RESTfulServerTest.mock_users, RESTfulServerTest.mock_authenticator, RESTfulServerTest.mock_provider)
+        server = RESTfulServer(RESTfulServerTest.ssl_config, RESTfulServerTest.mock_users, RESTfulServerTest.mock_authenticator, RESTfulServerTest.mock_provider, workers=0)
 
         # when
         server.serve_forever()
@@ -322,7 +674,7 @@ class RESTfulServerTest(unittest.TestCase):
     @patch('pixelated.manager.run')    # mock run call to avoid actually startng the server
     def test_that_serve_forever_runs_without_ssl_context(self, run_mock, wsgiRefServer_mock):
         # given
-        server = RESTfulServer(None, RESTfulServerTest.mock_users, RESTfulServerTest.mock_authenticator, RESTfulServerTest.mock_provider)
+        server = RESTfulServer(None, RESTfulServerTest.mock_users, RESTfulServerTest.mock_authenticator, RESTfulServerTest.mock_provider, workers=0)
 
         # when
         server.serve_forever()
@@ -330,6 +682,182 @@ class RESTfulServerTest(unittest.TestCase):
         # then
         wsgiRefServer_mock.assert_called_once_with(host='localhost', port=4443)
 
+    @patch('pixelated.manager.ThreadPoolWSGIServerAdapter')
+    @patch('pixelated.manager.run')    # mock run call to avoid actually startng the server
+    def test_that_thread_pool_server_adapter_gets_used_by_default(self, run_mock, adapter_mock):
+        server = RESTfulServer(RESTfulServerTest.ssl_config, RESTfulServerTest.mock_users, RESTfulServerTest.mock_authenticator, RESTfulServerTest.mock_provider, workers=8)
+
+        # when
+        server.serve_forever()
+
+        # then
+        adapter_mock.assert_called_once_with(ssl_ca_certs=None, ssl_ciphers=DEFAULT_CIPHERS, ssl_version=latest_available_ssl_version(), host='127.0.0.1', port=4443, ssl_cert_file=certfile(), ssl_key_file=keyfile(), workers=8)
+
+    def test_connections_are_kept_alive(self):
+        self.mock_provider.status.return_value = {'state': 'running'}
+
+        first = self.get('https://localhost:4443/agents/first/state')
+        second = self.get('https://localhost:4443/agents/first/state')
+
+        self.assertEqual('HTTP/1.1', 'HTTP/1.%d' % (first.raw.version - 10))
+        self.assertNotIn('close', first.headers.get('Connection', ''))
+        self.assertEqual(1, len(self.ssl_request.adapters['https://'].poolmanager.pools))
+        self.assertEqual(200, second.status_code)
+
+    def test_streamed_responses_close_the_connection(self):
+        self.mock_users.list.return_value = ['first']
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+
+        r = self.get('https://localhost:4443/agents')
+
+        self.assertEqual('close', r.headers['Connection'])
+
+    def test_slow_requests_do_not_block_other_requests(self):
+        release = Event()
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        self.mock_provider.start.side_effect = lambda user_config: release.wait(5)
+        try:
+            job_uri = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'}).headers['Location']
+            waiting = Thread(target=requests.get, args=(job_uri.replace('http:', 'https:') + '/wait?timeout=5',), kwargs={'verify': cafile()})
+            waiting.start()
+
+            start = time.time()
+            r = self.get('https://localhost:4443/agents/second/state')
+
+            self.assertEqual(200, r.status_code)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            release.set()
+            waiting.join()
+            self.mock_provider.start.side_effect = None
+
+    def test_server_stats(self):
+        r = self.get('https://localhost:4443/stats/server')
+
+        self.assertEqual(200, r.status_code)
+        stats = r.json()
+        self.assertEqual(16, stats['workers'])
+        self.assertEqual(1, stats['active_requests'])
+        for key in ['active_connections', 'queue_size', 'queue_depth', 'max_queue_depth', 'connections_handled', 'connections_rejected']:
+            self.assertIn(key, stats)
+        self.assertNotIn('password_hashing', stats)
+
+    def test_server_stats_include_password_hashing(self):
+        self.mock_authenticator.hashing_stats.return_value = {'pending': 2, 'max_pending': 32}
+
+        stats = self.get('https://localhost:4443/stats/server').json()
+
+        self.assertEqual({'pending': 2, 'max_pending': 32}, stats['password_hashing'])
+
+    def test_migrate_idle_agent(self):
+        user_config = UserConfig('first', None)
+        self.mock_provider.supports_migration = True
+        self.mock_provider.status.return_value = {'state': 'running', 'port': 5000, 'host': 'small'}
+        self.mock_users.config.return_value = user_config
+
+        r = self.post('https://localhost:4443/agents/first/migrate', data={'host': 'big'})
+
+        self.assertEqual(202, r.status_code)
+        self.assertEqual('running', r.json()['state'])
+        self.assertFalse(self.mock_provider.begin_transition.called)
+        self.assertEqual('succeeded', self.wait_for_job(r).json()['status'])
+        self.mock_provider.migrate.assert_called_once_with(user_config, 'big')
+
+    def test_migrate_agent_in_use_needs_force(self):
+        self.mock_provider.supports_migration = True
+        self.mock_provider.status.return_value = {'state': 'running', 'port': 5000, 'host': 'small'}
+        self.mock_users.config.return_value = UserConfig('first', None)
+        self.get('https://localhost:4443/agents/first/runtime')
+
+        r = self.post('https://localhost:4443/agents/first/migrate', data={'host': 'big'})
+        self.assertEqual(409, r.status_code)
+
+        r = self.post('https://localhost:4443/agents/first/migrate', data={'host': 'big', 'force': True})
+        self.assertEqual(202, r.status_code)
+        self.wait_for_job(r)
+
+    def test_migrate_stopped_agent_returns_conflict(self):
+        self.mock_provider.supports_migration = True
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+
+        r = self.post('https://localhost:4443/agents/first/migrate', data={'host': 'big'})
+
+        self.assertEqual(409, r.status_code)
+        self.assertFalse(self.mock_provider.migrate.called)
+
+    def test_migrate_not_supported_by_provider(self):
+        self.mock_provider.supports_migration = False
+        try:
+            r = self.post('https://localhost:4443/agents/first/migrate', data={'host': 'big'})
+            self.assertEqual(501, r.status_code)
+
+            r = self.get('https://localhost:4443/rebalance')
+            self.assertEqual(501, r.status_code)
+        finally:
+            self.mock_provider.supports_migration = True
+
+    def test_rebalance_plan(self):
+        moves = [{'agent': 'first', 'source': 'small', 'target': 'big'}]
+        self.mock_provider.supports_migration = True
+        self.mock_provider.rebalance_plan.return_value = moves
+
+        r = self.get('https://localhost:4443/rebalance?watermark=0.5')
+
+        self.assertSuccessJson({'moves': moves}, r)
+        self.mock_provider.rebalance_plan.assert_called_once_with(RESTfulServerTest.server._activity.is_idle, 0.5)
+        self.assertFalse(self.mock_provider.migrate.called)
+
+    def test_rebalance_plan_rejects_invalid_watermark(self):
+        self.mock_provider.supports_migration = True
+
+        self.assertEqual(400, self.get('https://localhost:4443/rebalance?watermark=2').status_code)
+        self.assertEqual(400, self.get('https://localhost:4443/rebalance?watermark=abc').status_code)
+
+    def test_rebalance_migrates_planned_agents(self):
+        user_config = UserConfig('first', None)
+        self.mock_provider.supports_migration = True
+        self.mock_provider.status.return_value = {'state': 'running', 'port': 5000, 'host': 'small'}
+        self.mock_provider.rebalance_plan.return_value = [{'agent': 'first', 'source': 'small', 'target': 'big'}]
+        self.mock_users.config.return_value = user_config
+
+        r = self.post('https://localhost:4443/rebalance', data={'watermark': 0.7})
+
+        self.assertEqual(202, r.status_code)
+        move = r.json()['moves'][0]
+        self.assertEqual(('first', 'migrate'), (move['job']['agent'], move['job']['action']))
+        self.assertEqual('succeeded', self.get(move['job']['uri'].replace('http:', 'https:') + '/wait?timeout=5').json()['status'])
+        self.mock_provider.migrate.assert_called_once_with(user_config, 'big')
+
+    def test_drain_rejects_starts_and_reports_progress(self):
+        self.mock_provider.list_running.return_value = []
+        self.mock_provider.status.return_value = {'state': 'stopped'}
+        try:
+            r = self.put('https://localhost:4443/drain', data={'grace_period': 30})
+            self.assertEqual(202, r.status_code)
+            self.assertIn(r.json()['state'], ('draining', 'drained'))
+            self.assertEqual(30, r.json()['grace_period'])
+
+            r = self.put('https://localhost:4443/agents/first/state', data={'state': 'running'})
+            self.assertEqual(503, r.status_code)
+            self.assertEqual('60', r.headers['Retry-After'])
+            self.assertFalse(self.mock_provider.start.called)
+
+            r = self.post('https://localhost:4443/batch', data={'action': 'start', 'agents': ['first']})
+            self.assertEqual(503, r.status_code)
+        finally:
+            r = self.put('https://localhost:4443/drain', data={'draining': False})
+
+        self.assertSuccessJson({'state': 'off'}, r)
+        self.assertSuccessJson({'state': 'off'}, self.get('https://localhost:4443/drain'))
+
+    def test_drain_rejects_invalid_grace_period(self):
+        r = self.put('https://localhost:4443/drain', data={'grace_period': 'soon'})
+        null = self.put('https://localhost:4443/drain', data={'grace_period': None})
+
+        self.assertEqual(400, r.status_code)
+        self.assertEqual(400, null.status_code)
+        self.assertEqual({'state': 'off'}, self.get('https://localhost:4443/drain').json())
+
     def test_handles_provider_initializing(self):
         self.mock_users.list.return_value = ['test']
         self.mock_provider.status.side_effect = ProviderInitializingException
@@ -357,6 +885,45 @@ class RESTfulServerTest(unittest.TestCase):
         thread_mock.assert_called_with(target=self.mock_provider.initialize)
         self.assertFalse(self.mock_provider.initialize.called)
 
+    @patch('pixelated.manager.LeapCertificate')
+    @patch('pixelated.manager.Authenticator')
+    @patch('pixelated.manager.MultiHostDockerProvider')
+    @patch('pixelated.manager.RESTfulServer')
+    @patch('pixelated.manager.Thread')
+    @patch('pixelated.manager.Users')
+    @patch('pixelated.manager.LeapProvider')
+    def test_that_multiple_docker_hosts_use_multi_host_provider(self, leap_provider_mock, users_mock, thread_mock, server_mock, multi_host_provider_mock, authenticator_mock, leap_certificate_mock):
+        docker_hosts = [('tcp://one:2375', 'one'), ('tcp://two:2375', 'two')]
+        manager = DispatcherManager(self._root_path, None, None, None, None, provider='docker', docker_hosts=docker_hosts, sync_data=True)
+
+        manager.serve_forever()
+
+        args, kwargs = multi_host_provider_mock.call_args
+        self.assertEqual(docker_hosts, args[3])
+        self.assertIsInstance(kwargs['data_sync'], RsyncDataSync)
+        thread_mock.assert_called_with(target=multi_host_provider_mock.return_value.initialize)
+
+    @patch('pixelated.manager.LeapCertificate')
+    @patch('pixelated.manager.Authenticator')
+    @patch('pixelated.manager.LeaderLock')
+    @patch('pixelated.manager.DockerProvider')
+    @patch('pixelated.manager.RESTfulServer')
+    @patch('pixelated.manager.Thread')
+    @patch('pixelated.manager.Users')
+    @patch('pixelated.manager.LeapProvider')
+    def test_that_standby_manager_waits_for_leadership_and_shares_state(self, leap_provider_mock, users_mock, thread_mock, server_mock, docker_provider_mock, leader_lock_mock, authenticator_mock, leap_certificate_mock):
+        manager = DispatcherManager(self._root_path, None, None, None, None, provider='docker', leader_election=True)
+        leader_lock_mock.return_value.acquire.side_effect = lambda: self.assertFalse(server_mock.called)
+
+        manager.serve_forever()
+        manager.shutdown()
+
+        leader_lock_mock.assert_called_once_with(join(self._root_path, '.manager.lock'))
+        leader_lock_mock.return_value.acquire.assert_called_once_with()
+        leader_lock_mock.return_value.release.assert_called_once_with()
+        state_store = server_mock.call_args[1]['state_store']
+        self.assertIsInstance(state_store, StateStore)
+
     @patch('pixelated.manager.LeapCertificate')
     @patch('pixelated.manager.Authenticator')
     @patch('pixelated.manager.DockerProvider')
@@ -372,7 +939,41 @@ class RESTfulServerTest(unittest.TestCase):
         manager.serve_forever()
 
         # then
-        authenticator_mock.assert_called_once_with(users_mock.return_value, leap_provider_mock.return_value)
+        authenticator_mock.assert_called_once_with(users_mock.return_value, leap_provider_mock.return_value, hashing_pool=self.hashing_pool_mock.return_value)
+
+    @patch('pixelated.manager.LeapCertificate')
+    @patch('pixelated.manager.Authenticator')
+    @patch('pixelated.manager.DockerProvider')
+    @patch('pixelated.manager.RESTfulServer')
+    @patch('pixelated.manager.Thread')
+    @patch('pixelated.manager.Users')
+    @patch('pixelated.manager.LeapProvider')
+    def test_that_passwords_get_hashed_in_a_process_pool(self, leap_provider_mock, users_mock, thread_mock, server_mock, docker_provider_mock, authenticator_mock, leap_certificate_mock):
+        # given
+        manager = DispatcherManager(self._root_path, None, None, None, None, provider='docker', hash_workers=2, max_pending_hashes=5)
+
+        # when
+        manager.serve_forever()
+        manager.shutdown()
+
+        # then
+        self.hashing_pool_mock.assert_called_once_with(2, 5)
+        self.hashing_pool_mock.return_value.shutdown.assert_called_once_with()
+
+    @patch('pixelated.manager.LeapCertificate')
+    @patch('pixelated.manager.Authenticator')
+    @patch('pixelated.manager.DockerProvider')
+    @patch('pixelated.manager.RESTfulServer')
+    @patch('pixelated.manager.Thread')
+    @patch('pixelated.manager.Users')
+    @patch('pixelated.manager.LeapProvider')
+    def test_that_passwords_can_be_hashed_on_request_threads(self, leap_provider_mock, users_mock, thread_mock, server_mock, docker_provider_mock, authenticator_mock, leap_certificate_mock):
+        manager = DispatcherManager(self._root_path, None, None, None, None, provider='docker', hash_workers=0)
+
+        manager.serve_forever()
+
+        self.assertFalse(self.hashing_pool_mock.called)
+        authenticator_mock.assert_called_once_with(users_mock.return_value, leap_provider_mock.return_value, hashing_pool=None)
 
     @patch('pixelated.manager.LeapCertificate')
     @patch('pixelated.manager.Authenticator')
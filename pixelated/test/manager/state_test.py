@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+from os.path import join, exists
+from threading import Thread
+
+from tempdir import TempDir
+
+from pixelated.manager.state import StateStore, LeaderLock
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = TempDir()
+        self.path = join(self._tmpdir.name, 'state.json')
+
+    def tearDown(self):
+        self._tmpdir.dissolve()
+
+    def test_empty_without_state_file(self):
+        self.assertEqual('default', StateStore(self.path).get('drain', 'default'))
+
+    def test_values_survive_restart(self):
+        StateStore(self.path).set('drain', {'state': 'draining'})
+
+        self.assertEqual({'state': 'draining'}, StateStore(self.path).get('drain'))
+        self.assertFalse(exists(self.path + '.tmp'))
+
+    def test_ignores_corrupt_state_file(self):
+        with open(self.path, 'w') as fd:
+            fd.write('{"drain": ')
+
+        self.assertIsNone(StateStore(self.path).get('drain'))
+
+
+class LeaderLockTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = TempDir()
+        self.path = join(self._tmpdir.name, 'manager.lock')
+
+    def tearDown(self):
+        self._tmpdir.dissolve()
+
+    def test_only_one_manager_is_leader(self):
+        active = LeaderLock(self.path)
+        standby = LeaderLock(self.path)
+
+        self.assertTrue(active.try_acquire())
+        self.assertFalse(standby.try_acquire())
+        self.assertTrue(active.is_leader)
+        self.assertFalse(standby.is_leader)
+        active.release()
+
+    def test_standby_takes_over_once_leader_is_gone(self):
+        active = LeaderLock(self.path)
+        standby = LeaderLock(self.path)
+        active.try_acquire()
+
+        t = Thread(target=standby.acquire, kwargs={'poll_interval': 0.01})
+        t.start()
+        active.release()
+        t.join(5)
+
+        self.assertFalse(t.is_alive())
+        self.assertTrue(standby.is_leader)
+        standby.release()
@@ -19,7 +19,7 @@ import socket
 from os.path import join, isdir, isfile, exists
 from tempfile import NamedTemporaryFile
 from time import sleep, clock
-from mock import patch, MagicMock
+from mock import patch, MagicMock, ANY
 import pkg_resources
 import requests
 import json
@@ -174,6 +174,49 @@ class DockerProviderTest(unittest.TestCase):
         self.assertFalse(client.build.called)
         self.assertFalse(provider.initializing)
 
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_initialize_takes_over_ports_of_running_agents(self, docker_mock):
+        client = docker_mock.return_value
+        client.images.return_value = [{'RepoTags': ['pixelated:latest']}, {'RepoTags': ['pixelated/logspout:latest']}]
+        client.containers.return_value = [
+            {'Names': ['/first'], 'Ports': [{'PrivatePort': 4567, 'PublicPort': 5000}]},
+            {'Names': ['/second'], 'Ports': [{'PrivatePort': 4567, 'PublicPort': 5002}]},
+            {'Names': ['/logger'], 'Ports': []}]
+        provider = DockerProvider(self._adapter, 'leap_provider', self._leap_provider_x509)
+
+        provider.initialize()
+
+        self.assertEqual(set([5000, 5002]), provider._used_ports())
+        self.assertEqual(5001, provider._reserve_port())
+
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_initialize_checks_image_can_expose_agents_on_unix_sockets(self, docker_mock):
+        client = docker_mock.return_value
+        client.images.return_value = [{'RepoTags': ['pixelated:latest']}, {'RepoTags': ['pixelated/logspout:latest']}]
+        client.containers.return_value = []
+        check = {'Id': 'check'}
+        client.create_container.return_value = check
+        client.wait.return_value = 0
+        provider = DockerProvider(self._adapter, 'leap_provider', self._leap_provider_x509, agent_socket_dir=self.root_path)
+
+        provider.initialize()
+
+        client.create_container.assert_called_with('pixelated', '/bin/sh -c "command -v socat"')
+        client.remove_container.assert_called_once_with(check)
+        self.assertEqual(self.root_path, provider._agent_socket_dir)
+
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_initialize_falls_back_to_ports_if_image_lacks_socket_support(self, docker_mock):
+        client = docker_mock.return_value
+        client.images.return_value = [{'RepoTags': ['pixelated:latest']}, {'RepoTags': ['pixelated/logspout:latest']}]
+        client.containers.return_value = []
+        client.wait.return_value = 1
+        provider = DockerProvider(self._adapter, 'leap_provider', self._leap_provider_x509, agent_socket_dir=self.root_path)
+
+        provider.initialize()
+
+        self.assertIsNone(provider._agent_socket_dir)
+
     @patch('pixelated.provider.docker.docker.Client')
     def test_initialize_doesnt_download_logger_image_if_already_available(self, docker_mock):
         # given
@@ -281,6 +324,34 @@ class DockerProviderTest(unittest.TestCase):
         client.start.assert_any_call(container, binds={data_path: {'bind': '/mnt/user', 'ro': False}}, port_bindings={4567: ('127.0.0.1', 5000)}, extra_hosts=expected_extra_hosts)
         client.start.assert_any_call(prepare_pixelated_container, binds={data_path: {'bind': '/mnt/user', 'ro': False}})
 
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_agent_gets_exposed_on_unix_socket(self, docker_mock):
+        client = docker_mock.return_value
+        container = MagicMock()
+        client.create_container.side_effect = [MagicMock(), container]
+        client.wait.return_value = 0
+        socket_dir = join(self.root_path, 'sockets')
+        os.mkdir(socket_dir)
+        provider = DockerProvider(self._adapter, 'leap_provider_hostname', self._leap_provider_x509, 'some docker url', agent_socket_dir=socket_dir)
+        provider._initializing = False
+
+        with patch('pixelated.provider.docker.socket.getfqdn') as mock:
+            mock.return_value = 'pixelated.example.tld'
+            provider.start(self._user_config('test'))
+
+        args, kwargs = client.create_container.call_args
+        self.assertEqual('/bin/bash -l -c "socat UNIX-LISTEN:/mnt/run/agent.sock,fork,unlink-early,mode=660 TCP:127.0.0.1:4567 & exec /usr/bin/pixelated-user-agent --leap-home /mnt/user --host 127.0.0.1 --port 4567 --organization-mode"', args[1])
+        self.assertEqual(['/mnt/user', '/mnt/run'], kwargs['volumes'])
+        args, kwargs = client.start.call_args
+        self.assertEqual({'bind': '/mnt/run', 'ro': False}, kwargs['binds'][join(socket_dir, 'test')])
+        self.assertFalse('port_bindings' in kwargs)
+        self.assertTrue(isdir(join(socket_dir, 'test')))
+        self.assertEqual(set(), provider._used_ports())
+
+        client.containers.side_effect = None
+        client.containers.return_value = [{'Names': ['/test'], 'Ports': [{'PrivatePort': 4567}]}]
+        self.assertEqual({'state': 'running', 'socket': join(socket_dir, 'test', 'agent.sock')}, provider.status('test'))
+
     @patch('pixelated.provider.docker.docker.Client')
     def test_that_existing_container_gets_reused(self, docker_mock):
         client = docker_mock.return_value
@@ -294,6 +365,34 @@ class DockerProviderTest(unittest.TestCase):
         client.containers.assert_called_with(all=True)
         self.assertFalse(client.build.called)
 
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_concurrently_started_agents_get_distinct_ports(self, docker_mock):
+        client = docker_mock.return_value
+        client.containers.return_value = []
+        client.wait.return_value = 0
+        provider = self._create_initialized_provider(self._adapter, 'some docker url')
+        configs = [self._user_config('agent%d' % i) for i in range(8)]
+
+        threads = [Thread(target=provider.start, args=(config,)) for config in configs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(set(range(5000, 5008)), provider._used_ports())
+
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_failed_start_releases_port(self, docker_mock):
+        client = docker_mock.return_value
+        client.containers.return_value = []
+        client.wait.return_value = 0
+        client.start.side_effect = [None, Exception('docker failed')]
+        provider = self._create_initialized_provider(self._adapter, 'some docker url')
+
+        self.assertRaises(Exception, provider.start, self._user_config('test'))
+
+        self.assertEqual(set(), provider._used_ports())
+
     @patch('pixelated.provider.docker.docker.Client')
     def test_running_containers_empty_if_none_started(self, docker_mock):
         client = docker_mock.return_value
@@ -304,10 +403,25 @@ class DockerProviderTest(unittest.TestCase):
 
         self.assertEqual([], running)
 
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_prepare_container_created_by_concurrent_start_gets_reused(self, docker_mock):
+        client = docker_mock.return_value
+        prepare = {u'Names': [u'/pixelated_prepare'], u'Id': u'prepare'}
+        client.containers.side_effect = [[], [], [prepare]]  # created after this start listed the containers
+        client.wait.return_value = 0
+        provider = self._create_initialized_provider(self._adapter, 'some docker url')
+
+        with patch('pixelated.provider.docker.socket.getfqdn') as mock:
+            mock.return_value = 'pixelated.example.tld'
+            provider.start(self._user_config('test'))
+
+        self.assertEqual(1, client.create_container.call_count)  # only the agent container
+        client.start.assert_any_call(prepare, binds=ANY)
+
     @patch('pixelated.provider.docker.docker.Client')
     def test_running_returns_running_container(self, docker_mock):
         client = docker_mock.return_value
-        client.containers.side_effect = [[], [], [{u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}]]
+        client.containers.side_effect = [[], [], [], [{u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}]]
         client.wait.return_value = 0
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
         provider.start(self._user_config('test'))
@@ -319,7 +433,7 @@ class DockerProviderTest(unittest.TestCase):
     @patch('pixelated.provider.docker.docker.Client')
     def test_a_container_cannot_be_started_twice(self, docker_mock):
         client = docker_mock.return_value
-        client.containers.side_effect = [[], [], [{u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}]]
+        client.containers.side_effect = [[], [], [], [{u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}]]
         client.wait.return_value = 0
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
         user_config = self._user_config('test')
@@ -341,7 +455,7 @@ class DockerProviderTest(unittest.TestCase):
         user_config = self._user_config('test')
         client = docker_mock.return_value
         container = {u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 5000, u'PrivatePort': 4567}], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}
-        client.containers.side_effect = [[], [], [container], [container], [container]]
+        client.containers.side_effect = [[], [], [], [container], [container], [container]]
         client.wait.return_value = 0
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
         provider.pass_credentials_to_agent(user_config, 'test')
@@ -360,7 +474,7 @@ class DockerProviderTest(unittest.TestCase):
         # given
         client = docker_mock.return_value
         container = {u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 5000, u'PrivatePort': 4567}], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}
-        client.containers.side_effect = [[], [], [container], [container], [container]]
+        client.containers.side_effect = [[], [], [], [container], [container], [container]]
         client.wait.return_value = 0
         client.stop.side_effect = requests.exceptions.Timeout
 
@@ -384,12 +498,33 @@ class DockerProviderTest(unittest.TestCase):
     def test_status_running(self, docker_mock):
         client = docker_mock.return_value
         container = {u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 5000, u'PrivatePort': 33144}], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}
-        client.containers.side_effect = [[], [], [container], [container]]
+        client.containers.side_effect = [[], [], [], [container], [container], [container], [container]]
         client.wait.return_value = 0
+        client.inspect_container.return_value = {'Image': 'b4f10a2395ab8dfc5e1c0fae26fa56c7f5d2541debe54263105fe5af1d263189'}
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
         provider.start(self._user_config('test'))
 
-        self.assertEqual({'state': 'running', 'port': 5000}, provider.status('test'))
+        self.assertEqual({'state': 'running', 'port': 5000, 'version': 'b4f10a2395ab'}, provider.status('test'))
+        self.assertEqual({'state': 'running', 'port': 5000, 'version': 'b4f10a2395ab'}, provider.status('test'))
+        client.inspect_container.assert_called_once_with(container['Id'])
+
+    @patch('pixelated.provider.docker.docker.Client')
+    def test_image_version_is_looked_up_again_after_stop_and_pull(self, docker_mock):
+        client = docker_mock.return_value
+        container = {u'Image': u'pixelated:latest', u'Ports': [{u'PublicPort': 5000, u'PrivatePort': 4567}], u'Names': [u'/test'], u'Id': u'f59ee32d2022'}
+        client.containers.return_value = [container]
+        client.inspect_container.return_value = {'Image': 'b4f10a2395ab8dfc5e1c0fae26fa56c7f5d2541debe54263105fe5af1d263189'}
+        client.pull.return_value = []
+        provider = self._create_initialized_provider(self._adapter, 'some docker url')
+
+        self.assertEqual('b4f10a2395ab', provider.status('test')['version'])
+        provider.stop('test')
+        client.inspect_container.return_value = {'Image': 'c0ffee2395ab8dfc5e1c0fae26fa56c7f5d2541debe54263105fe5af1d263189'}
+        self.assertEqual('c0ffee2395ab', provider.status('test')['version'])
+        provider._download_image('pixelated')
+        provider.status('test')
+
+        self.assertEqual(3, client.inspect_container.call_count)
 
     @patch('pixelated.provider.docker.Process')
     @patch('pixelated.provider.docker.docker.Client')
@@ -443,7 +578,7 @@ class DockerProviderTest(unittest.TestCase):
         # given
         client = docker_mock.return_value
         container = {u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 5000, u'PrivatePort': 4567}], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}
-        client.containers.side_effect = [[], [], [container]]
+        client.containers.side_effect = [[], [], [], [container]]
         client.wait.return_value = 0
 
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
@@ -501,7 +636,7 @@ class DockerProviderTest(unittest.TestCase):
         # given
         client = docker_mock.return_value
         container = {u'Status': u'Up 20 seconds', u'Created': 1404904929, u'Image': u'pixelated:latest', u'Ports': [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 5000, u'PrivatePort': 4567}], u'Command': u'sleep 100', u'Names': [u'/test'], u'Id': u'f59ee32d2022b1ab17eef608d2cd617b7c086492164b8c411f1cbcf9bfef0d87'}
-        client.containers.side_effect = [[], [], [container]]
+        client.containers.side_effect = [[], [], [], [container]]
         client.wait.return_value = 0
 
         provider = self._create_initialized_provider(self._adapter, 'some docker url')
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import patch
+
+from pixelated.provider.docker.migration import RsyncDataSync, plan_moves
+
+GB = 1024 * 1024 * 1024
+
+
+class RsyncDataSyncTest(unittest.TestCase):
+    def test_pushes_local_data_to_remote_host(self):
+        command = RsyncDataSync().command('127.0.0.1', '10.0.0.2', '/srv/agents/first/data')
+
+        self.assertEqual(['rsync', '-a', '--delete', '/srv/agents/first/data/', '10.0.0.2:/srv/agents/first/data/'], command)
+
+    def test_syncs_between_remote_hosts_via_ssh(self):
+        command = RsyncDataSync().command('10.0.0.1', '10.0.0.2', '/srv/agents/first/data')
+
+        self.assertEqual(['ssh', '10.0.0.1', 'rsync', '-a', '--delete', '/srv/agents/first/data/', '10.0.0.2:/srv/agents/first/data/'], command)
+
+    def test_pulls_remote_data_to_local_host(self):
+        command = RsyncDataSync().command('10.0.0.1', '127.0.0.1', '/srv/agents/first/data')
+
+        self.assertEqual(['rsync', '-a', '--delete', '10.0.0.1:/srv/agents/first/data/', '/srv/agents/first/data/'], command)
+
+    @patch('pixelated.provider.docker.migration.subprocess.check_call')
+    def test_sync_runs_rsync(self, check_call_mock):
+        RsyncDataSync().sync('127.0.0.1', '10.0.0.2', '/data')
+
+        check_call_mock.assert_called_once_with(['rsync', '-a', '--delete', '/data/', '10.0.0.2:/data/'])
+
+    @patch('pixelated.provider.docker.migration.subprocess.check_call')
+    def test_sync_to_same_host_does_nothing(self, check_call_mock):
+        RsyncDataSync().sync('10.0.0.2', '10.0.0.2', '/data')
+
+        self.assertFalse(check_call_mock.called)
+
+
+class PlanMovesTest(unittest.TestCase):
+    def test_no_moves_if_balanced(self):
+        hosts = [('one', 4 * GB, ['a', 'b']), ('two', 4 * GB, ['c'])]
+
+        self.assertEqual([], plan_moves(hosts, GB))
+
+    def test_moves_agents_from_full_to_empty_host(self):
+        hosts = [('one', 4 * GB, ['a', 'b', 'c', 'd']), ('two', 4 * GB, [])]
+
+        moves = plan_moves(hosts, GB)
+
+        self.assertEqual([{'agent': 'a', 'source': 'one', 'target': 'two'}, {'agent': 'b', 'source': 'one', 'target': 'two'}], moves)
+
+    def test_evens_out_usage_relative_to_host_memory(self):
+        hosts = [('small', 2 * GB, ['a', 'b']), ('big', 8 * GB, ['c'])]
+
+        moves = plan_moves(hosts, GB, watermark=1.0)
+
+        self.assertEqual([{'agent': 'a', 'source': 'small', 'target': 'big'}], moves)
+
+    def test_moves_agent_to_get_below_watermark_even_if_it_does_not_even_out(self):
+        hosts = [('small', 2 * GB, ['a', 'b']), ('big', 10 * GB, ['c', 'd', 'e', 'f', 'g', 'h', 'i'])]
+
+        moves = plan_moves(hosts, GB, watermark=0.8)
+
+        self.assertEqual([{'agent': 'a', 'source': 'small', 'target': 'big'}], moves)
+
+    def test_only_movable_agents_get_moved(self):
+        hosts = [('one', 4 * GB, ['busy', 'idle', 'other']), ('two', 4 * GB, []), ('three', 4 * GB, ['x', 'y', 'z'])]
+
+        moves = plan_moves(hosts, GB, movable=lambda name: name in ('idle', 'x'))
+
+        self.assertEqual([{'agent': 'x', 'source': 'three', 'target': 'two'}, {'agent': 'idle', 'source': 'one', 'target': 'two'}], moves)
+
+    def test_hosts_without_memory_info_are_ignored(self):
+        hosts = [('one', 4 * GB, ['a', 'b', 'c', 'd']), ('unknown', None, [])]
+
+        self.assertEqual([], plan_moves(hosts, GB))
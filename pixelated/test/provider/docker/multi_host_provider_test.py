@@ -0,0 +1,264 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import os
+import unittest
+from os.path import join
+
+from mock import patch, MagicMock, ANY, call
+from tempdir import TempDir
+
+from pixelated.bitmask_libraries.leap_config import LeapProviderX509Info
+from pixelated.exceptions import *
+from pixelated.provider import NotEnoughFreeMemory
+from pixelated.provider.docker import DOCKER_MEMORY_LIMIT_IN_BYTES
+from pixelated.provider.docker.multi_host import MultiHostDockerProvider, parse_docker_host
+from pixelated.provider.docker.pixelated_adapter import PixelatedDockerAdapter
+from pixelated.users import UserConfig
+
+
+class FakeDocker(object):
+    """Keeps track of the containers of one fake docker host"""
+
+    def __init__(self, total_memory):
+        self.running = {}
+        self.client = MagicMock()
+        self.client.info.return_value = {'MemTotal': total_memory}
+        self.client.images.return_value = [{'RepoTags': ['pixelated:latest', 'pixelated/logspout:latest']}]
+        self.client.wait.return_value = 0
+        self.client.create_container.side_effect = lambda *args, **kwargs: {'Id': kwargs.get('name')}
+        self.client.containers.side_effect = self._containers
+        self.client.start.side_effect = self._start
+        self.client.stop.side_effect = lambda container, timeout: self.running.pop(container['Names'][0][1:])
+
+    def _containers(self, all=False):
+        return [{'Names': ['/%s' % name], 'Ports': [{'PublicPort': port}]} for name, port in self.running.iteritems()]
+
+    def _start(self, container, port_bindings=None, **kwargs):
+        if port_bindings and container.get('Id'):
+            self.running[container['Id']] = port_bindings.values()[0][1]
+
+
+class MultiHostDockerProviderTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = TempDir()
+        self.root_path = self._tmpdir.name
+        self._adapter = MagicMock(wraps=PixelatedDockerAdapter('example.org'))
+        self._adapter.docker_image_name.return_value = 'pixelated'
+        self.small = FakeDocker(2 * DOCKER_MEMORY_LIMIT_IN_BYTES)
+        self.big = FakeDocker(10 * DOCKER_MEMORY_LIMIT_IN_BYTES)
+        self.dockers = {'tcp://small:2375': self.small, 'tcp://big:2375': self.big}
+
+        patcher = patch('pixelated.provider.docker.docker.Client')
+        self.addCleanup(patcher.stop)
+        docker_mock = patcher.start()
+        docker_mock.side_effect = lambda base_url, version: self.dockers[base_url].client
+
+    def tearDown(self):
+        self._tmpdir.dissolve()
+
+    def test_parse_docker_host(self):
+        self.assertEqual(('tcp://10.0.0.2:2375', '10.0.0.2'), parse_docker_host('tcp://10.0.0.2:2375'))
+        self.assertEqual(('tcp://docker:2375', '10.0.0.2'), parse_docker_host('tcp://docker:2375=10.0.0.2'))
+        self.assertEqual(('unix://var/run/docker.sock', '127.0.0.1'), parse_docker_host('unix://var/run/docker.sock'))
+
+    def test_agents_get_placed_on_host_with_most_free_memory(self):
+        provider = self._create_initialized_provider()
+
+        provider.start(self._user_config('first'))
+
+        self.assertEqual('big', provider.placement('first'))
+        self.assertEqual(['first'], self.big.running.keys())
+        self.assertEqual({'state': 'running', 'port': 5000, 'host': 'big'}, provider.status('first'))
+
+    def test_agent_ports_get_published_on_host_address(self):
+        provider = self._create_initialized_provider()
+
+        provider.start(self._user_config('first'))
+
+        self.big.client.start.assert_any_call({'Id': 'first'}, binds=ANY, extra_hosts=ANY, port_bindings={4567: ('big', 5000)})
+
+    def test_host_with_fewer_agents_wins_if_memory_is_equal(self):
+        self.big.client.info.return_value = {'MemTotal': 2 * DOCKER_MEMORY_LIMIT_IN_BYTES}
+        provider = self._create_initialized_provider()
+
+        provider.start(self._user_config('first'))
+        provider.start(self._user_config('second'))
+
+        self.assertEqual(1, len(self.small.running))
+        self.assertEqual(1, len(self.big.running))
+
+    def test_start_fails_if_all_hosts_are_full(self):
+        self.big.client.info.return_value = {'MemTotal': DOCKER_MEMORY_LIMIT_IN_BYTES}
+        self.small.client.info.return_value = {'MemTotal': DOCKER_MEMORY_LIMIT_IN_BYTES}
+        provider = self._create_initialized_provider()
+        provider.start(self._user_config('first'))
+        provider.start(self._user_config('second'))
+
+        self.assertRaises(NotEnoughFreeMemory, provider.start, self._user_config('third'))
+
+    def test_agent_cannot_be_started_twice(self):
+        provider = self._create_initialized_provider()
+        user_config = self._user_config('first')
+        provider.start(user_config)
+
+        self.assertRaises(InstanceAlreadyRunningError, provider.start, user_config)
+
+    def test_stop_stops_agent_on_its_host(self):
+        provider = self._create_initialized_provider()
+        provider.start(self._user_config('first'))
+
+        provider.stop('first')
+
+        self.assertEqual({}, self.big.running)
+        self.assertEqual({'state': 'stopped'}, provider.status('first'))
+        self.assertRaises(InstanceNotRunningError, provider.stop, 'first')
+
+    def test_running_agents_are_rediscovered_on_initialize(self):
+        self.small.running['existing'] = 5003
+
+        provider = self._create_initialized_provider()
+
+        self.assertEqual('small', provider.placement('existing'))
+        self.assertEqual(['existing'], provider.list_running())
+        self.assertEqual({'state': 'running', 'port': 5003, 'host': 'small'}, provider.status('existing'))
+
+    def test_credentials_get_passed_to_host_agent_is_placed_on(self):
+        provider = self._create_initialized_provider()
+        user_config = self._user_config('first')
+        provider.pass_credentials_to_agent(user_config, 'secret')
+
+        with patch('pixelated.provider.docker.CredentialsToDockerStdinWriter') as writer_mock:
+            provider.start(user_config)
+
+        writer_mock.assert_called_once_with('tcp://big:2375', 'first', 'leap_provider_hostname', 'first', 'secret')
+
+    def test_hosts_failing_to_initialize_are_skipped(self):
+        self.small.client.images.side_effect = Exception('docker is down')
+
+        provider = self._create_initialized_provider()
+        provider.start(self._user_config('first'))
+
+        self.assertFalse(provider.initializing)
+        self.assertEqual(['first'], self.big.running.keys())
+
+    @patch('pixelated.provider.docker.multi_host.Thread')
+    def test_failed_hosts_are_added_back_once_they_initialize(self, thread_mock):
+        self.small.client.images.side_effect = Exception('docker is down')
+        self.small.running['orphan'] = 5003
+        provider = self._create_initialized_provider()
+        thread_mock.return_value.start.assert_called_once_with()
+        self.assertEqual([], provider.list_running())
+
+        provider.retry_failed_hosts()
+        self.assertEqual([], provider.list_running())
+        self.small.client.images.side_effect = None
+        provider.retry_failed_hosts()
+
+        self.assertEqual(['orphan'], provider.list_running())
+        self.assertEqual('small', provider.placement('orphan'))
+
+    def test_reset_data_uses_host_agent_was_placed_on(self):
+        provider = self._create_initialized_provider()
+        user_config = self._user_config('first')
+        provider.start(user_config)
+        provider.stop('first')
+        small, big = provider._hosts
+
+        with patch.object(small.provider, 'reset_data') as small_reset, patch.object(big.provider, 'reset_data') as big_reset:
+            provider.reset_data(user_config)
+
+        big_reset.assert_called_once_with(user_config)
+        self.assertFalse(small_reset.called)
+
+    def test_migrate_moves_agent_and_syncs_data_twice(self):
+        data_sync = MagicMock()
+        provider = self._create_initialized_provider(data_sync=data_sync)
+        user_config = self._user_config('first')
+        provider.pass_credentials_to_agent(user_config, 'secret')
+        with patch('pixelated.provider.docker.CredentialsToDockerStdinWriter') as writer_mock:
+            provider.start(user_config)
+
+            provider.migrate(user_config, 'small')
+
+        data_path = join(user_config.path, 'data')
+        self.assertEqual([call('big', 'small', data_path), call('big', 'small', data_path)], data_sync.sync.call_args_list)
+        self.assertEqual({}, self.big.running)
+        self.assertEqual(['first'], self.small.running.keys())
+        self.assertEqual('small', provider.placement('first'))
+        writer_mock.assert_called_with('tcp://small:2375', 'first', 'leap_provider_hostname', 'first', 'secret')
+
+    def test_agent_is_only_reported_migrating_once_it_got_stopped(self):
+        data_sync = MagicMock()
+        provider = self._create_initialized_provider(data_sync=data_sync)
+        user_config = self._user_config('first')
+        provider.start(user_config)
+        states = []
+        data_sync.sync.side_effect = lambda *args: states.append(provider.status('first')['state'])
+
+        provider.migrate(user_config, 'small')
+
+        self.assertEqual(['running', 'migrating'], states)
+        self.assertEqual('running', provider.status('first')['state'])
+
+    def test_failed_migration_restarts_agent_on_old_host(self):
+        data_sync = MagicMock()
+        provider = self._create_initialized_provider(data_sync=data_sync)
+        user_config = self._user_config('first')
+        provider.start(user_config)
+        data_sync.sync.side_effect = [None, Exception('rsync failed')]
+
+        self.assertRaises(Exception, provider.migrate, user_config, 'small')
+
+        self.assertEqual(['first'], self.big.running.keys())
+        self.assertEqual({}, self.small.running)
+        self.assertEqual('big', provider.placement('first'))
+
+    def test_migrate_to_full_host_fails(self):
+        self.small.client.info.return_value = {'MemTotal': DOCKER_MEMORY_LIMIT_IN_BYTES}
+        self.small.running['other'] = 5000
+        provider = self._create_initialized_provider()
+        user_config = self._user_config('first')
+        provider.start(user_config)
+
+        self.assertRaises(NotEnoughFreeMemory, provider.migrate, user_config, 'small')
+        self.assertEqual(['first'], self.big.running.keys())
+
+    def test_migrate_requires_running_agent_and_known_host(self):
+        provider = self._create_initialized_provider()
+        user_config = self._user_config('first')
+
+        self.assertRaises(InstanceNotRunningError, provider.migrate, user_config, 'small')
+        provider.start(user_config)
+        self.assertRaises(ValueError, provider.migrate, user_config, 'unknown')
+
+    def test_rebalance_plan_moves_movable_agents_off_full_host(self):
+        for name in ['a', 'b']:
+            self.small.running[name] = 5000
+        provider = self._create_initialized_provider()
+
+        moves = provider.rebalance_plan(lambda name: name == 'b')
+
+        self.assertEqual([{'agent': 'b', 'source': 'small', 'target': 'big'}], moves)
+
+    def _create_initialized_provider(self, data_sync=None):
+        provider = MultiHostDockerProvider(self._adapter, 'leap_provider_hostname', LeapProviderX509Info(), [('tcp://small:2375', 'small'), ('tcp://big:2375', 'big')], data_sync=data_sync)
+        provider.initialize()
+        return provider
+
+    def _user_config(self, name):
+        path = join(self.root_path, name)
+        os.makedirs(path)
+        return UserConfig(name, path)
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 from collections import namedtuple
+import threading
+import time
 import unittest
 import os
 import stat
@@ -25,6 +27,7 @@ from mock import MagicMock, patch
 
 from pixelated.exceptions import *
 from pixelated.provider import NotEnoughFreeMemory
+from pixelated.provider.base_provider import run_in_parallel
 from pixelated.provider.fork import ForkProvider
 from pixelated.provider.fork.adapter import Adapter
 from pixelated.provider.fork.fork_runner import ForkedProcess
@@ -98,6 +101,15 @@ class ForkProviderTest(unittest.TestCase):
 
         self.assertEqual({'port': 1234, 'state': 'running'}, status)
 
+    def test_that_status_reports_transitional_state(self):
+        self.provider.begin_transition('test', 'starting')
+
+        self.assertEqual({'state': 'starting'}, self.provider.status('test'))
+
+        self.provider.end_transition('test')
+
+        self.assertEqual({'state': 'stopped'}, self.provider.status('test'))
+
     def assert_config_file(self, filename, name, hashed_password, salt):
         with open(filename, 'r') as file:
             content = file.read()
@@ -145,6 +157,124 @@ class ForkProviderTest(unittest.TestCase):
         process.memory_usage.return_value = free_memory - 1
         self.provider.start(second_config)
 
+    @patch('pixelated.provider.fork.psutil.virtual_memory')
+    def test_memory_of_pending_starts_is_reserved(self, vm_mock):
+        svmem = namedtuple('svmem', ['free'])
+        vm_mock.return_value = svmem(1024 * 1024)
+        process = MagicMock(spec=ForkedProcess)
+        process.memory_usage.return_value = 600 * 1024
+        self.runner.start.return_value = process
+        self.provider.start(self._user_config('first'))
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_start(name):
+            started.set()
+            release.wait(5)
+            return process
+        self.runner.start.side_effect = slow_start
+        slow = threading.Thread(target=self.provider.start, args=(self._user_config('slow'),))
+        slow.start()
+        started.wait(5)
+
+        second_config = self._user_config('second')
+        try:
+            self.assertRaises(NotEnoughFreeMemory, self.provider.start, second_config)
+        finally:
+            release.set()
+            slow.join(5)
+
+        self.runner.start.side_effect = None
+        vm_mock.return_value = svmem(10 * 1024 * 1024)
+        self.provider.start(second_config)
+
+    def test_run_in_parallel_limits_parallelism(self):
+        lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+        def operation(name):
+            with lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(0.01)
+            with lock:
+                self.active -= 1
+
+        run_in_parallel(operation, [str(i) for i in range(20)], parallelism=3)
+
+        self.assertEqual(3, self.max_active)
+
+    def test_concurrent_operations_only_serialize_per_agent(self):
+        lock = threading.Lock()
+        active = dict()
+        self.max_active_per_agent = 0
+        configs = dict((name, self._user_config(name)) for name in ['one', 'two', 'three', 'four'])
+        errors = []
+
+        def track(delta, name):
+            with lock:
+                active[name] = active.get(name, 0) + delta
+                self.max_active_per_agent = max(self.max_active_per_agent, active[name])
+
+        def start_process(name):
+            track(1, name)
+            time.sleep(0.002)
+            track(-1, name)
+            process = MagicMock(spec=ForkedProcess)
+            process.memory_usage.return_value = 1024
+            process.port = 5000
+            return process
+        self.runner.start.side_effect = start_process
+
+        def hammer(seed):
+            names = sorted(configs.keys())
+            for i in range(40):
+                name = names[(seed + i) % len(names)]
+                try:
+                    operation = (seed * 7 + i) % 4
+                    if operation == 0:
+                        self.provider.start(configs[name])
+                    elif operation == 1:
+                        self.provider.stop(name)
+                    elif operation == 2:
+                        self.assertIn(self.provider.status(name)['state'], ('running', 'stopped'))
+                    else:
+                        self.provider.memory_usage()
+                except (InstanceAlreadyRunningError, InstanceNotRunningError):
+                    pass
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=hammer, args=(seed,)) for seed in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(1, self.max_active_per_agent)
+        for name in self.provider.list_running():
+            self.assertEqual({'state': 'running', 'port': 5000}, self.provider.status(name))
+
+    def test_slow_start_does_not_block_other_agents(self):
+        self._init_runner_memory_usage()
+        release = threading.Event()
+        new_process = self.runner.start.side_effect
+        self.runner.start.side_effect = lambda name: release.wait(5) and new_process() if name == 'slow' else new_process()
+        slow_start = threading.Thread(target=self.provider.start, args=(self._user_config('slow'),))
+        slow_start.start()
+
+        try:
+            self.provider.start(self._user_config('fast'))
+            self.provider.stop('fast')
+        finally:
+            release.set()
+            slow_start.join()
+
+        self.assertEqual(['slow'], self.provider.list_running())
+
     def _init_runner_memory_usage(self):
         def new_process(*args):
             process = MagicMock(spec=ForkedProcess)
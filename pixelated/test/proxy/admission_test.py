@@ -0,0 +1,103 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import socket
+import time
+
+import tornado.web
+from tornado.iostream import IOStream
+from tornado.testing import AsyncHTTPTestCase
+
+from pixelated.common.metrics import Metrics
+from pixelated.proxy.admission import Admission, AdmissionHTTPServer
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        self.application.settings['io_loop'].add_timeout(time.time() + 0.2, lambda: self.finish('done'))
+
+
+class AdmissionTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.admission = Admission(max_connections=2, max_requests_per_ip=1, header_timeout=0.2, body_timeout=0.2, retry_after=3, metrics=self.metrics)
+        super(AdmissionTest, self).setUp()
+
+    def get_app(self):
+        return tornado.web.Application([(r'/slow', SlowHandler)], io_loop=self.io_loop)
+
+    def get_http_server(self):
+        return AdmissionHTTPServer(self._app, self.admission, io_loop=self.io_loop)
+
+    def _connect(self):
+        stream = IOStream(socket.socket(), io_loop=self.io_loop)
+        stream.connect(('127.0.0.1', self.get_http_port()), self.stop)
+        self.wait()
+        return stream
+
+    def _fetch_concurrently(self, count):
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == count:
+                self.stop()
+
+        for _ in range(count):
+            self.http_client.fetch(self.get_url('/slow'), on_response)
+        self.wait()
+        return sorted(response.code for response in responses), responses
+
+    def test_sheds_concurrent_requests_over_per_ip_limit(self):
+        codes, responses = self._fetch_concurrently(2)
+
+        self.assertEqual([200, 503], codes)
+        rejected = [response for response in responses if response.code == 503][0]
+        self.assertEqual('3', rejected.headers['Retry-After'])
+        self.assertEqual(1, self.metrics.snapshot()['counters']['admission.rejected.requests'])
+
+    def test_sheds_connections_over_limit(self):
+        idle = [self._connect(), self._connect()]
+
+        response = self.fetch('/slow')
+
+        self.assertEqual(503, response.code)
+        self.assertEqual(1, self.metrics.snapshot()['counters']['admission.rejected.connections'])
+        for stream in idle:
+            stream.close()
+
+    def test_closes_connections_of_clients_too_slow_to_send_headers(self):
+        stream = self._connect()
+        stream.write('GET /slow HTTP/1.1\r\nHost: localhost\r\n')
+        stream.read_until_close(self.stop)
+
+        self.assertEqual('', self.wait(timeout=2))
+        self.assertEqual(1, self.metrics.snapshot()['counters']['admission.timeouts.headers'])
+        self.assertEqual(0, self.admission.stats()['connections'])
+
+    def test_closes_connections_of_clients_too_slow_to_send_body(self):
+        stream = self._connect()
+        stream.write('POST /slow HTTP/1.1\r\nHost: localhost\r\nContent-Length: 10\r\n\r\nabc')
+        stream.read_until_close(self.stop)
+
+        self.wait(timeout=2)
+        self.assertEqual(1, self.metrics.snapshot()['counters']['admission.timeouts.body'])
+
+    def test_releases_request_slots_when_done(self):
+        self.assertEqual(200, self.fetch('/slow').code)
+        self.assertEqual(200, self.fetch('/slow').code)
+
+        self.assertEqual(0, self.admission.stats()['requests'])
@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import MagicMock
+
+from pixelated.common.metrics import Metrics
+from pixelated.proxy.breaker import AgentHealth
+
+
+class AgentHealthTest(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = MagicMock()
+        self.on_open = MagicMock()
+        self.metrics = Metrics()
+        self.health = AgentHealth(failure_threshold=2, reset_timeout=30, metrics=self.metrics, on_open=self.on_open, io_loop=self.io_loop)
+        self.probe = MagicMock()
+
+    def _run_scheduled_probe(self, healthy):
+        scheduled = self.io_loop.add_timeout.call_args[0][1]
+        self.io_loop.add_timeout.reset_mock()
+        scheduled()
+        callback = self.probe.call_args[0][0]
+        callback(healthy)
+
+    def test_opens_after_consecutive_failures(self):
+        self.health.failure('alice', self.probe)
+        self.assertTrue(self.health.allow('alice'))
+
+        self.health.failure('alice', self.probe)
+
+        self.assertFalse(self.health.allow('alice'))
+        self.assertTrue(self.health.allow('bob'))
+        self.on_open.assert_called_once_with('alice')
+        self.assertTrue(1 <= self.health.retry_after('alice') <= 30)
+        self.assertEqual(['alice'], self.health.stats()['open'])
+
+    def test_success_resets_failure_count(self):
+        self.health.failure('alice', self.probe)
+        self.health.success('alice', 0.1)
+        self.health.failure('alice', self.probe)
+
+        self.assertTrue(self.health.allow('alice'))
+        self.assertEqual({'alice': 0.1}, self.health.stats()['latency'])
+
+    def test_closes_once_probe_succeeds(self):
+        self.health.failure('alice', self.probe)
+        self.health.failure('alice', self.probe)
+
+        self._run_scheduled_probe(healthy=False)
+        self.assertFalse(self.health.allow('alice'))
+        self.assertTrue(self.io_loop.add_timeout.called)  # probes again later
+
+        self._run_scheduled_probe(healthy=True)
+        self.assertTrue(self.health.allow('alice'))
+        self.assertEqual({'breaker.opened': 1, 'breaker.closed': 1}, self.metrics.snapshot()['counters'])
+
+    def test_latency_is_moving_average(self):
+        self.health.success('alice', 1.0)
+        self.health.success('alice', 2.0)
+
+        self.assertAlmostEqual(1.2, self.health.stats()['latency']['alice'])
+
+    def test_closed_circuits_are_not_tracked(self):
+        self.health.failure('alice', self.probe)
+        self.health.failure('alice', self.probe)
+        self._run_scheduled_probe(healthy=True)
+        self.health.failure('bob', self.probe)
+        self.health.success('bob', 0.1)
+
+        self.assertEqual({}, self.health._agents)
+
+    def test_agent_at_new_address_resets_circuit(self):
+        self.health.failure('alice', self.probe, address=('host', 5000))
+        self.health.failure('alice', self.probe, address=('host', 5000))
+        self.assertFalse(self.health.allow('alice', ('host', 5000)))
+
+        self.assertTrue(self.health.allow('alice', ('other-host', 5002)))
+        self.assertTrue(self.health.allow('alice', ('host', 5000)))
+        self._run_scheduled_probe(healthy=False)
+        self.assertFalse(self.io_loop.add_timeout.called)  # the old probe stopped
+
+    def test_failure_at_new_address_counts_from_start(self):
+        self.health.failure('alice', self.probe, address=('host', 5000))
+        self.health.failure('alice', self.probe, address=('host', 5002))
+
+        self.assertTrue(self.health.allow('alice', ('host', 5002)))
+
+    def test_gone_agent_gets_forgotten(self):
+        self.health.failure('alice', self.probe)
+        self.health.failure('alice', self.probe)
+
+        self._run_scheduled_probe(healthy=None)
+
+        self.assertTrue(self.health.allow('alice'))
+        self.assertFalse(self.io_loop.add_timeout.called)
+        self.assertEqual(1, self.metrics.snapshot()['counters']['breaker.reset'])
@@ -0,0 +1,67 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import MagicMock
+from tornado.httputil import HTTPHeaders
+
+from pixelated.common.metrics import Metrics
+from pixelated.proxy.collapsing import RequestCollapser
+
+
+def _request(method='GET', uri='/mails?q=tag:inbox', **headers):
+    request = MagicMock()
+    request.method = method
+    request.uri = uri
+    request.headers = HTTPHeaders(headers)
+    return request
+
+
+class RequestCollapserTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.collapser = RequestCollapser(self.metrics)
+
+    def test_identical_gets_of_a_user_share_a_key(self):
+        self.assertEqual(self.collapser.key('alice', _request(Cookie='a=1')), self.collapser.key('alice', _request(Cookie='a=1')))
+
+    def test_key_differs_by_user_uri_and_relevant_headers(self):
+        key = self.collapser.key('alice', _request())
+
+        self.assertNotEqual(key, self.collapser.key('bob', _request()))
+        self.assertNotEqual(key, self.collapser.key('alice', _request(uri='/mails?q=tag:sent')))
+        self.assertNotEqual(key, self.collapser.key('alice', _request(Cookie='a=1')))
+        self.assertNotEqual(key, self.collapser.key('alice', _request(Range='bytes=0-1')))
+        self.assertEqual(key, self.collapser.key('alice', _request(**{'User-Agent': 'other tab'})))
+
+    def test_only_gets_of_known_users_get_collapsed(self):
+        self.assertIsNone(self.collapser.key('alice', _request(method='POST')))
+        self.assertIsNone(self.collapser.key(None, _request()))
+
+    def test_followers_wait_for_first_request(self):
+        key = self.collapser.key('alice', _request())
+        first, second, third = object(), object(), object()
+
+        self.assertFalse(self.collapser.join(key, first))
+        self.assertTrue(self.collapser.join(key, second))
+        self.assertTrue(self.collapser.join(key, third))
+
+        self.assertEqual([second, third], self.collapser.complete(key))
+        self.assertFalse(self.collapser.join(key, first))  # a new request once the last one completed
+        self.assertEqual({'collapsing.upstream': 2, 'collapsing.collapsed': 2}, self.metrics.snapshot()['counters'])
+
+    def test_complete_without_waiters(self):
+        self.assertEqual([], self.collapser.complete(('alice', '/')))
@@ -0,0 +1,75 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import zlib
+
+from mock import patch
+
+from pixelated.common.metrics import Metrics
+from pixelated.proxy.compression import Compression, parse_accept_encoding
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.compression = Compression(min_size=100, use_brotli=False)
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual({'gzip': 1.0, 'deflate': 0.5, 'br': 0.0}, parse_accept_encoding('gzip, deflate;q=0.5, br;q=0'))
+
+    def test_compresses_compressible_types_above_threshold(self):
+        self.assertEqual('gzip', self.compression.negotiate('gzip, deflate', 'application/json; charset=utf-8', 100))
+        self.assertEqual('gzip', self.compression.negotiate('*', 'text/html', None))
+
+    def test_does_not_compress_small_or_incompressible_responses(self):
+        self.assertIsNone(self.compression.negotiate('gzip', 'application/json', 99))
+        self.assertIsNone(self.compression.negotiate('gzip', 'image/png', 1000))
+        self.assertIsNone(self.compression.negotiate('gzip', None, 1000))
+
+    def test_respects_what_the_client_accepts(self):
+        self.assertIsNone(self.compression.negotiate('identity', 'text/html', 1000))
+        self.assertIsNone(self.compression.negotiate('gzip;q=0', 'text/html', 1000))
+        self.assertIsNone(self.compression.negotiate(None, 'text/html', 1000))
+
+    def test_prefers_brotli_if_available(self):
+        with patch('pixelated.proxy.compression.brotli'):
+            compression = Compression(min_size=0)
+
+        self.assertEqual('br', compression.negotiate('gzip, br', 'text/html', 1000))
+        self.assertEqual('gzip', compression.negotiate('gzip', 'text/html', 1000))
+
+    def test_gzip_compresses_incrementally_and_records_metrics(self):
+        metrics = Metrics()
+        compression = Compression(metrics=metrics)
+        data = '{"mails": []}' * 100
+
+        compressed = compression.compress('gzip', data)
+
+        self.assertEqual(data, zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual((1, len(data), len(compressed)), (counters['compression.gzip.responses'], counters['compression.gzip.bytes_in'], counters['compression.gzip.bytes_out']))
+        self.assertEqual(1, metrics.snapshot()['timers']['compression.gzip.cpu']['count'])
+
+    def test_stream_chunks_can_be_decoded_as_they_arrive(self):
+        metrics = Metrics()
+        stream = Compression(metrics=metrics).stream('gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        self.assertEqual('data: first\n\n', decompressor.decompress(stream.compress('data: first\n\n')))
+        self.assertEqual('data: last\n\n', decompressor.decompress(stream.compress('data: last\n\n')))
+        decompressor.decompress(stream.finish())
+
+        self.assertEqual('', decompressor.unused_data)
+        self.assertEqual(25, metrics.snapshot()['counters']['compression.gzip.bytes_in'])
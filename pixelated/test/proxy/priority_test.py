@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import MagicMock
+from tornado.httputil import HTTPHeaders
+
+from pixelated.common.metrics import Metrics
+from pixelated.proxy.priority import RequestClassifier, UpstreamScheduler, INTERACTIVE, BACKGROUND
+
+XHR = {'X-Requested-With': 'XMLHttpRequest'}
+
+
+def _request(uri, **headers):
+    request = MagicMock()
+    request.uri = uri
+    request.headers = HTTPHeaders(headers)
+    return request
+
+
+class RequestClassifierTest(unittest.TestCase):
+    def setUp(self):
+        self.classifier = RequestClassifier([r'^/mails\?q=tag:inbox', r'^/tags'])
+
+    def test_matching_xhr_requests_are_background(self):
+        self.assertEqual(BACKGROUND, self.classifier.classify(_request('/tags', **XHR)))
+        self.assertEqual(INTERACTIVE, self.classifier.classify(_request('/mail/1234', **XHR)))
+
+    def test_navigation_is_interactive_even_if_matching(self):
+        self.assertEqual(INTERACTIVE, self.classifier.classify(_request('/tags')))
+
+    def test_prefetches_are_background(self):
+        self.assertEqual(BACKGROUND, self.classifier.classify(_request('/mail/1234', Purpose='prefetch')))
+
+    def test_explicit_priority_wins(self):
+        headers = dict(XHR, **{'X-Pixelated-Priority': 'interactive'})
+        self.assertEqual(INTERACTIVE, self.classifier.classify(_request('/tags', **headers)))
+        self.assertEqual(BACKGROUND, self.classifier.classify(_request('/mail/1', **{'X-Pixelated-Priority': 'Background'})))
+
+
+class UpstreamSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.scheduler = UpstreamScheduler(2, self.metrics)
+        self.started = []
+
+    def _submit(self, name, agent='alice', priority=INTERACTIVE):
+        self.scheduler.submit(agent, priority, lambda: self.started.append(name))
+
+    def test_starts_requests_up_to_the_limit_per_agent(self):
+        self._submit('a1')
+        self._submit('a2')
+        self._submit('a3')
+        self._submit('b1', agent='bob')
+
+        self.assertEqual(['a1', 'a2', 'b1'], self.started)
+        self.assertEqual({'agents': 2, 'in_flight': 3, 'waiting': {INTERACTIVE: 1, BACKGROUND: 0}}, self.scheduler.stats())
+
+    def test_waiting_interactive_requests_go_first(self):
+        self._submit('busy1')
+        self._submit('busy2')
+        self._submit('poll1', priority=BACKGROUND)
+        self._submit('poll2', priority=BACKGROUND)
+        self._submit('click')
+
+        self.scheduler.release('alice', INTERACTIVE, 0)
+        self.scheduler.release('alice', INTERACTIVE, 0)
+
+        self.assertEqual(['busy1', 'busy2', 'click', 'poll1'], self.started)
+
+    def test_forgets_idle_agents_and_records_metrics(self):
+        self._submit('a1', priority=BACKGROUND)
+        self.scheduler.release('alice', BACKGROUND, 0)
+
+        self.assertEqual(0, self.scheduler.stats()['agents'])
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(1, snapshot['counters']['priority.background.requests'])
+        self.assertEqual(1, snapshot['timers']['priority.background.queue_wait']['count'])
+        self.assertEqual(1, snapshot['timers']['priority.background.latency']['count'])
@@ -14,24 +14,41 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import Cookie
+import functools
+import json
+import zlib
 import urllib
 import time
 import tornado.httpserver
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_unix_socket
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.websocket import WebSocketHandler, websocket_connect
+import tornado.web
+import tornado.httputil
+from os.path import join
+from tempdir import TempDir
 import threading
 
 from mock import MagicMock, patch, ANY
 import tornado
-from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.testing import AsyncHTTPTestCase, gen_test, bind_unused_port
 
 from pixelated.client.dispatcher_api_client import PixelatedHTTPError, PixelatedNotAvailableHTTPError
-from pixelated.proxy import DispatcherProxy, MainHandler
+from pixelated.proxy import DispatcherProxy, MainHandler, RestartServerThread, _end_to_end_headers, STATIC_PATH
+from pixelated.proxy.breaker import AgentHealth
+from pixelated.proxy.collapsing import RequestCollapser
+from pixelated.proxy.priority import RequestClassifier, UpstreamScheduler
 from pixelated.common import latest_available_ssl_version, DEFAULT_CIPHERS
-from bottle import request, route, run, ServerAdapter, Bottle
+from pixelated.common.static_assets import build_static_assets
+from bottle import request, response, route, run, ServerAdapter, Bottle, HTTPResponse
 
 __author__ = 'fbernitt'
 
 
+MAILS = '{"mails": [%s]}' % ', '.join(['{"subject": "Hello"}'] * 200)
+
+
 class MyWSGIRefServer(ServerAdapter):
     server = None
 
@@ -67,6 +84,31 @@ class Server(object):
     def run(self):
         app = Bottle()
 
+        @app.route("/tagged")
+        def tagged():
+            if request.headers.get('If-None-Match') == '"v1"':
+                return HTTPResponse(status=304, headers={'ETag': '"v1"'})
+            return HTTPResponse('tagged content', headers={'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+
+        @app.route("/ranged")
+        def ranged():
+            return HTTPResponse('0123', status=206, headers={'Content-Range': 'bytes 0-3/10', 'Accept-Ranges': 'bytes'})
+
+        @app.route("/missing")
+        def missing():
+            return HTTPResponse('no such mail', status=404)
+
+        @app.route("/mails")
+        def mails():
+            response.content_type = 'application/json'
+            return MAILS
+
+        @app.route("/cookies")
+        def cookies():
+            response.set_cookie('first', '1')
+            response.set_cookie('second', '2')
+            return 'cookies'
+
         @app.route("/")
         @app.route("/<url:re:.+>")
         def catch_all_requests(url=None):
@@ -85,6 +127,61 @@ class Server(object):
         self._thread.join()
 
 
+class AgentOnUnixSocket(object):
+    def __init__(self, socket_path, io_loop):
+        class Handler(tornado.web.RequestHandler):
+            def get(self):
+                self.write('You requested %s via unix socket\n' % self.request.path)
+
+        self._server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/.*', Handler)]), io_loop=io_loop)
+        self._server.add_socket(bind_unix_socket(socket_path))
+
+    def stop(self):
+        self._server.stop()
+
+
+class AsyncAgent(object):
+    """Agent that echoes websocket messages, streams events until the test releases it and answers slowly"""
+
+    def __init__(self, io_loop):
+        self.release_stream = None
+        self.slow_requests = 0
+        self.slow_uris = []
+
+        class EchoHandler(WebSocketHandler):
+            def on_message(self, message):
+                self.write_message('echo %s' % message)
+
+        agent = self
+
+        class EventsHandler(tornado.web.RequestHandler):
+            @tornado.web.asynchronous
+            def get(self):
+                self.set_header('Content-Type', 'text/event-stream')
+                self.write('data: first\n\n')
+                self.flush()
+                agent.release_stream = self._send_last_event
+
+            def _send_last_event(self):
+                self.write('data: last\n\n')
+                self.finish()
+
+        class SlowHandler(tornado.web.RequestHandler):
+            @tornado.web.asynchronous
+            def get(self):
+                agent.slow_requests += 1
+                agent.slow_uris.append(self.request.uri)
+                answer = 'slow answer %d' % agent.slow_requests
+                io_loop.add_timeout(time.time() + 0.2, lambda: self.finish(answer))
+
+        sock, self.port = bind_unused_port()
+        self._server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/ws', EchoHandler), (r'/events', EventsHandler), (r'/slow.*', SlowHandler)]), io_loop=io_loop)
+        self._server.add_socket(sock)
+
+    def stop(self):
+        self._server.stop()
+
+
 class DispatcherProxyTest(AsyncHTTPTestCase):
     def setUp(self):
         self.client = MagicMock()
@@ -341,6 +438,317 @@ class DispatcherProxyTest(AsyncHTTPTestCase):
         self.assertEqual(401, response.code)
         self.assertEqual('', cookies['pixelated_user'].value)
 
+    def test_service_unavailable_while_agent_is_starting(self):
+        self.client.get_agent_runtime.side_effect = [{'state': 'running', 'port': Server.PORT}, {'state': 'starting'}]
+
+        with Server():
+            self._fetch_auth_cookie()
+            response = self._get('/')
+
+        self.assertEqual(503, response.code)
+        self.assertEqual('1', response.headers['Retry-After'])
+        self.assertFalse(self.client.stop.called)
+
+    def test_forwards_to_host_the_agent_runs_on(self):
+        self.client.get_agent_runtime.side_effect = [{'state': 'running', 'port': Server.PORT, 'host': Server.HOSTNAME}, {'state': 'running', 'port': Server.PORT, 'host': '127.0.0.2'}]
+
+        with Server():
+            self._fetch_auth_cookie()
+            response = self._get('/some/url')
+
+        self.assertEqual(503, response.code)  # nothing listens on 127.0.0.2
+        self.assertRegexpMatches(response.body, 'Could not connect to instance tester: .*')
+
+    def test_forwards_to_agent_unix_socket(self):
+        tmpdir = TempDir()
+        socket_path = join(tmpdir.name, 'agent.sock')
+        agent = AgentOnUnixSocket(socket_path, self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'socket': socket_path}
+        try:
+            self._fetch_auth_cookie()
+            response = self._get('/some/url')
+        finally:
+            agent.stop()
+            tmpdir.dissolve()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('You requested /some/url via unix socket\n', response.body)
+
+    def test_tunnels_websocket_to_agent(self):
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        try:
+            self._fetch_auth_cookie()
+            request = tornado.httpclient.HTTPRequest(self.get_url('/ws').replace('http', 'ws'), headers={'Cookie': self.cookies.output(header='').strip()})
+            websocket_connect(request, io_loop=self.io_loop, callback=self.stop)
+            connection = self.wait().result()
+            connection.write_message('hello')
+            connection.read_message(self.stop)
+            message = self.wait().result()
+            connection.close()
+        finally:
+            agent.stop()
+
+        self.assertEqual('echo hello', message)
+
+    def test_websocket_upgrade_fails_if_agent_is_not_reachable(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': port}
+
+        self._fetch_auth_cookie()
+        response = self._get('/ws', extra_headers={'Upgrade': 'websocket', 'Connection': 'Upgrade'})
+
+        self.assertEqual(503, response.code)
+
+    def test_streams_event_stream_responses(self):
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        chunks = []
+
+        def on_chunk(chunk):
+            chunks.append(chunk)
+            if agent.release_stream:
+                agent.release_stream()  # only happens if the proxy passed the first event on before the agent finished
+                agent.release_stream = None
+
+        try:
+            self._fetch_auth_cookie()
+            self.http_client.fetch(self.get_url('/events'), self.stop, streaming_callback=on_chunk,
+                                   headers={'Cookie': self.cookies.output(header='').strip(), 'Accept': 'text/event-stream'})
+            response = self.wait()
+        finally:
+            agent.stop()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('text/event-stream', response.headers['Content-Type'])
+        self.assertEqual('data: first\n\ndata: last\n\n', ''.join(chunks))
+
+    def test_compresses_event_stream_chunk_by_chunk(self):
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        events = []
+        http_client = SimpleAsyncHTTPClient(self.io_loop, force_instance=True)  # passes the encoded chunks on as they are
+
+        def on_chunk(chunk):
+            events.append(decompressor.decompress(chunk))
+            if agent.release_stream:
+                agent.release_stream()  # only happens if the first event could be decoded before the agent finished
+                agent.release_stream = None
+
+        try:
+            self._fetch_auth_cookie()
+            http_client.fetch(self.get_url('/events'), self.stop, streaming_callback=on_chunk, use_gzip=False,
+                              headers={'Cookie': self.cookies.output(header='').strip(), 'Accept': 'text/event-stream', 'Accept-Encoding': 'gzip'})
+            response = self.wait()
+        finally:
+            http_client.close()
+            agent.stop()
+
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('data: first\n\n', events[0])
+        self.assertEqual('data: first\n\ndata: last\n\n', ''.join(events) + decompressor.flush())
+
+    def _fetch_concurrently(self, *requests, **kwargs):
+        """Sends the requests at once, the ones after the first with a delay if given"""
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == len(requests):
+                self.stop()
+
+        def fetch(url, headers):
+            headers = dict(headers, Cookie=self.cookies.output(header='').strip())
+            self.http_client.fetch(self.get_url(url), on_response, headers=headers)
+
+        fetch(*requests[0])
+        for url, headers in requests[1:]:
+            self.io_loop.add_timeout(time.time() + kwargs.get('delay', 0), functools.partial(fetch, url, headers))
+        self.wait()
+        return responses
+
+    def test_identical_concurrent_gets_are_not_collapsed_by_default(self):
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        try:
+            self._fetch_auth_cookie()
+            self._fetch_concurrently(('/slow', {}), ('/slow', {}))
+        finally:
+            agent.stop()
+
+        self.assertEqual(2, agent.slow_requests)
+
+    def test_collapses_identical_concurrent_gets(self):
+        self._dispatcher._collapser = RequestCollapser(self._dispatcher._metrics)
+        self._app = self._dispatcher.create_app()
+        self.http_server.request_callback = self._app
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        try:
+            self._fetch_auth_cookie()
+            responses = self._fetch_concurrently(('/slow', {}), ('/slow', {}), ('/slow', {'Accept': 'text/plain'}))
+        finally:
+            agent.stop()
+
+        self.assertEqual(2, agent.slow_requests)
+        self.assertEqual([200, 200, 200], [response.code for response in responses])
+        self.assertEqual(2, len([response for response in responses if response.body == 'slow answer 1']))
+        stats = json.loads(self._get('/dispatcher_stats').body)
+        self.assertEqual(1, stats['counters']['collapsing.collapsed'])
+
+    def test_interactive_requests_overtake_background_ones_when_agent_is_busy(self):
+        self._dispatcher._scheduler = UpstreamScheduler(1, self._dispatcher._metrics)
+        self._dispatcher._classifier = RequestClassifier([r'^/slow/poll'])
+        self.http_server.request_callback = self._dispatcher.create_app()
+        agent = AsyncAgent(self.io_loop)
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': agent.port}
+        try:
+            self._fetch_auth_cookie()
+            responses = self._fetch_concurrently(('/slow/first', {}), ('/slow/poll', {'X-Requested-With': 'XMLHttpRequest'}), ('/slow/open-mail', {'X-Requested-With': 'XMLHttpRequest'}), delay=0.05)
+        finally:
+            agent.stop()
+
+        self.assertEqual([200, 200, 200], [response.code for response in responses])
+        self.assertEqual(['/slow/first', '/slow/open-mail', '/slow/poll'], agent.slow_uris)
+        stats = json.loads(self._get('/dispatcher_stats').body)
+        self.assertEqual(2, stats['counters']['priority.interactive.requests'])
+        self.assertEqual(1, stats['timers']['priority.background.latency']['count'])
+        self.assertEqual({'agents': 0, 'in_flight': 0, 'waiting': {'interactive': 0, 'background': 0}}, stats['scheduler'])
+
+    def test_requests_to_unresponsive_agent_fail_fast(self):
+        self._dispatcher._health = AgentHealth(failure_threshold=2, reset_timeout=30, metrics=self._dispatcher._metrics)
+        self.http_server.request_callback = self._dispatcher.create_app()
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+        self._fetch_auth_cookie()
+
+        with patch('pixelated.proxy.AsyncHTTPClient') as http_client:
+            http_client.return_value.fetch.side_effect = lambda request, callback: callback(MagicMock(code=599, error='timeout'))
+            self._get('/some/url')
+            self._get('/some/url')
+            response = self._get('/some/url')
+
+        self.assertEqual(2, http_client.return_value.fetch.call_count)
+        self.assertEqual(503, response.code)
+        self.assertTrue(0 < int(response.headers['Retry-After']) <= 30)
+        stats = json.loads(self._get('/dispatcher_stats').body)
+        self.assertEqual(['tester'], stats['circuits']['open'])
+
+    def test_circuit_gets_probed_where_agent_runs_now(self):
+        self._dispatcher._health = AgentHealth(failure_threshold=1, reset_timeout=30, metrics=self._dispatcher._metrics, io_loop=MagicMock())
+        self.http_server.request_callback = self._dispatcher.create_app()
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+        self._fetch_auth_cookie()
+
+        with patch('pixelated.proxy.AsyncHTTPClient') as http_client:
+            http_client.return_value.fetch.side_effect = lambda request, callback: callback(MagicMock(code=599, error='timeout'))
+            self._get('/some/url')
+            self.client.get_agent_runtime.return_value = {'state': 'running', 'port': 5555}
+            http_client.return_value.fetch.side_effect = lambda request, callback: callback(MagicMock(code=200))
+            self._dispatcher._health._io_loop.add_timeout.call_args[0][1]()
+
+            self.assertEqual('http://127.0.0.1:5555/', http_client.return_value.fetch.call_args[0][0].url)
+        self.assertEqual([], json.loads(self._get('/dispatcher_stats').body)['circuits']['open'])
+
+    def test_restart_thread_starts_agent_once_stopped(self):
+        self.client.get_agent_runtime.side_effect = [{'state': 'running'}, {'state': 'stopped'}]
+
+        with patch('pixelated.proxy.time.sleep') as sleep:
+            RestartServerThread(self.client, 'tester').run()
+
+        self.assertEqual(1, sleep.call_count)
+        self.client.stop.assert_called_once_with('tester')
+        self.client.start.assert_called_once_with('tester')
+
+    def test_static_assets_get_served_from_shared_cache(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT, 'version': 'b4f10a2395ab'}
+
+        with Server():
+            self._fetch_auth_cookie()
+            first = self._get('/assets/app.js')
+            self.assertEqual('You requested /assets/app.js\n', first.body)
+        second = self._get('/assets/app.js')  # agent is gone, must come from the cache
+        not_modified = self._get('/assets/app.js', extra_headers={'If-None-Match': second.headers['ETag']})
+
+        self.assertEqual(200, second.code)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual('private, max-age=86400', second.headers['Cache-Control'])
+        self.assertFalse('Pragma' in second.headers)
+        self.assertEqual(304, not_modified.code)
+
+    def test_only_static_assets_of_known_image_version_get_cached(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+
+        with Server():
+            self._fetch_auth_cookie()
+            self._get('/assets/app.js')
+        response = self._get('/assets/app.js')
+
+        self.assertEqual(503, response.code)
+
+    def test_passes_validators_and_not_modified_through(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+
+        with Server():
+            self._fetch_auth_cookie()
+            first = self._get('/tagged')
+            second = self._get('/tagged', extra_headers={'If-None-Match': '"v1"'})
+
+        self.assertEqual(200, first.code)
+        self.assertEqual('"v1"', first.headers['ETag'])
+        self.assertEqual('Wed, 21 Oct 2015 07:28:00 GMT', first.headers['Last-Modified'])
+        self.assertEqual(304, second.code)
+        self.assertEqual('', second.body)
+
+    def test_passes_partial_content_through(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+
+        with Server():
+            self._fetch_auth_cookie()
+            response = self._get('/ranged', extra_headers={'Range': 'bytes=0-3'})
+
+        self.assertEqual(206, response.code)
+        self.assertEqual('0123', response.body)
+        self.assertEqual('bytes 0-3/10', response.headers['Content-Range'])
+        self.assertEqual('4', response.headers['Content-Length'])
+
+    def test_passes_agent_errors_and_all_cookies_through(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+
+        with Server():
+            self._fetch_auth_cookie()
+            missing = self._get('/missing')
+            cookies = self._get('/cookies')
+
+        self.assertEqual(404, missing.code)
+        self.assertEqual('no such mail', missing.body)
+        self.assertEqual(2, len(cookies.headers.get_list('Set-Cookie')))
+        self.assertEqual('SAMEORIGIN', cookies.headers['X-Frame-Options'])
+
+    def test_compresses_large_json_responses(self):
+        self.client.get_agent_runtime.return_value = {'state': 'running', 'port': Server.PORT}
+
+        with Server():
+            self._fetch_auth_cookie()
+            response = self._get('/mails', extra_headers={'Accept-Encoding': 'gzip'})
+            uncompressed = self._get('/mails', extra_headers={'Accept-Encoding': 'identity'})
+
+        self.assertEqual(MAILS, response.body)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+        self.assertFalse('Content-Encoding' in uncompressed.headers)
+        self.assertEqual(MAILS, uncompressed.body)
+
+        stats = json.loads(self._get('/dispatcher_stats').body)
+        self.assertEqual(1, stats['counters']['compression.gzip.responses'])
+        self.assertEqual(len(MAILS), stats['counters']['compression.gzip.bytes_in'])
+
+    def test_hop_by_hop_headers_are_not_forwarded(self):
+        headers = tornado.httputil.HTTPHeaders({'Connection': 'close, X-Session-Hint', 'X-Session-Hint': 'a', 'Keep-Alive': 'timeout=5', 'Transfer-Encoding': 'chunked', 'ETag': '"v1"'})
+
+        self.assertEqual([('Etag', '"v1"')], list(_end_to_end_headers(headers).get_all()))
+
     def test_pixelated_not_available_error_raised_on_503(self):
         # given
         self.client.get_agent.side_effect = PixelatedNotAvailableHTTPError
@@ -358,9 +766,10 @@ class DispatcherProxyTest(AsyncHTTPTestCase):
         self.assertEqual(302, response.code)
         self.assertEqual('Service+currently+not+available', cookies['error_msg'].value)
 
-    @patch('pixelated.proxy.HTTPServer')
+    @patch('pixelated.proxy.AdmissionHTTPServer')
     @patch('pixelated.proxy.tornado.ioloop.IOLoop.instance')
-    def test_serve_forever(self, ioloop_factory_mock, http_server_mock):
+    @patch('pixelated.proxy.create_ssl_context')
+    def test_serve_forever(self, create_ssl_context_mock, ioloop_factory_mock, http_server_mock):
         # given
         ioloop_mock = MagicMock()
         ioloop_factory_mock.return_value = ioloop_mock
@@ -377,7 +786,8 @@ class DispatcherProxyTest(AsyncHTTPTestCase):
             'ssl_version': latest_available_ssl_version(),
             'ciphers': DEFAULT_CIPHERS
         }
-        http_server_mock.assert_called_once_with(ANY, ssl_options=expected_ssl_options)
+        create_ssl_context_mock.assert_called_once_with(expected_ssl_options, 'prime256v1', True)
+        http_server_mock.assert_called_once_with(ANY, dispatcher._admission, ssl_options=create_ssl_context_mock.return_value)
 
     def test_status_msg(self):
         # given
@@ -389,3 +799,54 @@ class DispatcherProxyTest(AsyncHTTPTestCase):
         # then
         self.assertEqual(200, response.code)
         self.assertTrue('<div class="message-panel message-panel-small">\n<span>\nsome status msg\n</span>' in response.body)
+
+
+class DispatcherStaticFilesTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self._tmpdir = TempDir()
+        self.build_path = join(self._tmpdir.name, 'static_build')
+        self.manifest = build_static_assets(STATIC_PATH, self.build_path)
+        super(DispatcherStaticFilesTest, self).setUp()
+
+    def tearDown(self):
+        super(DispatcherStaticFilesTest, self).tearDown()
+        self._tmpdir.dissolve()
+
+    def get_app(self):
+        with patch('pixelated.proxy.STATIC_BUILD_PATH', self.build_path):
+            return DispatcherProxy(MagicMock()).create_app()
+
+    def _get(self, url, headers={}):
+        self.http_client.fetch(self.get_url(url), self.stop, headers=headers, use_gzip=False)
+        return self.wait()
+
+    def test_login_page_references_fingerprinted_files(self):
+        response = self._get('/auth/login')
+
+        self.assertTrue('href="/dispatcher_static/%s"' % self.manifest['pixelated.css'] in response.body)
+
+    def test_fingerprinted_files_are_immutable(self):
+        response = self._get('/dispatcher_static/%s' % self.manifest['favicon.png'])
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('public, max-age=31536000, immutable', response.headers['Cache-Control'])
+        self.assertEqual('DENY', response.headers['X-Frame-Options'])
+
+    def test_serves_precompressed_variant(self):
+        url = '/dispatcher_static/%s' % self.manifest['pixelated.css']
+
+        compressed = self._get(url, headers={'Accept-Encoding': 'gzip'})
+        plain = self._get(url, headers={'Accept-Encoding': 'identity'})
+
+        self.assertEqual('gzip', compressed.headers['Content-Encoding'])
+        self.assertEqual('text/css', compressed.headers['Content-Type'])
+        self.assertEqual('Accept-Encoding', compressed.headers['Vary'])
+        self.assertFalse('Content-Encoding' in plain.headers)
+        self.assertNotEqual(compressed.headers['Etag'], plain.headers['Etag'])
+        self.assertEqual(plain.body, compressed.body)  # curl decodes it
+
+    def test_original_names_keep_short_cache_time(self):
+        response = self._get('/dispatcher_static/pixelated.css')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('max-age=3600', response.headers['Cache-Control'])
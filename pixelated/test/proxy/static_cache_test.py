@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mock import MagicMock
+from tornado.httputil import HTTPHeaders
+
+from pixelated.proxy.static_cache import StaticAssetCache
+
+
+def _response(body, code=200, **headers):
+    response = MagicMock()
+    response.code = code
+    response.body = body
+    response.headers = HTTPHeaders(headers)
+    return response
+
+
+class StaticAssetCacheTest(unittest.TestCase):
+    def test_only_static_prefixes_are_cacheable(self):
+        cache = StaticAssetCache(prefixes=['/assets/'])
+
+        self.assertTrue(cache.is_static('/assets/app.js'))
+        self.assertFalse(cache.is_static('/mails'))
+
+    def test_assets_are_keyed_by_version_and_uri(self):
+        cache = StaticAssetCache()
+        cache.put('v1', '/js/app.js', _response('old', **{'Content-Type': 'application/javascript'}))
+
+        asset = cache.get('v1', '/js/app.js')
+
+        self.assertEqual('old', asset.body)
+        self.assertEqual({'Content-Type': 'application/javascript'}, asset.headers)
+        self.assertIsNone(cache.get('v2', '/js/app.js'))
+        self.assertEqual({'entries': 1, 'size': 3, 'hits': 1, 'misses': 1}, cache.stats())
+
+    def test_does_not_cache_errors_cookies_or_large_bodies(self):
+        cache = StaticAssetCache(max_entry_size=10)
+
+        self.assertIsNone(cache.put('v1', '/js/missing.js', _response('', code=404)))
+        self.assertIsNone(cache.put('v1', '/js/session.js', _response('x', **{'Set-Cookie': 'a=b'})))
+        self.assertIsNone(cache.put('v1', '/js/big.js', _response('x' * 11)))
+        self.assertEqual(0, cache.stats()['entries'])
+
+    def test_does_not_cache_private_or_varying_responses(self):
+        cache = StaticAssetCache()
+
+        for cache_control in ['private', 'no-store', 'No-Cache', 'max-age=60, private="Set-Cookie"']:
+            self.assertIsNone(cache.put('v1', '/js/a.js', _response('x', **{'Cache-Control': cache_control})))
+        self.assertIsNone(cache.put('v1', '/js/a.js', _response('x', Vary='Accept-Encoding, Cookie')))
+        self.assertIsNone(cache.put('v1', '/js/a.js', _response('x', Vary='*')))
+        self.assertEqual(0, cache.stats()['entries'])
+
+        self.assertIsNotNone(cache.put('v1', '/js/a.js', _response('x', Vary='accept-encoding', **{'Cache-Control': 'public, max-age=60'})))
+
+    def test_etag_only_matches_whole_tags(self):
+        asset = StaticAssetCache().put('v1', '/js/a.js', _response('a'))
+
+        self.assertTrue(asset.matches('"other", %s' % asset.etag))
+        self.assertTrue(asset.matches('W/%s' % asset.etag))
+        self.assertTrue(asset.matches('*'))
+        self.assertFalse(asset.matches('"x%s"' % asset.etag.strip('"')))
+        self.assertFalse(asset.matches('"prefix, %s"' % asset.etag.strip('"')))
+        self.assertFalse(asset.matches(''))
+
+    def test_evicts_least_recently_used_assets(self):
+        cache = StaticAssetCache(max_size=10)
+        cache.put('v1', '/js/a.js', _response('aaaa'))
+        cache.put('v1', '/js/b.js', _response('bbbb'))
+        cache.get('v1', '/js/a.js')
+
+        cache.put('v1', '/js/c.js', _response('cccc'))
+
+        self.assertIsNotNone(cache.get('v1', '/js/a.js'))
+        self.assertIsNone(cache.get('v1', '/js/b.js'))
+        self.assertEqual(8, cache.stats()['size'])
+
+    def test_etag_changes_with_content(self):
+        cache = StaticAssetCache()
+
+        first = cache.put('v1', '/js/a.js', _response('a'))
+        second = cache.put('v1', '/js/a.js', _response('b'))
+
+        self.assertNotEqual(first.etag, second.etag)
+        self.assertEqual(1, cache.stats()['size'])
+
+    def test_compressed_variants_get_computed_once_and_count_towards_size(self):
+        cache = StaticAssetCache()
+        asset = cache.put('v1', '/js/a.js', _response('aaaa'))
+        compress = MagicMock(return_value='zz')
+
+        self.assertEqual('zz', cache.encoded(asset, 'gzip', compress))
+        self.assertEqual('zz', cache.encoded(asset, 'gzip', compress))
+
+        compress.assert_called_once_with('gzip', 'aaaa')
+        self.assertEqual(6, cache.stats()['size'])
@@ -0,0 +1,96 @@
+#
+# Copyright (c) 2014 ThoughtWorks Deutschland GmbH
+#
+# Pixelated is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pixelated is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
+import socket
+import ssl
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+from pixelated.common import latest_available_ssl_version, DEFAULT_CIPHERS
+from pixelated.proxy.tls import create_ssl_context, TLSStats, OP_NO_TICKET
+from pixelated.test.util import certfile, keyfile
+
+
+class CreateSSLContextTest(unittest.TestCase):
+    def setUp(self):
+        self.ssl_options = {'certfile': certfile(), 'keyfile': keyfile(), 'ssl_version': latest_available_ssl_version(), 'ciphers': DEFAULT_CIPHERS}
+
+    def test_server_picks_cipher_and_tickets_are_on_by_default(self):
+        context = create_ssl_context(self.ssl_options)
+
+        self.assertTrue(context.options & ssl.OP_CIPHER_SERVER_PREFERENCE)
+        self.assertFalse(context.options & OP_NO_TICKET)
+
+    def test_session_tickets_can_be_turned_off(self):
+        context = create_ssl_context(self.ssl_options, session_tickets=False)
+
+        self.assertTrue(context.options & OP_NO_TICKET)
+
+    def test_unknown_curve_fails(self):
+        self.assertRaises(ValueError, create_ssl_context, self.ssl_options, ecdh_curve='no-such-curve')
+
+    def test_handshakes_get_counted(self):
+        context = create_ssl_context(self.ssl_options)
+        stats = TLSStats(context)
+        server, client = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        accepted = threading.Thread(target=lambda: context.wrap_socket(server, server_side=True).close())
+        accepted.start()
+
+        ssl.wrap_socket(client, ssl_version=latest_available_ssl_version()).close()
+        accepted.join()
+
+        snapshot = stats.snapshot()
+        self.assertEqual(1, snapshot['handshakes'])
+        self.assertEqual(0, snapshot['resumed'])
+
+
+class TLSStatsTest(unittest.TestCase):
+    def _context(self, accept_good, hits):
+        context = MagicMock()
+        context.session_stats.return_value = {'accept_good': accept_good, 'hits': hits, 'number': 3, 'misses': 1, 'timeouts': 0, 'cache_full': 0}
+        return context
+
+    @patch('pixelated.proxy.tls.time.time')
+    def test_resumption_ratio_and_handshake_rate(self, time_mock):
+        context = self._context(0, 0)
+        time_mock.return_value = 100
+        stats = TLSStats(context)
+        context.session_stats.return_value.update(accept_good=20, hits=15)
+        time_mock.return_value = 110
+
+        snapshot = stats.snapshot()
+
+        self.assertEqual(20, snapshot['handshakes'])
+        self.assertEqual(15, snapshot['resumed'])
+        self.assertEqual(0.75, snapshot['resumption_ratio'])
+        self.assertEqual(2.0, snapshot['handshakes_per_second'])
+        self.assertEqual(3, snapshot['session_cache']['size'])
+
+    @patch('pixelated.proxy.tls.time.time')
+    def test_handshake_rate_is_since_previous_snapshot(self, time_mock):
+        context = self._context(10, 0)
+        time_mock.return_value = 100
+        stats = TLSStats(context)
+        time_mock.return_value = 105
+        stats.snapshot()
+        context.session_stats.return_value['accept_good'] = 15
+        time_mock.return_value = 110
+
+        self.assertEqual(1.0, stats.snapshot()['handshakes_per_second'])
+
+    def test_no_handshakes_yet(self):
+        self.assertEqual(0.0, TLSStats(self._context(0, 0)).snapshot()['resumption_ratio'])
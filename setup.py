@@ -15,7 +15,8 @@
 # along with Pixelated. If not, see <http://www.gnu.org/licenses/>.
 import os
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Command
+from setuptools.command.build_py import build_py
 from setuptools.command.install import install
 
 
@@ -26,6 +27,31 @@ class write_login_banner(install):
         install.run(self)
 
 
+class build_static(Command):
+    """Fingerprints and precompresses the static files of the dispatcher."""
+    description = 'build fingerprinted and gzipped dispatcher static files'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from pixelated.common.static_assets import build_static_assets
+        files = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pixelated', 'files')
+        manifest = build_static_assets(os.path.join(files, 'static'), os.path.join(files, 'static_build'))
+        for name, fingerprinted in sorted(manifest.items()):
+            self.announce('%s -> %s' % (name, fingerprinted), level=2)
+
+
+class build_py_with_static(build_py):
+    def run(self):
+        self.run_command('build_static')
+        build_py.run(self)
+
+
 # Utility function to read the README file.
 # Used for the long_description.  It's nice, because now 1) we have a top level
 # README file and 2) it's easier to type in the README file than to put a raw
@@ -40,6 +66,8 @@ setup(
     packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
     cmdclass={
         'install': write_login_banner,
+        'build_static': build_static,
+        'build_py': build_py_with_static,
     },
 
 